@@ -0,0 +1,78 @@
+from cloudnode.base.core.swiftdata.modeling import SwiftDataInternal
+from cloudnode import SwiftData, sd
+from elasticsearch_dsl.response import Response
+import dataclasses
+import datetime
+import random
+import time
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# This benchmark compares the decoding of a 10k-hit search response into SwiftData objects: the legacy path, which is
+# ElasticSearchDslClient.perform_dsl_query followed by SwiftData construction (hit.to_dict(), es_cls(**source), meta.id,
+# es_obj.to_dict(), cls(**values): four conversions per hit), against the raw path of SwiftData.expert_query, which is
+# the plain json response decoded by the codecs of each field, and against its columnar variant (as_columns=True). No
+# ElasticSearch server is necessary: the response is synthesized as the json dict the ElasticSearch client would return.
+# python benchmark_hit_decoding.py
+
+
+@dataclasses.dataclass
+class BenchmarkPage(SwiftData):
+    url: sd.string()
+    text: sd.string(analyze=True)
+    labels: sd.string(list=True)
+    views: sd.integer()
+    now: sd.timestamp()
+
+
+def synthesize_response(n_hits):
+    words = ["washington", "estate", "mount", "vernon", "farms", "whiskey", "dentures", "foxhound", "cherry", "tree"]
+    hits = []
+    for i in range(n_hits):
+        now = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc) + datetime.timedelta(minutes=i)
+        source = dict(id=f"{i:08d}", ts=now.isoformat(), url=f"https://example.com/{i}", views=random.randint(0, 10**6),
+                      text=" ".join(random.choices(words, k=60)), labels=random.choices(words, k=3), now=now.isoformat())
+        hits.append(dict(_index="index.benchmarkpage.elasticsearchdocument", _id=source["id"], _score=1.0, _source=source))
+    return dict(took=5, timed_out=False, hits=dict(total=dict(value=n_hits, relation="eq"), max_score=1.0, hits=hits))
+
+
+def legacy_decode(es_cls, raw):
+    r = Response(es_cls.search(), raw)
+    es_objs = []
+    for h in r["hits"]["hits"]:  # as in ElasticSearchDslClient.perform_dsl_query
+        h = h.to_dict()
+        d = es_cls(**h["_source"])
+        d.meta.id = h["_id"]
+        es_objs.append(d)
+    return [BenchmarkPage(**SwiftDataInternal.es_obj_swiftdata_init(obj)) for obj in es_objs]
+
+
+def raw_decode(raw): return SwiftDataInternal.decode_hits(BenchmarkPage, raw["hits"]["hits"])
+
+
+def raw_decode_as_columns(raw): return SwiftDataInternal.decode_hits_as_columns(BenchmarkPage, raw["hits"]["hits"])
+
+
+def timed(function, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        s = time.perf_counter()
+        result = function(*args)
+        duration_s = time.perf_counter() - s
+        best = duration_s if best is None else min(best, duration_s)
+    return best, result
+
+
+if __name__ == "__main__":
+    n_hits = 10000
+    raw = synthesize_response(n_hits)
+    es_cls, _ = SwiftDataInternal.build_es_class_from_swift_class(BenchmarkPage, "benchmark")
+    logging.disable(logging.INFO)
+    results = dict(legacy=timed(legacy_decode, es_cls, raw), raw=timed(raw_decode, raw),
+                   columns=timed(raw_decode_as_columns, raw))
+    logging.disable(logging.NOTSET)
+    for name, (duration_s, _) in results.items():
+        logger.info(f"{name:>8s}: {duration_s*1000:9.1f} ms for {n_hits} hits; {n_hits/duration_s:12.0f} hits/s; "
+                    f"{results['legacy'][0]/duration_s:5.1f}x legacy")
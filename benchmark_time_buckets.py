@@ -0,0 +1,76 @@
+from cloudnode import SwiftData, SwiftDataBackend, sd
+from cloudnode.base.core.swiftdata.modeling import SwiftDataInternal
+from elasticsearch_dsl import Q
+import dataclasses
+import datetime
+import random
+import time
+
+import logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# This benchmark compares window filters on a timestamp as plain ranges against their rewrite into terms over the time
+# buckets of sd.timestamp(buckets=...): the same windows (hours to days, aligned and unaligned) are counted with the
+# range query and with the bucketed query, in the search engine (the embedded engine by default; engine="docker" runs
+# against ElasticSearch) and in the local index, whose candidates come from its bucket keys instead of a scan.
+# python benchmark_time_buckets.py
+
+n_records, n_windows, repeats = 20000, 50, 3
+index = "benchmark"
+t0 = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+@dataclasses.dataclass
+class Event(SwiftData):
+    now: sd.timestamp(buckets=["5m", "1h", "1d"])
+    n: sd.integer()
+
+
+def windows(rng):
+    found = []
+    for _ in range(n_windows):
+        start = t0 + datetime.timedelta(minutes=rng.randint(0, 25 * 24 * 60))
+        if rng.random() < 0.5: start = start.replace(minute=0)  # half of the windows are aligned to hours
+        span = datetime.timedelta(hours=rng.choice([1, 6, 24, 72]), minutes=rng.choice([0, 0, 17]))
+        found.append(f"now:{start.isoformat()}..{(start + span).isoformat()}".replace("+00:00", "Z"))
+    return found
+
+
+def timed(count, queries):
+    s = time.perf_counter()
+    for _ in range(repeats): counts = [count(q) for q in queries]
+    return (time.perf_counter() - s) / repeats / len(queries) * 1000, counts
+
+
+if __name__ == "__main__":
+    rng = random.Random(11)
+    swift = SwiftDataBackend().start(engine="embedded", rebuild=True)
+    Event.create_index(index, exist_ok=True)
+    events = [Event.new(id=str(i), now=t0 + datetime.timedelta(seconds=rng.randint(0, 30 * 86400)), n=i) for i in range(n_records)]
+    es_cls, es_index = SwiftDataInternal.build_es_class_from_swift_class(Event, index)
+    with swift.bulk_indexer() as indexer:
+        indexer.add_all(dict(_index=es_index._name, _id=e.id, _source=es_cls(**SwiftDataInternal.swiftdata_obj_es_init(e)).to_dict())
+                        for e in events)
+    Event.refresh_index(index, es=True)
+    queries = windows(rng)
+
+    as_range = lambda s: Q("range", now=dict(zip(["gte", "lte"], s.split(":", 1)[1].split(".."))))
+    range_ms, range_counts = timed(lambda s: Event.count(index, q=as_range(s), es=True), queries)
+    bucket_ms, bucket_counts = timed(lambda s: Event.count(index, q=s, es=True), queries)
+    assert range_counts == bucket_counts, "bucketed windows must count the same records as ranges"
+    logger.info(f"search engine: range {range_ms:7.2f} ms/window; buckets {bucket_ms:7.2f} ms/window; "
+                f"x{range_ms / max(bucket_ms, 1e-9):.1f} over {n_records} records")
+
+    local_index = Event.local_index(index)
+    for e in events: local_index.upsert(e)
+    compile = lambda s: SwiftDataInternal.compiled_search_bar(Event, s, local=True)
+    def scan(s):  # the same predicate without its bucket lookups; every record is tested
+        predicate = compile(s)
+        return local_index.count(lambda values, tokens: predicate(values, tokens))
+    range_ms, range_counts = timed(scan, queries)
+    bucket_ms, bucket_counts = timed(lambda s: local_index.count(compile(s)), queries)
+    assert range_counts == bucket_counts, "bucketed windows must count the same records as ranges"
+    logger.info(f"  local index: range {range_ms:7.2f} ms/window; buckets {bucket_ms:7.2f} ms/window; "
+                f"x{range_ms / max(bucket_ms, 1e-9):.1f} over {n_records} records")
+    swift.stop()
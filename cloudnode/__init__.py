@@ -1,5 +1,8 @@
 from cloudnode.base.core.swiftdata.modeling import SwiftData, SwiftDataBackend
 from cloudnode.base.core.swiftdata.models import sd
+from cloudnode.base.core.elasticsearch.rollover import Rollover
+from cloudnode.base.core.swiftdata.tiering import Tiering
+from cloudnode.base.core.elasticsearch.transport import TransportProfile
 from cloudnode.base.core.lightweight_utilities.filesystem import FileSystem
 from cloudnode.config import RuntimeConfig
 
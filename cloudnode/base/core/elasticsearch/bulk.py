@@ -0,0 +1,190 @@
+from elasticsearch import helpers
+import elasticsearch.exceptions
+import elastic_transport
+import collections
+import threading
+import queue
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+# The BulkIndexer is a long-lived service that indexes documents from any number of producer threads. Each document is
+# serialized once at .add() into its two ndjson lines and put on a bounded queue, so that producers block (backpressure)
+# rather than memory grow when ElasticSearch is slower than the producers; memory is therefore flat for arbitrarily
+# large iterators: at most max_queue documents plus one batch per worker are held at any time.
+#
+# BATCHING: n_workers threads each take documents from the queue until the batch reaches the byte budget, or the queue
+# has been empty for linger_s. Byte budget is what matters to ElasticSearch (about 5MB is ideal, 100MB is the maximum)
+# and adapts to observed latency: additive increase while batches return faster than target_latency_s, multiplicative
+# decrease when they are slower or rejected.
+# RETRIES: documents rejected with 429 (the write thread pool queue of ElasticSearch is full) are retried by the worker
+# with exponential backoff, as are whole requests rejected with 429 or 503 or failing on connection; documents which fail
+# for any other reason (i.e., mapping errors) are counted as failures and the most recent are kept for inspection. Bulk
+# requests are sent with max_retries=0, so that they are retried by the worker only and not by the transport as well.
+# WATCHED: documents added into an index for which watched(index) is True keep their source, and are passed to
+# on_indexed([(index, id, source)]) once indexed, i.e., to match them against the saved queries of SwiftData.watch.
+
+
+class BulkIndexer(object):
+    """Multi-producer, multi-worker bulk indexing service with adaptive batches, 429 backoff and metrics."""
+
+    def __init__(self, es, n_workers=4, max_queue=10000, batch_bytes=5 * 2**20, min_batch_bytes=2**20,
+                 max_batch_bytes=50 * 2**20, target_latency_s=1.0, linger_s=0.05, max_retries=8,
+                 initial_backoff_s=0.5, max_backoff_s=30.0, refresh=False, watched=None, on_indexed=None):
+        self.es = es.options(max_retries=0)  # NOTE: the worker retries, with the backoff of the whole batch
+        self.n_workers = n_workers
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.batch_bytes = batch_bytes
+        self.min_batch_bytes, self.max_batch_bytes = min_batch_bytes, max_batch_bytes
+        self.target_latency_s = target_latency_s
+        self.linger_s = linger_s
+        self.max_retries = max_retries
+        self.initial_backoff_s, self.max_backoff_s = initial_backoff_s, max_backoff_s
+        self.refresh = refresh
+        self.watched = watched        # watched(index) => True if the documents added into index are passed to on_indexed
+        self.on_indexed = on_indexed
+        self.serializer = es.transport.serializers.get_serializer("application/json")
+        self.lock = threading.Lock()
+        self.workers = []
+        self.stopping = threading.Event()
+        self.recent_failures = collections.deque(maxlen=100)
+        self.counters = dict(docs=0, bytes=0, batches=0, failures=0, retries=0, backoff_s=0.0, latency_s=0.0)
+        self.started_s = None
+
+    def __enter__(self): return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb): self.close()
+
+    def start(self):
+        if len(self.workers) != 0: return self
+        self.started_s = time.time()
+        self.stopping.clear()
+        for i in range(self.n_workers):
+            worker = threading.Thread(target=self.__work, name=f"BulkIndexer-{i}", daemon=True)
+            worker.start()
+            self.workers.append(worker)
+        return self
+
+    def add(self, action):
+        """Adds one document; action is an elasticsearch.helpers action dict or a Document. Blocks if the queue is full."""
+        if len(self.workers) == 0: raise RuntimeError("BulkIndexer must be started before adding documents.")
+        if hasattr(action, "to_dict"): action = action.to_dict(True)
+        op, source = helpers.expand_action(action)
+        lines = [self.serializer.dumps(op)] + ([] if source is None else [self.serializer.dumps(source)])
+        kind, meta = list(op.items())[0]
+        watched = (meta.get("_index"), meta.get("_id"), source) if self.watched is not None and kind in ["index", "create"] \
+            and self.watched(meta.get("_index")) else None
+        self.queue.put((lines, sum(len(line) + 1 for line in lines), watched))
+
+    def add_all(self, actions):
+        """Adds documents from any iterable, i.e., a generator; only max_queue of them are held at any time."""
+        n = 0
+        for action in actions:
+            self.add(action)
+            n += 1
+        return n
+
+    def flush(self):
+        """Blocks until every document added so far has been indexed or has failed."""
+        self.queue.join()
+        return self
+
+    def close(self):
+        """Flushes, then stops the workers; returns the final metrics."""
+        self.flush()
+        self.stopping.set()
+        for worker in self.workers: worker.join()
+        self.workers = []
+        return self.metrics()
+
+    def metrics(self):
+        """Returns docs/s and bytes/s since start, queue depth, the current byte budget, retries and failures."""
+        with self.lock: counters = dict(self.counters)
+        elapsed_s = max(1e-9, time.time() - (self.started_s or time.time()))
+        return dict(docs=counters["docs"], bytes=counters["bytes"], docs_per_s=counters["docs"] / elapsed_s,
+                    bytes_per_s=counters["bytes"] / elapsed_s, queue_depth=self.queue.qsize(),
+                    batches=counters["batches"], batch_bytes=self.batch_bytes,
+                    mean_latency_s=counters["latency_s"] / max(1, counters["batches"]),
+                    retries=counters["retries"], backoff_s=counters["backoff_s"], failures=counters["failures"])
+
+    def failures(self):
+        """Returns the most recent failed items, each as dict(status, error, action)."""
+        return list(self.recent_failures)
+
+    def __work(self):
+        while not self.stopping.is_set():
+            batch = self.__next_batch()
+            if len(batch) == 0: continue
+            try: self.__send(batch)
+            except Exception as e:
+                logger.error(f"BulkIndexer batch of {len(batch)} failed: {e}", exc_info=True)
+                self.__fail(batch, None, str(e))
+            finally:
+                for _ in batch: self.queue.task_done()
+
+    def __next_batch(self):
+        batch, size = [], 0
+        try: item = self.queue.get(timeout=0.1)
+        except queue.Empty: return batch
+        while True:
+            batch.append(item)
+            size += item[1]
+            if size >= self.batch_bytes: return batch
+            try: item = self.queue.get(timeout=self.linger_s)
+            except queue.Empty: return batch
+
+    def __send(self, batch):
+        attempt = 0
+        while len(batch) != 0:
+            s = time.time()
+            try:
+                response = self.es.bulk(operations=[line for lines, _, _ in batch for line in lines], refresh=self.refresh)
+            except (elasticsearch.exceptions.ApiError, elastic_transport.TransportError) as e:
+                status = getattr(getattr(e, "meta", None), "status", None)
+                retryable = status in [429, 503] or isinstance(e, elastic_transport.TransportError)
+                if not retryable or attempt >= self.max_retries: raise
+                attempt = self.__backoff(attempt, len(batch))
+                continue
+            latency_s = time.time() - s
+            sent_bytes = sum(size for _, size, _ in batch)
+            retry, n_indexed, indexed = [], 0, []
+            for item, result in zip(batch, response.body["items"]):
+                result = list(result.values())[0]
+                status = result.get("status", 200)
+                if status == 429 and attempt < self.max_retries: retry.append(item)
+                elif status >= 300: self.__fail([item], status, result.get("error"))
+                else:
+                    n_indexed += 1
+                    if item[2] is not None: indexed.append((item[2][0], result.get("_id", item[2][1]), item[2][2]))
+            with self.lock:
+                self.counters["docs"] += n_indexed
+                self.counters["bytes"] += sent_bytes
+                self.counters["batches"] += 1
+                self.counters["latency_s"] += latency_s
+            self.__adapt(latency_s, sent_bytes, rejected=len(retry) != 0)
+            if len(indexed) != 0:
+                try: self.on_indexed(indexed)
+                except Exception as e: logger.warning(f"BulkIndexer on_indexed of {len(indexed)} documents failed: {e}")
+            batch = retry
+            if len(batch) != 0: attempt = self.__backoff(attempt, len(batch))
+
+    def __backoff(self, attempt, n):
+        s = min(self.max_backoff_s, self.initial_backoff_s * 2 ** attempt)
+        logger.warning(f"BulkIndexer rejected {n} documents; retrying in {s:.2f}s")
+        with self.lock:
+            self.counters["retries"] += n
+            self.counters["backoff_s"] += s
+        time.sleep(s)
+        return attempt + 1
+
+    def __adapt(self, latency_s, sent_bytes, rejected):
+        """Additive increase of the byte budget while fast and full; multiplicative decrease if slow or rejected."""
+        with self.lock:
+            if rejected or latency_s > self.target_latency_s: self.batch_bytes = max(self.min_batch_bytes, self.batch_bytes // 2)
+            elif sent_bytes >= self.batch_bytes and latency_s < self.target_latency_s / 2:
+                self.batch_bytes = min(self.max_batch_bytes, self.batch_bytes + self.min_batch_bytes)
+
+    def __fail(self, items, status, error):
+        with self.lock: self.counters["failures"] += len(items)
+        for lines, _, _ in items: self.recent_failures.append(dict(status=status, error=error, action=lines[0]))
@@ -0,0 +1,1338 @@
+from cloudnode.base.core.elasticsearch.search import ElasticSearchClient
+from cloudnode.base.core.elasticsearch.searchbar import analyze, as_utc_datetime, date_math
+from cloudnode.base.core.elasticsearch import geo
+from elastic_transport import ApiResponseMeta, ObjectApiResponse, HeadApiResponse, HttpHeaders, NodeConfig
+from elasticsearch.serializer import JsonSerializer
+import elasticsearch.exceptions
+import urllib.parse
+import contextlib
+import functools
+import threading
+import datetime
+import fnmatch
+import shutil
+import numpy
+import math
+import json
+import time
+import uuid
+import os
+import re
+
+import logging
+logger = logging.getLogger(__name__)
+
+########################################################################################################################
+# Embedded ElasticSearch
+########################################################################################################################
+# The embedded engine is an in-process stand-in for the dockerized ElasticSearch server, for hosts which cannot run the
+# docker image (ci boxes, edge nodes, benchmark machines). EmbeddedElasticsearch duck-types the Elasticsearch client
+# object so that elasticsearch-dsl Documents, Index and Search, and the elasticsearch.helpers (scan, streaming_bulk),
+# run against it unchanged: SwiftDataBackend().start(engine="embedded") switches all es=True paths onto it.
+#
+# SUPPORTED: index/create/get/mget/exists/delete/update/bulk; search with scroll, size, from, sort, _source, filter_path
+# and count over the query subset that SwiftData generates: bool (must, filter, should, must_not), match_all, match,
+# match_phrase, multi_match, term, terms, range (with simple now-1d/d date math), exists, ids, prefix, constant_score;
+# and the completion suggester over the whole values of a field with a completion multi-field; knn (exact, by cosine)
+# alone or summed with a query, and msearch; the metric aggregations (stats, min, max, avg, sum, value_count) and terms;
+# geo_distance and geo_bounding_box over geo_point fields with the _geo_distance sort and the geohash_grid aggregation.
+# Aliases (index names for reads, with a write index for writes; see indices.update_aliases) and _reindex, which runs
+# as a task when wait_for_completion=False and reports its status through tasks.get, as ElasticSearch does; the docs and
+# store metrics of indices.stats.
+# Scroll contexts expire after their keep-alive (i.e., scroll="1m"), which each scroll call renews, as in ElasticSearch.
+# Text is analyzed with the standard-like analyzer of searchbar.analyze and scored with BM25 (k1=1.2, b=0.75). Keys
+# of flattened fields (field.key) are keyword fields, and the flattened field itself matches any of its leaf values.
+# Near-real-time: like ElasticSearch, writes are searchable after a refresh, which occurs at most every refresh_interval_s
+# (1s, as the ElasticSearch default) when searched, or when asked for by refresh=True or indices.refresh.
+# PERSISTENCE: with a directory, indices are written at flush() (i.e., at SwiftDataBackend.stop) and loaded at startup;
+# snapshots (_snapshot repository api of type fs) are written as json files into the registered repository location.
+
+
+class EmbeddedIndex(object):
+    """One index of the embedded engine: realtime documents, their searchable (refreshed) view, and its postings."""
+
+    k1, b = 1.2, 0.75
+
+    def __init__(self, name, mappings=None, settings=None):
+        self.name = name
+        self.uuid = uuid.uuid4().hex[:22]
+        self.mappings = dict(properties=dict()) if mappings is None else mappings
+        self.settings = dict() if settings is None else settings
+        self.docs = dict()        # map from id => dict(_source, _version, _seq_no): realtime, as get
+        self.searchable = dict()  # map from id => EmbeddedDoc: as of the last refresh, as search
+        self.dirty = set()        # ids written since the last refresh
+        self.postings = dict()    # map from field => dict(token or exact value => set of ids)
+        self.lengths = dict()     # map from field => total number of tokens; for BM25 average field length
+        self.seq_no = 0
+        self.restored_bytes = None  # the size of the snapshot it was restored from, if any; for _recovery
+        self.aliases = dict()     # map from alias => dict(is_write_index=...)
+        self.last_refresh_s = time.time()
+        self.lock = threading.RLock()
+
+    def properties(self): return self.mappings.setdefault("properties", dict())
+
+    def field_mapping(self, field):
+        """Returns the mapping of a (dotted) field, including multi-fields (i.e., url.keyword), or None if unmapped."""
+        mapping, properties = None, self.properties()
+        for part in field.split("."):
+            if mapping is not None and mapping.get("type") == "flattened": return dict(type="keyword")  # a keyed value
+            if part in properties: mapping = properties[part]
+            elif mapping is not None and part in mapping.get("fields", dict()): mapping = mapping["fields"][part]
+            else: return None
+            properties = mapping.get("properties", dict())
+        return mapping
+
+    def field_type(self, field):
+        mapping = self.field_mapping(field)
+        return None if mapping is None else mapping.get("type", "object")
+
+    def source_field(self, field):
+        """Returns the source field of a (dotted) field; i.e., url.keyword is indexed from the values of url."""
+        parts, properties = [], self.properties()
+        for part in field.split("."):
+            if part not in properties: break
+            if properties[part].get("type") == "flattened": return field  # keys of flattened fields are source fields
+            parts.append(part)
+            properties = properties[part].get("properties", dict())
+        return ".".join(parts) if len(parts) != 0 else field
+
+    def map_dynamic(self, source, properties=None):
+        """Adds the mapping of unmapped fields as ElasticSearch dynamic mapping does: long, float, boolean, date, object
+        and text with a .keyword multi-field (for strings that are not dates)."""
+        if str(self.mappings.get("dynamic", True)).lower() in ["false", "strict"]: return
+        properties = self.properties() if properties is None else properties
+        for key, value in source.items():
+            values = value if isinstance(value, list) else [value]
+            values = [v for v in values if v is not None]
+            if len(values) == 0: continue
+            if key in properties:
+                if isinstance(values[0], dict) and "properties" in properties[key]:
+                    for v in values: self.map_dynamic(v, properties[key]["properties"])
+                continue
+            properties[key] = dynamic_mapping(values[0])
+            if isinstance(values[0], dict):
+                for v in values: self.map_dynamic(v, properties[key]["properties"])
+
+    def write(self, id, source):
+        with self.lock:
+            self.map_dynamic(source)
+            self.seq_no += 1
+            version = self.docs[id]["_version"] + 1 if id in self.docs else 1
+            self.docs[id] = dict(_source=source, _version=version, _seq_no=self.seq_no)
+            self.dirty.add(id)
+            return version
+
+    def remove(self, id):
+        with self.lock:
+            if id not in self.docs: return False
+            self.seq_no += 1
+            del self.docs[id]
+            self.dirty.add(id)
+            return True
+
+    def refresh(self):
+        """Makes all writes since the last refresh searchable; maintains postings and field lengths incrementally."""
+        with self.lock:
+            for id in self.dirty:
+                if id in self.searchable: self.__unpost(self.searchable.pop(id))
+                if id in self.docs:
+                    doc = EmbeddedDoc(id, self.docs[id]["_source"], self)
+                    self.searchable[id] = doc
+                    self.__post(doc)
+            self.dirty = set()
+            self.last_refresh_s = time.time()
+
+    def refresh_if_due(self, refresh_interval_s):
+        if len(self.dirty) != 0 and time.time() - self.last_refresh_s >= refresh_interval_s: self.refresh()
+
+    def __post(self, doc):
+        for field, tokens in doc.tokens.items():
+            postings = self.postings.setdefault(field, dict())
+            for token in set(tokens): postings.setdefault(token, set()).add(doc.id)
+            self.lengths[field] = self.lengths.get(field, 0) + len(tokens)
+        for field, values in doc.exact.items():
+            postings = self.postings.setdefault(field, dict())
+            for value in values: postings.setdefault(value, set()).add(doc.id)
+
+    def __unpost(self, doc):
+        for field, tokens in doc.tokens.items():
+            for token in set(tokens): self.postings[field][token].discard(doc.id)
+            self.lengths[field] -= len(tokens)
+        for field, values in doc.exact.items():
+            for value in values: self.postings[field][value].discard(doc.id)
+
+    def idf(self, field, token):
+        df = len(self.postings.get(field, dict()).get(token, ()))
+        n = len(self.searchable)
+        return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+    def bm25(self, doc, field, query_tokens):
+        tokens = doc.tokens.get(field)
+        if tokens is None: return 0.0
+        average = self.lengths.get(field, 0) / max(1, len(self.searchable))
+        score = 0.0
+        for token in query_tokens:
+            f = tokens.count(token)
+            if f == 0: continue
+            norm = self.k1 * (1 - self.b + self.b * len(tokens) / max(average, 1e-9))
+            score += self.idf(field, token) * f * (self.k1 + 1) / (f + norm)
+        return score
+
+    def as_dict(self):
+        return dict(name=self.name, mappings=self.mappings, settings=self.settings, aliases=self.aliases,
+                    docs={id: d["_source"] for id, d in self.docs.items()})
+
+    @staticmethod
+    def from_dict(d):
+        index = EmbeddedIndex(d["name"], mappings=d["mappings"], settings=d["settings"])
+        index.aliases = d.get("aliases", dict())
+        for id, source in d["docs"].items(): index.write(id, source)
+        index.refresh()
+        return index
+
+
+class EmbeddedDoc(object):
+    """A searchable document: its source, the analyzed tokens of its text fields and the values of its keyword fields."""
+
+    def __init__(self, id, source, index):
+        self.id = id
+        self.source = source
+        self.tokens = dict()  # map from field => analyzed tokens of text fields
+        self.exact = dict()   # map from field => exact string values of keyword fields
+        self.index = index
+        for field, values in flatten(source).items():
+            mapping = index.field_mapping(field) or dict()
+            kind = mapping.get("type")
+            if kind == "text": self.tokens[field] = analyze(values)
+            if kind == "keyword": self.exact[field] = set(str(v) for v in values)
+            if kind == "flattened":  # the root of a flattened field matches any of its leaf values
+                self.exact[field] = set(str(leaf) for value in values for leaves in flatten(value).values()
+                                        for leaf in leaves if not isinstance(leaf, dict))
+            for name, sub in mapping.get("fields", dict()).items():
+                if sub.get("type") == "keyword": self.exact[f"{field}.{name}"] = set(str(v) for v in values)
+
+    def values(self, field):
+        return field_values(self.source, self.index.source_field(field))
+
+
+def dynamic_mapping(value):
+    if isinstance(value, bool): return dict(type="boolean")
+    if isinstance(value, int): return dict(type="long")
+    if isinstance(value, float): return dict(type="float")
+    if isinstance(value, dict): return dict(properties=dict())
+    if _dynamic_date.match(str(value)): return dict(type="date")
+    return dict(type="text", fields=dict(keyword=dict(type="keyword", ignore_above=256)))
+
+
+_dynamic_date = re.compile(r"^\d{4}-\d{2}-\d{2}([T ]\d{2}:\d{2}(:\d{2}(\.\d+)?)?(Z|[+-]\d{2}:?\d{2})?)?$")
+
+
+def flatten(source, prefix=""):
+    """Flattens nested objects into dict(dotted field => list of leaf values)."""
+    flat = dict()
+    for key, value in source.items():
+        name = f"{prefix}{key}"
+        if isinstance(value, dict):
+            flat[name] = [value]
+            flat.update(flatten(value, prefix=f"{name}."))
+        else: flat[name] = value if isinstance(value, list) else [value]
+    return flat
+
+
+def field_values(source, field):
+    """Returns the list of values of a (dotted) field in source; lists are expanded, missing is the empty list."""
+    values = [source]
+    for part in field.split("."):
+        found = []
+        for value in values:
+            if isinstance(value, dict) and part in value:
+                v = value[part]
+                found.extend(v if isinstance(v, list) else [v])
+        values = found
+    return [v for v in values if v is not None]
+
+
+########################################################################################################################
+# query evaluation
+########################################################################################################################
+
+
+class EmbeddedQuery(object):
+    """Compiles the query dsl into candidates(index) => set of ids (None is all) and score(doc) => float or None."""
+
+    def __init__(self, candidates, score):
+        self.candidates = candidates
+        self.score = score
+
+    @staticmethod
+    def compile(query, index):
+        if query is None or len(query) == 0: return EmbeddedQuery.compile(dict(match_all=dict()), index)
+        if len(query) != 1: raise EmbeddedBadRequest(f"query must have exactly one clause: {query}")
+        name, body = list(query.items())[0]
+        if name not in EmbeddedQuery.compilers: raise EmbeddedBadRequest(f"query [{name}] is not supported by the embedded engine")
+        return EmbeddedQuery.compilers[name](body, index)
+
+    @staticmethod
+    def field_and_params(body, key):
+        field, params = list(body.items())[0]
+        if not isinstance(params, dict): params = {key: params}
+        return field, params
+
+    @staticmethod
+    def match_all(body, index): return EmbeddedQuery(lambda: None, lambda doc: float(body.get("boost", 1.0)))
+
+    @staticmethod
+    def match_none(body, index): return EmbeddedQuery(lambda: set(), lambda doc: None)
+
+    @staticmethod
+    def ids(body, index):
+        ids = set(str(v) for v in body["values"])
+        return EmbeddedQuery(lambda: ids & set(index.searchable.keys()), lambda doc: 1.0 if doc.id in ids else None)
+
+    @staticmethod
+    def match(body, index):
+        field, params = EmbeddedQuery.field_and_params(body, "query")
+        if index.field_type(field) not in [None, "text"]: return EmbeddedQuery.term({field: params["query"]}, index)
+        tokens = analyze(params["query"])
+        required = len(set(tokens)) if str(params.get("operator", "or")).lower() == "and" else 1
+        def candidates():
+            postings = index.postings.get(field, dict())
+            sets = [postings.get(t, set()) for t in set(tokens)]
+            if len(sets) == 0: return set()
+            return set.intersection(*sets) if required > 1 else set.union(*sets)
+        def score(doc):
+            present = set(doc.tokens.get(field, ())) & set(tokens)
+            if len(tokens) == 0 or len(present) < required: return None
+            return index.bm25(doc, field, tokens)
+        return EmbeddedQuery(candidates, score)
+
+    @staticmethod
+    def match_phrase(body, index):
+        field, params = EmbeddedQuery.field_and_params(body, "query")
+        tokens = analyze(params["query"])
+        n = len(tokens)
+        def candidates():
+            postings = index.postings.get(field, dict())
+            sets = [postings.get(t, set()) for t in set(tokens)]
+            return set.intersection(*sets) if len(sets) != 0 else set()
+        def score(doc):
+            doc_tokens = doc.tokens.get(field, [])
+            if n == 0 or not any(doc_tokens[i:i+n] == tokens for i in range(len(doc_tokens) - n + 1)): return None
+            return index.bm25(doc, field, tokens)
+        return EmbeddedQuery(candidates, score)
+
+    @staticmethod
+    def multi_match(body, index):
+        fields = body.get("fields")
+        if fields is None or len(fields) == 0:
+            fields = list(index.postings.keys())  # i.e., index.query.default_field is *
+        fields = [f.split("^")[0] for f in fields]
+        name = "match_phrase" if body.get("type") == "phrase" else "match"
+        params = {k: v for k, v in body.items() if k in ["query", "operator"]}
+        queries = [EmbeddedQuery.compilers[name]({field: dict(params)}, index) for field in fields]
+        return EmbeddedQuery.any_of(queries, best=True)
+
+    @staticmethod
+    def term(body, index):
+        field, params = EmbeddedQuery.field_and_params(body, "value")
+        return EmbeddedQuery.terms({field: [params["value"]]}, index)
+
+    @staticmethod
+    def terms(body, index):
+        field, values = [(k, v) for k, v in body.items() if k != "boost"][0]
+        kind = index.field_type(field)
+        if kind is None: return EmbeddedQuery.match_none(dict(), index)
+        if kind in ["keyword", "flattened"]:
+            expected = set(str(v) for v in values)
+            def candidates():
+                postings = index.postings.get(field, dict())
+                return set().union(*[postings.get(v, set()) for v in expected])
+            return EmbeddedQuery(candidates, lambda doc: 1.0 if expected & doc.exact.get(field, set()) else None)
+        if kind == "text":  # ElasticSearch compares terms to the analyzed tokens of text fields
+            expected = set(str(v) for v in values)
+            return EmbeddedQuery(lambda: set().union(*[index.postings.get(field, dict()).get(v, set()) for v in expected]),
+                                 lambda doc: 1.0 if expected & set(doc.tokens.get(field, ())) else None)
+        coerce = coercion(kind)
+        expected = set(coerce(v) for v in values)
+        return EmbeddedQuery(lambda: None, lambda doc: 1.0 if any(coerce(v) in expected for v in doc.values(field)) else None)
+
+    @staticmethod
+    def range(body, index):
+        field, bounds = list(body.items())[0]
+        kind = index.field_type(field)
+        coerce = coercion(kind)
+        tests = []
+        for op in ["gte", "gt", "lte", "lt"]:
+            if bounds.get(op) is None: continue
+            bound = date_math(bounds[op], round_up=op in ["gt", "lte"]) if kind == "date" else coerce(bounds[op])
+            tests.append((comparisons[op], bound))
+        def score(doc):
+            for value in doc.values(field):
+                try: value = coerce(value)
+                except (TypeError, ValueError): continue
+                if all(compare(value, bound) for compare, bound in tests): return 1.0
+            return None
+        return EmbeddedQuery(lambda: None, score)
+
+    @staticmethod
+    def exists(body, index):
+        field = body["field"]
+        return EmbeddedQuery(lambda: None, lambda doc: 1.0 if len(doc.values(field)) != 0 else None)
+
+    @staticmethod
+    def prefix(body, index):
+        field, params = EmbeddedQuery.field_and_params(body, "value")
+        prefix = str(params["value"])
+        def score(doc):
+            values = doc.tokens.get(field) if index.field_type(field) == "text" else [str(v) for v in doc.values(field)]
+            return 1.0 if any(v.startswith(prefix) for v in (values or [])) else None
+        return EmbeddedQuery(lambda: None, score)
+
+    @staticmethod
+    def geo_distance(body, index):
+        field, point = [(k, v) for k, v in body.items() if k not in ["distance", "distance_type", "validation_method", "boost"]][0]
+        (lat, lng), meters = geo.parse_es_point(point), geo.parse_distance(body["distance"])
+        def score(doc):
+            points = _geo_points(doc.values(field))
+            if len(points) == 0: return None
+            return 1.0 if geo.haversine_m(lat, lng, points[:, 0], points[:, 1]).min() <= meters else None
+        return EmbeddedQuery(lambda: None, score)
+
+    @staticmethod
+    def geo_bounding_box(body, index):
+        field, box = [(k, v) for k, v in body.items() if k not in ["validation_method", "boost"]][0]
+        top_left, bottom_right = geo.parse_es_point(box["top_left"]), geo.parse_es_point(box["bottom_right"])
+        def score(doc):
+            points = _geo_points(doc.values(field))
+            if len(points) == 0: return None
+            return 1.0 if geo.in_bbox(points[:, 0], points[:, 1], top_left, bottom_right).any() else None
+        return EmbeddedQuery(lambda: None, score)
+
+    @staticmethod
+    def constant_score(body, index):
+        inner = EmbeddedQuery.compile(body["filter"], index)
+        boost = float(body.get("boost", 1.0))
+        return EmbeddedQuery(inner.candidates, lambda doc: None if inner.score(doc) is None else boost)
+
+    @staticmethod
+    def bool(body, index):
+        listed = lambda key: body.get(key, []) if isinstance(body.get(key, []), list) else [body[key]]
+        must = [EmbeddedQuery.compile(q, index) for q in listed("must")]
+        filters = [EmbeddedQuery.compile(q, index) for q in listed("filter")]
+        should = [EmbeddedQuery.compile(q, index) for q in listed("should")]
+        must_not = [EmbeddedQuery.compile(q, index) for q in listed("must_not")]
+        minimum = body.get("minimum_should_match", 1 if len(must) + len(filters) == 0 and len(should) != 0 else 0)
+        minimum = int(minimum) if not isinstance(minimum, str) else int(minimum.strip("%")) * len(should) // 100
+        def candidates():
+            sets = [s for s in [q.candidates() for q in must + filters] if s is not None]
+            if len(must) + len(filters) == 0 and minimum > 0 and len(should) != 0:
+                union = [q.candidates() for q in should]
+                if all(s is not None for s in union): sets.append(set().union(*union))
+            return set.intersection(*sets) if len(sets) != 0 else None
+        def score(doc):
+            total = 0.0
+            for q in must:
+                s = q.score(doc)
+                if s is None: return None
+                total += s
+            for q in filters:
+                if q.score(doc) is None: return None
+            for q in must_not:
+                if q.score(doc) is not None: return None
+            matched = 0
+            for q in should:
+                s = q.score(doc)
+                if s is not None: matched, total = matched + 1, total + s
+            if matched < minimum: return None
+            return total if len(must) + len(should) != 0 else 0.0
+        return EmbeddedQuery(candidates, score)
+
+    @staticmethod
+    def any_of(queries, best=False):
+        def candidates():
+            sets = [q.candidates() for q in queries]
+            return None if any(s is None for s in sets) else set().union(*sets)
+        def score(doc):
+            scores = [s for s in [q.score(doc) for q in queries] if s is not None]
+            if len(scores) == 0: return None
+            return max(scores) if best else sum(scores)
+        return EmbeddedQuery(candidates, score)
+
+
+EmbeddedQuery.compilers = dict(match_all=EmbeddedQuery.match_all, match_none=EmbeddedQuery.match_none,
+                               ids=EmbeddedQuery.ids, match=EmbeddedQuery.match, match_phrase=EmbeddedQuery.match_phrase,
+                               multi_match=EmbeddedQuery.multi_match, term=EmbeddedQuery.term, terms=EmbeddedQuery.terms,
+                               range=EmbeddedQuery.range, exists=EmbeddedQuery.exists, prefix=EmbeddedQuery.prefix,
+                               constant_score=EmbeddedQuery.constant_score, bool=EmbeddedQuery.bool,
+                               geo_distance=EmbeddedQuery.geo_distance, geo_bounding_box=EmbeddedQuery.geo_bounding_box)
+
+comparisons = dict(gte=lambda a, b: a >= b, gt=lambda a, b: a > b, lte=lambda a, b: a <= b, lt=lambda a, b: a < b)
+
+
+def as_date(value):
+    if isinstance(value, (int, float)) and not isinstance(value, bool):  # epoch milliseconds
+        return datetime.datetime.fromtimestamp(value / 1000, tz=datetime.timezone.utc)
+    return as_utc_datetime(value)
+
+
+def as_boolean(value): return value if isinstance(value, bool) else str(value).lower() == "true"
+
+
+def _geo_points(values):
+    """The (n, 2) array of (lat, lng) of geo_point values in their string and object forms"""
+    points = [geo.parse_es_point(v) for v in values if isinstance(v, (str, dict))]
+    return numpy.asarray(points, dtype=float).reshape(-1, 2)
+
+
+def coercion(kind):
+    if kind in ["integer", "long", "short", "byte", "float", "double", "half_float", "scaled_float"]: return float
+    if kind == "date": return as_date
+    if kind == "boolean": return as_boolean
+    return lambda value: value if isinstance(value, (int, float)) and not isinstance(value, bool) else str(value)
+
+
+_time_units = dict(nanos=1e-9, micros=1e-6, ms=1e-3, s=1, m=60, h=3600, d=86400)
+
+
+def time_value_s(value):
+    """Parses an ElasticSearch time value as seconds: i.e., the scroll keep-alive 1m, 30s or 500ms."""
+    match = re.match(r"^(\d+(\.\d+)?)(nanos|micros|ms|s|m|h|d)$", str(value).strip())
+    if match is None: raise ValueError(f"failed to parse [{value}] as a time value")
+    return float(match.group(1)) * _time_units[match.group(3)]
+
+
+########################################################################################################################
+# the client
+########################################################################################################################
+
+
+class EmbeddedBadRequest(elasticsearch.exceptions.BadRequestError):
+    """A request the embedded engine cannot parse or run, raised as the 400 BadRequestError of ElasticSearch."""
+
+    def __init__(self, reason, kind="parsing_exception"):
+        super().__init__(message=kind, meta=EmbeddedElasticsearch.meta(400),
+                         body=dict(error=dict(type=kind, reason=reason), status=400))
+
+
+def _bad_requests(method):
+    """Raises the ValueError, TypeError and KeyError of a malformed request as EmbeddedBadRequest, so that callers
+    handle the embedded engine with the ApiError of the Elasticsearch client, i.e., per item in bulk and msearch."""
+    @functools.wraps(method)
+    def wrapped(*args, **kwargs):
+        try: return method(*args, **kwargs)
+        except (ValueError, TypeError, KeyError) as e:
+            raise EmbeddedBadRequest(f"{type(e).__name__}: {e}", kind="illegal_argument_exception") from e
+    return wrapped
+
+
+class _EmbeddedIndicesClient(object):
+    """The .indices namespace of the embedded client."""
+
+    def __init__(self, engine): self.engine = engine
+
+    def create(self, index, body=None, mappings=None, settings=None, aliases=None, **kwargs):
+        body = dict() if body is None else body
+        with self.engine.lock:
+            if index in self.engine._indices:
+                raise self.engine.error(400, "resource_already_exists_exception", f"index [{index}] already exists")
+            if len(self.engine.aliased(index)) != 0:
+                raise self.engine.error(400, "invalid_index_name_exception", f"Invalid index name [{index}], already exists as alias")
+            created = EmbeddedIndex(index, mappings=mappings or body.get("mappings"), settings=settings or body.get("settings"))
+            created.aliases = {alias: dict(props or dict()) for alias, props in (aliases or body.get("aliases") or dict()).items()}
+            self.engine._indices[index] = created
+        return self.engine.response(dict(acknowledged=True, shards_acknowledged=True, index=index))
+
+    def exists(self, index, **kwargs):
+        return self.engine.head(all(len(self.engine.resolve(i, strict=False)) != 0 for i in _names(index)))
+
+    def delete(self, index, **kwargs):
+        with self.engine.lock:
+            for i in self.engine.resolve(index): del self.engine._indices[i.name]
+        return self.engine.response(dict(acknowledged=True))
+
+    def refresh(self, index=None, **kwargs):
+        for i in self.engine.resolve("*" if index is None else index): i.refresh()
+        return self.engine.response(dict(_shards=dict(total=1, successful=1, failed=0)))
+
+    def get_mapping(self, index=None, **kwargs):
+        return self.engine.response({i.name: dict(mappings=i.mappings) for i in self.engine.resolve(index or "*")})
+
+    def put_mapping(self, index, body=None, properties=None, **kwargs):
+        properties = properties or (body or dict()).get("properties", dict())
+        for i in self.engine.resolve(index): i.properties().update(properties)
+        return self.engine.response(dict(acknowledged=True))
+
+    def update_aliases(self, actions=None, body=None, **kwargs):
+        """Applies add, remove and remove_index actions atomically: all of them, or none if any index is missing."""
+        actions = actions if actions is not None else (body or dict()).get("actions", [])
+        with self.engine.lock:
+            steps = []
+            for action in actions:
+                kind, params = list(action.items())[0]
+                names = params.get("indices", [params.get("index")])
+                for name in names: steps.extend((kind, target, params) for target in self.engine.resolve(name))
+            for kind, target, params in steps:
+                if kind == "add": target.aliases[params["alias"]] = {k: v for k, v in params.items() if k == "is_write_index"}
+                elif kind == "remove": target.aliases.pop(params["alias"], None)
+                elif kind == "remove_index": self.engine._indices.pop(target.name, None)
+                else: raise self.engine.error(400, "illegal_argument_exception", f"unknown alias action [{kind}]")
+        return self.engine.response(dict(acknowledged=True))
+
+    def get_alias(self, index=None, name=None, **kwargs):
+        names = None if name is None else _names(name)
+        with self.engine.lock:
+            found = {i.name: dict(aliases={a: p for a, p in i.aliases.items() if names is None or any(fnmatch.fnmatch(a, n) for n in names)})
+                     for i in self.engine.resolve(index or "*")}
+        if names is not None:
+            found = {n: v for n, v in found.items() if len(v["aliases"]) != 0}
+            if len(found) == 0: raise self.engine.error(404, "aliases_not_found_exception", f"alias [{name}] missing")
+        return self.engine.response(found)
+
+    def exists_alias(self, name, index=None, **kwargs):
+        with self.engine.lock: return self.engine.head(all(len(self.engine.aliased(n)) != 0 for n in _names(name)))
+
+    def stats(self, index=None, metric=None, **kwargs):
+        """The docs and store metrics; the store size is that of the json sources, as the engine holds no segments."""
+        indices = dict()
+        for i in self.engine.resolve(index or "*"):
+            with i.lock: n_bytes = sum(len(json.dumps(d["_source"], default=self.engine.serializer.default)) for d in i.docs.values())
+            indices[i.name] = dict(primaries=dict(docs=dict(count=len(i.docs), deleted=0), store=dict(size_in_bytes=n_bytes)))
+        total = lambda metric, key: sum(stats["primaries"][metric][key] for stats in indices.values())
+        primaries = dict(docs=dict(count=total("docs", "count"), deleted=0), store=dict(size_in_bytes=total("store", "size_in_bytes")))
+        return self.engine.response(dict(_all=dict(primaries=primaries, total=primaries), indices=indices))
+
+    def close(self, index, **kwargs): return self.engine.response(dict(acknowledged=True))
+
+    def open(self, index, **kwargs): return self.engine.response(dict(acknowledged=True))
+
+    def flush(self, index=None, **kwargs):
+        self.engine.flush()
+        return self.engine.response(dict(_shards=dict(total=1, successful=1, failed=0)))
+
+
+class _EmbeddedTasks(object):
+    """The .tasks namespace of the embedded client; tasks are the _reindex requests run without waiting."""
+
+    def __init__(self, engine): self.engine = engine
+
+    def get(self, task_id, **kwargs):
+        with self.engine.lock: task = self.engine.running.get(task_id)
+        if task is None: raise self.engine.error(404, "resource_not_found_exception", f"task [{task_id}] isn't running and hasn't stored its results")
+        body = dict(completed=task["completed"], task=dict(node="embedded", id=int(task_id.split(":")[1]), action=task["action"],
+                                                            status=dict(task["status"]), running_time_in_nanos=int((time.time() - task["start_s"]) * 1e9)))
+        if task["completed"]: body["response" if task.get("error") is None else "error"] = task.get("response") or task.get("error")
+        return self.engine.response(body)
+
+
+class _EmbeddedCluster(object):
+
+    def __init__(self, engine): self.engine = engine
+
+    def health(self, **kwargs):
+        return self.engine.response(dict(cluster_name="embedded", status="green", number_of_nodes=1,
+                                          active_primary_shards=len(self.engine._indices)))
+
+
+class _EmbeddedTelemetry(object):
+    """No-op stand-in for the client telemetry the elasticsearch.helpers expect."""
+
+    @contextlib.contextmanager
+    def helpers_span(self, name): yield None
+
+    @contextlib.contextmanager
+    def use_span(self, span): yield None
+
+
+class _EmbeddedTransport(object):
+
+    class serializers(object):
+        @staticmethod
+        def get_serializer(mimetype): return JsonSerializer()
+
+
+class EmbeddedElasticsearch(object):
+    """In-process, Elasticsearch-compatible engine implementing the client surface SwiftData and its helpers use."""
+
+    version = "8.15.1-embedded"
+
+    def __init__(self, directory=None, refresh_interval_s=1.0):
+        self.directory = directory
+        self.refresh_interval_s = refresh_interval_s
+        self._indices = dict()      # map from name => EmbeddedIndex
+        self.scrolls = dict()       # map from scroll_id => remaining hits and page size
+        self.repositories = dict()  # map from snapshot repository => location
+        self.running = dict()       # map from task id => the status and response of a _reindex task
+        self.lock = threading.RLock()
+        self.serializer = JsonSerializer()
+        self._otel = _EmbeddedTelemetry()
+        self.transport = _EmbeddedTransport()
+        self.cluster = _EmbeddedCluster(self)
+        self.indices = _EmbeddedIndicesClient(self)  # the namespace client, i.e., es.indices.refresh as for Elasticsearch
+        self.tasks = _EmbeddedTasks(self)
+        self.load()
+
+    ####################################################################################################################
+    # responses and errors
+    ####################################################################################################################
+
+    @staticmethod
+    def meta(status=200):
+        return ApiResponseMeta(status=status, http_version="1.1", headers=HttpHeaders(), duration=0.0,
+                               node=NodeConfig("http", "embedded", 0))
+
+    def response(self, body, status=200): return ObjectApiResponse(body=body, meta=self.meta(status))
+
+    def head(self, exists): return HeadApiResponse(meta=self.meta(200 if exists else 404))
+
+    def error(self, status, kind, reason):
+        body = dict(error=dict(type=kind, reason=reason), status=status)
+        cls = {400: elasticsearch.exceptions.BadRequestError, 404: elasticsearch.exceptions.NotFoundError,
+               409: elasticsearch.exceptions.ConflictError}.get(status, elasticsearch.exceptions.ApiError)
+        return cls(message=kind, meta=self.meta(status), body=body)
+
+    def options(self, **kwargs): return self
+
+    ####################################################################################################################
+    # indices and persistence
+    ####################################################################################################################
+
+    def resolve(self, index, strict=True):
+        """Returns the EmbeddedIndex objects of a name, comma separated names, list of names or wildcard patterns."""
+        found = []
+        with self.lock:
+            for name in _names(index):
+                if any(c in name for c in "*?"):
+                    found.extend(i for n, i in self._indices.items() if fnmatch.fnmatch(n, name) and i not in found)
+                elif name in self._indices:
+                    if self._indices[name] not in found: found.append(self._indices[name])
+                elif len(self.aliased(name)) != 0: found.extend(i for i in self.aliased(name) if i not in found)
+                elif strict: raise self.error(404, "index_not_found_exception", f"no such index [{name}]")
+        return found
+
+    def aliased(self, alias):
+        """Returns the EmbeddedIndex objects of an alias."""
+        with self.lock: return [i for i in self._indices.values() if alias in i.aliases]
+
+    def writable(self, index):
+        """Returns the EmbeddedIndex to write into, the write index of an alias; auto-creates it with dynamic mapping
+        as ElasticSearch does."""
+        with self.lock:
+            aliased = self.aliased(index) if index not in self._indices else []
+            if len(aliased) != 0:
+                writes = [i for i in aliased if i.aliases[index].get("is_write_index", len(aliased) == 1)]
+                if len(writes) != 1: raise self.error(400, "illegal_argument_exception", f"no write index is defined for alias [{index}]")
+                return writes[0]
+            if index not in self._indices: self._indices[index] = EmbeddedIndex(index)
+            return self._indices[index]
+
+    def load(self):
+        if self.directory is None or not os.path.exists(self.directory): return
+        for filename in sorted(os.listdir(self.directory)):
+            if not filename.endswith(".json"): continue
+            with open(os.path.join(self.directory, filename), "r") as f: index = EmbeddedIndex.from_dict(json.load(f))
+            self._indices[index.name] = index
+        logger.info(f"embedded elasticsearch loaded {len(self._indices)} indices from {self.directory}")
+
+    def flush(self):
+        """Writes all indices to the engine directory, if any; called at SwiftDataBackend.stop()."""
+        if self.directory is None: return
+        os.makedirs(self.directory, exist_ok=True)
+        with self.lock: indices = list(self._indices.values())
+        for index in indices: self.__write_index(index, self.directory)
+        existing = {f"{i.name}.json" for i in indices}
+        for filename in os.listdir(self.directory):
+            if filename.endswith(".json") and filename not in existing: os.remove(os.path.join(self.directory, filename))
+
+    def __write_index(self, index, directory):
+        with index.lock: data = json.dumps(index.as_dict(), default=self.serializer.default)
+        filename = os.path.join(directory, f"{index.name}.json")
+        with open(filename + ".tmp", "w") as f: f.write(data)
+        os.replace(filename + ".tmp", filename)
+
+    ####################################################################################################################
+    # documents
+    ####################################################################################################################
+
+    def ping(self, **kwargs): return True
+
+    def info(self, **kwargs):
+        return self.response(dict(name="embedded", cluster_name="embedded", version=dict(number=self.version)))
+
+    @_bad_requests
+    def index(self, index, body=None, document=None, id=None, op_type=None, refresh=None, **kwargs):
+        source = _jsonable(document if document is not None else body, self.serializer)
+        target = self.writable(index)
+        id = uuid.uuid4().hex if id is None else str(id)
+        with target.lock:
+            if op_type == "create" and id in target.docs:
+                raise self.error(409, "version_conflict_engine_exception", f"[{id}]: version conflict, document already exists")
+            version = target.write(id, source)
+        if refresh not in [None, False, "false"]: target.refresh()
+        return self.response(dict(_index=target.name, _id=id, _version=version, result="created" if version == 1 else "updated",
+                                  _seq_no=target.seq_no, _primary_term=1, _shards=dict(total=1, successful=1, failed=0)),
+                             status=201 if version == 1 else 200)
+
+    def create(self, index, id, body=None, document=None, **kwargs):
+        return self.index(index, body=body, document=document, id=id, op_type="create", **kwargs)
+
+    def get(self, index, id, _source=None, **kwargs):
+        id = str(id)
+        for target in self.resolve(index):
+            with target.lock: doc = target.docs.get(id)
+            if doc is not None:
+                return self.response(dict(_index=target.name, _id=id, _version=doc["_version"], _seq_no=doc["_seq_no"],
+                                          _primary_term=1, found=True, _source=_source_filter(doc["_source"], _source)))
+        raise self.error(404, "not_found", f"document [{id}] not found in [{index}]")
+
+    def exists(self, index, id, **kwargs):
+        return self.head(any(str(id) in target.docs for target in self.resolve(index, strict=False)))
+
+    def mget(self, index=None, body=None, docs=None, ids=None, **kwargs):
+        requested = docs if docs is not None else (body or dict()).get("docs")
+        if requested is None: requested = [dict(_id=id) for id in (ids if ids is not None else (body or dict()).get("ids", []))]
+        results = []
+        for item in requested:
+            name = item.get("_index", index)
+            try: results.append(self.get(name, item["_id"]).body)
+            except elasticsearch.exceptions.NotFoundError: results.append(dict(_index=name, _id=str(item["_id"]), found=False))
+        return self.response(dict(docs=results))
+
+    def delete(self, index, id, refresh=None, **kwargs):
+        targets = self.resolve(index, strict=False)
+        removed = any([target.remove(str(id)) for target in targets])
+        if not removed: raise self.error(404, "not_found", f"document [{id}] not found in [{index}]")
+        if refresh not in [None, False, "false"]: [target.refresh() for target in targets]
+        return self.response(dict(_index=index, _id=str(id), result="deleted", _shards=dict(total=1, successful=1, failed=0)))
+
+    @_bad_requests
+    def update(self, index, id, body=None, doc=None, doc_as_upsert=False, upsert=None, refresh=None, **kwargs):
+        body = dict() if body is None else body
+        doc = doc if doc is not None else body.get("doc")
+        upsert = upsert if upsert is not None else body.get("upsert")
+        target = self.writable(index)
+        with target.lock:
+            existing = target.docs.get(str(id))
+            if existing is None:
+                if not (doc_as_upsert or body.get("doc_as_upsert")) and upsert is None:
+                    raise self.error(404, "document_missing_exception", f"[{id}]: document missing")
+                source = _jsonable(upsert if upsert is not None else doc, self.serializer)
+            else: source = _merge(existing["_source"], _jsonable(doc or dict(), self.serializer))
+            version = target.write(str(id), source)
+        if refresh not in [None, False, "false"]: target.refresh()
+        return self.response(dict(_index=target.name, _id=str(id), _version=version, result="created" if version == 1 else "updated",
+                                  _seq_no=target.seq_no, _primary_term=1))
+
+    @_bad_requests
+    def bulk(self, operations=None, body=None, index=None, refresh=None, **kwargs):
+        lines = _bulk_lines(operations if operations is not None else body, self.serializer)
+        items, errors, touched, s = [], False, set(), time.time()
+        i = 0
+        while i < len(lines):
+            action = lines[i]
+            op, meta = list(action.items())[0]
+            source = lines[i + 1] if op != "delete" else None
+            i += 1 if op == "delete" else 2
+            name, id = meta.get("_index", index), meta.get("_id")
+            try:
+                if op in ["index", "create"]: r = self.index(name, document=source, id=id, op_type=op if op == "create" else None)
+                elif op == "delete": r = self.delete(name, id)
+                elif op == "update": r = self.update(name, id, body=source)
+                else: raise self.error(400, "illegal_argument_exception", f"malformed action/metadata line [{op}]")
+                touched.add(name)
+                items.append({op: dict(_index=name, _id=r.body["_id"], status=r.meta.status, result=r.body["result"],
+                                       _version=r.body.get("_version"), _seq_no=r.body.get("_seq_no"), _primary_term=1)})
+            except elasticsearch.exceptions.ApiError as e:
+                errors = True
+                items.append({op: dict(_index=name, _id=id, status=e.meta.status, error=e.body["error"])})
+        if refresh not in [None, False, "false"]: [target.refresh() for name in touched for target in self.resolve(name)]
+        return self.response(dict(took=int((time.time() - s) * 1000), errors=errors, items=items))
+
+    @_bad_requests
+    def reindex(self, source=None, dest=None, body=None, conflicts=None, slices=None, wait_for_completion=True,
+                refresh=None, max_docs=None, **kwargs):
+        """Copies the documents of source (matching its query, if any) into dest; op_type create with conflicts=proceed
+        counts existing documents as version conflicts. wait_for_completion=False runs it as a task (see tasks.get)."""
+        body = dict() if body is None else body
+        source, dest = source or body["source"], dest or body["dest"]
+        conflicts = conflicts or body.get("conflicts", "abort")
+        n_slices = 1 if slices in [None, "auto"] else int(slices)
+        with self.lock:
+            task_id = f"embedded:{len(self.running) + 1}"
+            task = self.running[task_id] = dict(action="indices:data/write/reindex", start_s=time.time(), completed=False,
+                                                status=dict(total=0, created=0, updated=0, deleted=0, batches=0, version_conflicts=0,
+                                                            noops=0, slices=[dict(slice_id=i) for i in range(n_slices)] if n_slices > 1 else []))
+        def run():
+            try: task["response"] = self.__reindex(source, dest, conflicts, task["status"], refresh, max_docs)
+            except elasticsearch.exceptions.ApiError as e: task["error"] = e.body["error"]
+            task["response"] = task.get("response") and task["response"] | dict(took=int((time.time() - task["start_s"]) * 1000))
+            task["completed"] = True
+        if not str(wait_for_completion).lower() == "false":
+            run()
+            if task.get("error") is not None: raise self.error(400, task["error"]["type"], task["error"]["reason"])
+            return self.response(task["response"])
+        threading.Thread(target=run, name=f"reindex={task_id}", daemon=True).start()
+        return self.response(dict(task=task_id))
+
+    def __reindex(self, source, dest, conflicts, status, refresh, max_docs, batch_size=1000):
+        hits, total, _ = self.__search(source["index"], dict(query=source.get("query")))
+        hits = hits if max_docs is None else hits[:int(max_docs)]
+        status["total"] = len(hits)
+        op_type, failures = dest.get("op_type", "index"), []
+        for i in range(0, len(hits), int(source.get("size", batch_size))):
+            for hit in hits[i:i + int(source.get("size", batch_size))]:
+                try:
+                    r = self.index(dest["index"], document=hit["_source"], id=hit["_id"], op_type="create" if op_type == "create" else None)
+                    status["created" if r.body["result"] == "created" else "updated"] += 1
+                except elasticsearch.exceptions.ConflictError as e:
+                    status["version_conflicts"] += 1
+                    if conflicts != "proceed":
+                        failures.append(dict(index=dest["index"], id=hit["_id"], cause=e.body["error"], status=409))
+                        break
+            status["batches"] += 1
+            if len(failures) != 0: break
+        if refresh not in [None, False, "false"]: self.indices.refresh(index=dest["index"])
+        return dict(timed_out=False, failures=failures, throttled_millis=0, requests_per_second=-1.0,
+                    retries=dict(bulk=0, search=0), **{k: v for k, v in status.items() if k != "slices"})
+
+    ####################################################################################################################
+    # search
+    ####################################################################################################################
+
+    @_bad_requests
+    def search(self, index=None, body=None, scroll=None, filter_path=None, **kwargs):
+        request = dict() if body is None else dict(body)
+        request.update({k.rstrip("_"): v for k, v in kwargs.items() if v is not None})  # i.e., from_ => from
+        s = time.time()
+        hits, total, max_score = self.__search(index, request)
+        aggregations = self.__aggregate(request.get("aggs", request.get("aggregations")), hits)
+        offset, size = int(request.get("from", 0)), int(request.get("size", 10))
+        page = hits[offset:offset + size]
+        result = dict(took=0, timed_out=False, _shards=dict(total=1, successful=1, skipped=0, failed=0),
+                      hits=dict(total=dict(value=total, relation="eq"), max_score=max_score, hits=page))
+        if request.get("profile"):  # NOTE: the embedded profile is the time of the whole query, not per clause
+            query = request.get("query") or dict(match_all=dict())
+            searches = [dict(query=[dict(type=list(query.keys())[0], description=json.dumps(query),
+                                         time_in_nanos=int((time.time() - s) * 1e9), children=[])])]
+            result["profile"] = dict(shards=[dict(id=f"[embedded][{index}][0]", searches=searches)])
+        if request.get("suggest"): result["suggest"] = self.__suggest(index, request["suggest"])
+        if aggregations is not None: result["aggregations"] = aggregations
+        if scroll is not None:
+            scroll_id, now = uuid.uuid4().hex, time.time()
+            with self.lock:
+                for expired in [id for id, state in self.scrolls.items() if state["expires_s"] < now]: del self.scrolls[expired]
+                self.scrolls[scroll_id] = dict(hits=hits[offset + size:], size=size, total=total, expires_s=now + time_value_s(scroll))
+            result["_scroll_id"] = scroll_id
+        result["took"] = int((time.time() - s) * 1000)
+        return self.response(_filter_path(result, filter_path))
+
+    @_bad_requests
+    def scroll(self, scroll_id=None, body=None, scroll=None, filter_path=None, **kwargs):
+        scroll_id = scroll_id if scroll_id is not None else (body or dict()).get("scroll_id")
+        scroll = scroll if scroll is not None else (body or dict()).get("scroll")
+        with self.lock:
+            state = self.scrolls.get(scroll_id)
+            if state is not None and state["expires_s"] < time.time():
+                del self.scrolls[scroll_id]
+                state = None
+            if state is not None and scroll is not None: state["expires_s"] = time.time() + time_value_s(scroll)  # keep-alive
+        if state is None: raise self.error(404, "search_context_missing_exception", f"No search context found for id [{scroll_id}]")
+        page, state["hits"] = state["hits"][:state["size"]], state["hits"][state["size"]:]
+        result = dict(_scroll_id=scroll_id, took=0, timed_out=False, _shards=dict(total=1, successful=1, skipped=0, failed=0),
+                      hits=dict(total=dict(value=state["total"], relation="eq"), max_score=None, hits=page))
+        return self.response(_filter_path(result, filter_path))
+
+    @_bad_requests
+    def msearch(self, searches=None, body=None, index=None, **kwargs):
+        """Runs header and body pairs of searches; failing searches are reported per response, as ElasticSearch does."""
+        lines = _bulk_lines(searches if searches is not None else body, self.serializer)
+        s, responses = time.time(), []
+        for header, request in zip(lines[0::2], lines[1::2]):
+            try: responses.append(self.search(index=header.get("index", index), body=request).body | dict(status=200))
+            except elasticsearch.exceptions.ApiError as e: responses.append(dict(error=e.body["error"], status=e.meta.status))
+        return self.response(dict(took=int((time.time() - s) * 1000), responses=responses))
+
+    def clear_scroll(self, scroll_id=None, body=None, **kwargs):
+        scroll_id = scroll_id if scroll_id is not None else (body or dict()).get("scroll_id")
+        ids = scroll_id if isinstance(scroll_id, list) else [scroll_id]
+        with self.lock: n = sum(1 for id in ids if self.scrolls.pop(id, None) is not None)
+        return self.response(dict(succeeded=True, num_freed=n))
+
+    @_bad_requests
+    def count(self, index=None, body=None, query=None, **kwargs):
+        query = query if query is not None else (body or dict()).get("query")
+        _, total, _ = self.__search(index, dict(query=query, _source=False), collect=False)
+        return self.response(dict(count=total, _shards=dict(total=1, successful=1, skipped=0, failed=0)))
+
+    def __search(self, index, request, collect=True):
+        """Returns (hits sorted, total, max_score) of the request over the refreshed view of the resolved indices."""
+        hits, max_score = [], None
+        for target in self.resolve("*" if index is None else index):
+            target.refresh_if_due(self.refresh_interval_s)
+            with target.lock:
+                knn = self.__knn(target, request["knn"]) if request.get("knn") else None
+                if knn is not None and request.get("query") is None: query = EmbeddedQuery(lambda: set(knn), lambda doc: 0.0)
+                else: query = EmbeddedQuery.compile(request.get("query"), target)
+                candidates = query.candidates()
+                if knn is not None and candidates is not None: candidates = set(candidates) | set(knn)
+                docs = target.searchable.values() if candidates is None else [target.searchable[id] for id in candidates if id in target.searchable]
+                for doc in docs:
+                    score = query.score(doc)
+                    if knn is not None and doc.id in knn: score = (score or 0.0) + knn[doc.id]  # as ElasticSearch sums
+                    if score is None: continue
+                    max_score = score if max_score is None else max(max_score, score)
+                    hits.append((target, doc, score))
+        total = len(hits)
+        if not collect: return None, total, max_score
+        hits = _sorted_hits(hits, request.get("sort"))
+        source = request.get("_source")
+        return [_Hit(_index=target.name, _id=doc.id, _score=score, _source=_source_filter(doc.source, source), doc=doc)
+                for target, doc, score in hits], total, max_score
+
+    def __aggregate(self, aggs, hits):
+        """The metric aggregations (stats, min, max, avg, sum, value_count), terms and geohash_grid over the documents of
+        hits; geohash_grid counts documents per cell, so its values are per document."""
+        if not aggs: return None
+        results = dict()
+        for name, spec in aggs.items():
+            kind = [k for k in spec if k not in ["aggs", "aggregations", "meta"]][0]
+            body = spec[kind]
+            if kind not in _aggregations: raise self.error(400, "illegal_argument_exception", f"aggregation [{kind}] is not supported by the embedded engine")
+            values = [hit.doc.values(hit.doc.index.source_field(body["field"])) for hit in hits]
+            if kind not in _per_document: values = [v for doc_values in values for v in doc_values]
+            results[name] = _aggregations[kind](values, body)
+        return results
+
+    def __knn(self, target, knn):
+        """Returns dict(id=score) of the exact k nearest neighbors (by cosine, scored (1 + cosine) / 2) among the
+        documents matching the knn filter; the filter applies before the neighbors are chosen, as in ElasticSearch."""
+        # NOTE: exact (brute force) rather than approximate (HNSW); num_candidates has no effect on the embedded engine
+        filter = knn.get("filter")
+        if isinstance(filter, list): filter = dict(bool=dict(filter=filter))
+        query = EmbeddedQuery.compile(filter, target)
+        candidates = query.candidates()
+        docs = target.searchable.values() if candidates is None else [target.searchable[id] for id in candidates if id in target.searchable]
+        q = [float(f) for f in knn["query_vector"]]
+        if (target.field_mapping(knn["field"]) or dict()).get("element_type") == "byte":  # as ElasticSearch validates
+            for i, f in enumerate(q):
+                if f != int(f) or not -128 <= f <= 127:
+                    raise EmbeddedBadRequest(f"element_type [byte] vectors only support non-decimal values between -128 and"
+                                             f" 127 but found [{f}] at dim [{i}]", kind="illegal_argument_exception")
+        q_norm = math.sqrt(sum(f * f for f in q))
+        scores = []
+        for doc in docs:
+            if query.score(doc) is None: continue
+            v = doc.values(knn["field"])
+            if len(v) != len(q): continue
+            norm = math.sqrt(sum(float(f) * float(f) for f in v)) * q_norm
+            if norm == 0: continue
+            scores.append((doc.id, (1 + sum(a * float(b) for a, b in zip(q, v)) / norm) / 2 * float(knn.get("boost", 1.0))))
+        return dict(sorted(scores, key=lambda item: -item[1])[:int(knn.get("k", 10))])
+
+    def __suggest(self, index, suggesters):
+        """The completion suggester: distinct whole values of the field of a completion multi-field, by prefix."""
+        # NOTE: every value has the default weight of 1, so options are ordered by text as ElasticSearch orders ties
+        results = dict()
+        for name, spec in suggesters.items():
+            if not isinstance(spec, dict) or "completion" not in spec: continue
+            prefix, completion = str(spec.get("prefix", spec.get("text", ""))).lower(), spec["completion"]
+            options, seen = [], set()
+            for target in self.resolve("*" if index is None else index):
+                target.refresh_if_due(self.refresh_interval_s)
+                if target.field_type(completion["field"]) != "completion":
+                    raise self.error(400, "illegal_argument_exception", f"Field [{completion['field']}] is not a completion suggest field")
+                with target.lock: docs = list(target.searchable.values())
+                for doc in docs:
+                    for value in doc.values(completion["field"]):
+                        text = str(value)
+                        if not text.lower().startswith(prefix): continue
+                        if completion.get("skip_duplicates") and text in seen: continue
+                        seen.add(text)
+                        options.append(dict(text=text, _index=target.name, _id=doc.id, _score=1.0))
+            options = sorted(options, key=lambda option: option["text"])[:int(completion.get("size", 5))]
+            results[name] = [dict(text=prefix, offset=0, length=len(prefix), options=options)]
+        return results
+
+    ####################################################################################################################
+    # rest api: the subset of paths used by ElasticSearchClient.perform_request
+    ####################################################################################################################
+
+    @_bad_requests
+    def perform_request(self, method, path, headers=None, body=None, params=None, **kwargs):
+        parsed = urllib.parse.urlparse(path)
+        query = {k: v[-1] for k, v in urllib.parse.parse_qs(parsed.query).items()} | (params or dict())
+        parts = [urllib.parse.unquote(p) for p in parsed.path.strip("/").split("/") if p != ""]
+        if isinstance(body, (str, bytes)): body = json.loads(body)
+        route = (method.upper(), *(p if p.startswith("_") else "{}" for p in parts))
+        values = [p for p in parts if not p.startswith("_")]
+        if route == ("HEAD", "{}"): return self.indices.exists(values[0])
+        if route == ("PUT", "{}"): return self.indices.create(values[0], body=body)
+        if route == ("DELETE", "{}"): return self.indices.delete(values[0])
+        if route in [("POST", "{}", "_refresh"), ("POST", "_refresh")]: return self.indices.refresh(values[0] if values else None)
+        if route in [("POST", "{}", "_close"), ("POST", "_all", "_close")]: return self.__close(values[0] if values else "_all")
+        if route == ("POST", "{}", "_open"): return self.response(dict(acknowledged=True))
+        if route in [("GET", "{}", "_search"), ("POST", "{}", "_search")]: return self.search(values[0], body=body)
+        if route in [("GET", "{}", "_count"), ("POST", "{}", "_count")]: return self.count(values[0], body=body)
+        if route == ("GET", "{}", "_recovery"): return self.__recovery(values[0])
+        if route == ("GET", "_cat", "{}") and values == ["indices"]: return self.__cat_indices()
+        if route == ("GET", "_resolve", "{}", "{}") and values[0] == "index": return self.__resolve_index(values[1])
+        if route == ("GET", "_cluster", "{}") and values == ["health"]: return self.cluster.health()
+        if len(parts) != 0 and parts[0] == "_snapshot": return self.__snapshot(method.upper(), parts[1:], query, body)
+        raise self.error(400, "illegal_argument_exception", f"embedded engine does not support {method} {path}")
+
+    def __close(self, index):
+        """Acknowledges the _close of named indices; as ElasticSearch 8 (action.destructive_requires_name=true), rejects
+        wildcards and _all."""
+        if any(name == "_all" or any(c in name for c in "*?") for name in _names(index)):
+            raise self.error(400, "illegal_argument_exception", "Wildcard expressions or all indices are not allowed")
+        return self.response(dict(acknowledged=True))
+
+    def __resolve_index(self, index):
+        """The _resolve/index api: the indices and aliases matching names or wildcard patterns; all are open."""
+        patterns = _names(index)
+        matches = lambda name: any(fnmatch.fnmatch(name, pattern) for pattern in patterns)
+        with self.lock: indices = list(self._indices.values())
+        aliases = sorted({alias for i in indices for alias in i.aliases if matches(alias)})
+        return self.response(dict(
+            indices=[dict(name=i.name, aliases=sorted(i.aliases), attributes=["open"]) for i in indices if matches(i.name)],
+            aliases=[dict(name=alias, indices=[i.name for i in indices if alias in i.aliases]) for alias in aliases],
+            data_streams=[]))
+
+    def __cat_indices(self):
+        with self.lock: indices = list(self._indices.values())
+        lines = [f"green open {i.name} {i.uuid} 1 0 {len(i.docs)} 0 0b 0b" for i in indices]
+        return "\n".join(lines) + "\n"
+
+    def __recovery(self, index):
+        """The _recovery api of indices restored from snapshots; restores of the embedded engine are synchronous."""
+        size = lambda n: dict(total_in_bytes=n, recovered_in_bytes=n)
+        return self.response({i.name: dict(shards=[dict(type="SNAPSHOT", stage="DONE", index=dict(size=size(i.restored_bytes)))])
+                              for i in self.resolve(index, strict=False) if i.restored_bytes is not None})
+
+    def __snapshot(self, method, parts, query, body):
+        """The fs snapshot repository api: register, verify, save, info, list and restore; snapshots are json files."""
+        repository = parts[0].lower() if len(parts) != 0 else None
+        if len(parts) == 1 and method == "PUT":
+            self.repositories[repository] = body["settings"]["location"]
+            return self.response(dict(acknowledged=True))
+        if repository not in self.repositories:
+            raise self.error(404, "repository_missing_exception", f"[{repository}] missing")
+        location = self.repositories[repository]
+        if parts[1:] == ["_verify"]: return self.response(dict(nodes=dict(embedded=dict(name="embedded"))))
+        if parts[1:] == ["_current"]: return self.response(dict(snapshots=[], total=0, remaining=0))  # saves are synchronous
+        snapshot = parts[1] if len(parts) > 1 else None
+        if method == "PUT" and len(parts) == 2: return self.__snapshot_save(location, snapshot, body)
+        if method == "POST" and parts[2:] == ["_restore"]: return self.__snapshot_restore(location, snapshot, body)
+        if method == "GET" and len(parts) == 2:
+            snapshots = [s for s in _snapshots_in(location) if fnmatch.fnmatch(s["snapshot"], snapshot)]
+            if len(snapshots) == 0 and "*" not in snapshot:
+                raise self.error(404, "snapshot_missing_exception", f"[{repository}:{snapshot}] is missing")
+            reverse = query.get("order", "asc") == "desc"
+            snapshots = sorted(snapshots, key=lambda s: s["start_time_in_millis"], reverse=reverse)
+            if "size" in query: snapshots = snapshots[:int(query["size"])]
+            return self.response(dict(snapshots=snapshots, total=len(snapshots), remaining=0))
+        if method == "DELETE" and len(parts) == 2:
+            for name in _names(snapshot): shutil.rmtree(os.path.join(location, name), ignore_errors=True)
+            return self.response(dict(acknowledged=True))
+        raise self.error(400, "illegal_argument_exception", f"embedded engine does not support {method} _snapshot/{'/'.join(parts)}")
+
+    def __snapshot_save(self, location, snapshot, body):
+        s = time.time()
+        indices = self.resolve((body or dict()).get("indices", "*"))
+        directory = os.path.join(location, snapshot)
+        os.makedirs(directory, exist_ok=True)
+        for index in indices: self.__write_index(index, directory)
+        info = dict(snapshot=snapshot, uuid=uuid.uuid4().hex, indices=[i.name for i in indices], state="SUCCESS",
+                    start_time_in_millis=int(s * 1000), end_time_in_millis=int(time.time() * 1000),
+                    start_time=datetime.datetime.fromtimestamp(s, tz=datetime.timezone.utc).isoformat())
+        with open(os.path.join(directory, "_snapshot.json"), "w") as f: json.dump(info, f)
+        return self.response(dict(accepted=True, snapshot=info))
+
+    def __snapshot_restore(self, location, snapshot, body):
+        directory = os.path.join(location, snapshot)
+        if not os.path.exists(directory): raise self.error(404, "snapshot_missing_exception", f"[{snapshot}] is missing")
+        patterns = _names((body or dict()).get("indices", "*"))
+        restored = []
+        for filename in sorted(os.listdir(directory)):
+            if filename.startswith("_") or not filename.endswith(".json"): continue
+            name = filename[:-len(".json")]
+            if not any(fnmatch.fnmatch(name, p) for p in patterns): continue
+            with open(os.path.join(directory, filename), "r") as f: index = EmbeddedIndex.from_dict(json.load(f))
+            index.restored_bytes = os.path.getsize(os.path.join(directory, filename))
+            with self.lock: self._indices[name] = index
+            restored.append(name)
+        return self.response(dict(accepted=True, snapshot=dict(snapshot=snapshot, indices=restored)))
+
+
+class _Hit(dict):
+    """A search hit as ElasticSearch returns it; holds its EmbeddedDoc (not serialized) for aggregations."""
+
+    def __init__(self, doc=None, **hit):
+        super().__init__(**hit)
+        self.doc = doc
+
+
+def _geohash_grid(values, body):
+    counts, precision = dict(), int(body.get("precision", 5))
+    for doc_values in values:
+        for key in set(geo.geohash(lat, lng, precision) for lat, lng in _geo_points(doc_values)): counts[key] = counts.get(key, 0) + 1
+    buckets = sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:int(body.get("size", 10000))]
+    return dict(buckets=[dict(key=key, doc_count=n) for key, n in buckets])
+
+
+def _stats(values, body):
+    numbers = [float(v) for v in values if not isinstance(v, (dict, list))]
+    if len(numbers) == 0: return dict(count=0, min=None, max=None, avg=None, sum=0.0)
+    return dict(count=len(numbers), min=min(numbers), max=max(numbers), avg=sum(numbers) / len(numbers), sum=sum(numbers))
+
+
+def _terms(values, body):
+    counts = dict()
+    for v in values: counts[v] = counts.get(v, 0) + 1
+    buckets = sorted(counts.items(), key=lambda item: (-item[1], str(item[0])))[:int(body.get("size", 10))]
+    return dict(doc_count_error_upper_bound=0, sum_other_doc_count=sum(counts.values()) - sum(n for _, n in buckets),
+                buckets=[dict(key=key, doc_count=n) for key, n in buckets])
+
+
+_aggregations = dict(stats=_stats, terms=_terms,
+                     min=lambda values, body: dict(value=_stats(values, body)["min"]),
+                     max=lambda values, body: dict(value=_stats(values, body)["max"]),
+                     avg=lambda values, body: dict(value=_stats(values, body)["avg"]),
+                     sum=lambda values, body: dict(value=_stats(values, body)["sum"]),
+                     value_count=lambda values, body: dict(value=len(values)), geohash_grid=_geohash_grid)
+_per_document = ["geohash_grid"]
+
+
+def _names(index):
+    if isinstance(index, (list, tuple)): return [n for i in index for n in _names(i)]
+    return [n.strip() for n in str(index).split(",") if n.strip() != ""]
+
+
+def _jsonable(source, serializer):
+    """Round trips a document through the ElasticSearch json serializer, i.e., datetimes become isoformat strings."""
+    return json.loads(serializer.dumps(source))
+
+
+def _merge(existing, doc):
+    merged = dict(existing)
+    for key, value in doc.items():
+        merged[key] = _merge(merged[key], value) if isinstance(value, dict) and isinstance(merged.get(key), dict) else value
+    return merged
+
+
+def _bulk_lines(operations, serializer):
+    if isinstance(operations, (str, bytes)): operations = operations.splitlines() if isinstance(operations, str) else operations.decode().splitlines()
+    lines = []
+    for line in operations:
+        if isinstance(line, bytes): line = line.decode()
+        if isinstance(line, str):
+            if line.strip() == "": continue
+            line = json.loads(line)
+        lines.append(_jsonable(line, serializer))
+    return lines
+
+
+def _source_filter(source, includes):
+    if includes is None or includes is True: return source
+    if includes is False or (isinstance(includes, list) and len(includes) == 0): return dict()
+    if isinstance(includes, dict): includes = includes.get("includes", includes.get("include", []))
+    if isinstance(includes, str): includes = [includes]
+    return {k: v for k, v in source.items() if any(fnmatch.fnmatch(k, pattern) for pattern in includes)}
+
+
+def _sorted_hits(hits, sort):
+    if sort is None: return sorted(hits, key=lambda h: -h[2])
+    keys = []
+    for item in (sort if isinstance(sort, list) else [sort]):
+        if isinstance(item, str): field, order = (item.split(":") + ["asc" if item != "_score" else "desc"])[:2]
+        else:
+            field, order = list(item.items())[0]
+            if isinstance(order, dict) and field == "_geo_distance": order = dict(order)
+            elif isinstance(order, dict): order = order.get("order", "asc")
+        keys.append((field, order))
+    for field, order in reversed(keys):  # stable sorts from the least significant key
+        reverse = order == "desc"
+        if field == "_score": hits = sorted(hits, key=lambda h: h[2], reverse=reverse)
+        elif field == "_doc": continue
+        elif field == "_geo_distance": hits = _geo_distance_sorted(hits, order)
+        else:
+            kind = hits[0][0].field_type(field) if len(hits) != 0 else None
+            coerce = coercion(kind)
+            present = [h for h in hits if len(h[1].values(field)) != 0]
+            missing = [h for h in hits if len(h[1].values(field)) == 0]
+            pick = max if reverse else min
+            present = sorted(present, key=lambda h: pick(coerce(v) for v in h[1].values(field)), reverse=reverse)
+            hits = present + missing  # missing values sort last in either order, as ElasticSearch's default _last
+    return hits
+
+
+def _geo_distance_sorted(hits, spec):
+    """Sorts hits by the distance of their geo_point field to the point of spec (the nearest of lists, as mode min)"""
+    field, point = [(k, v) for k, v in spec.items() if k not in ["order", "unit", "mode", "distance_type", "ignore_unmapped"]][0]
+    lat, lng = geo.parse_es_point(point)
+    pick = max if spec.get("mode") == "max" else min
+    def distance(h):
+        points = _geo_points(h[1].values(field))
+        return pick(geo.haversine_m(lat, lng, points[:, 0], points[:, 1])) if len(points) != 0 else math.inf
+    return sorted(hits, key=distance, reverse=spec.get("order") == "desc")
+
+
+def _filter_path(body, filter_path):
+    """Applies an ElasticSearch filter_path (i.e., hits.hits._id,hits.hits._source) to a response body."""
+    if filter_path is None: return body
+    paths = [p.strip().split(".") for p in (filter_path if isinstance(filter_path, list) else filter_path.split(","))]
+
+    def keep(value, remaining):
+        if any(len(r) == 0 for r in remaining): return value
+        if isinstance(value, list):
+            kept = [keep(v, remaining) for v in value]
+            return [v for v in kept if v is not None]
+        if not isinstance(value, dict): return None
+        kept = dict()
+        for key, v in value.items():
+            below = [r[1:] for r in remaining if fnmatch.fnmatch(key, r[0])]
+            if len(below) == 0: continue
+            v = keep(v, below)
+            if v is not None and v != dict() and v != []: kept[key] = v
+        return kept
+
+    return keep(body, paths) or dict()
+
+
+def _snapshots_in(location):
+    snapshots = []
+    if not os.path.exists(location): return snapshots
+    for name in os.listdir(location):
+        filename = os.path.join(location, name, "_snapshot.json")
+        if os.path.exists(filename):
+            with open(filename, "r") as f: snapshots.append(json.load(f))
+    return snapshots
+
+
+########################################################################################################################
+# SwiftDataBackend engine
+########################################################################################################################
+
+
+class EmbeddedElasticSearchServer(object):
+    """Stands in for ElasticSearchServer: owns the embedded engine and its persistence directory."""
+
+    def __init__(self, directory=None, rebuild=False):
+        if rebuild and directory is not None and os.path.exists(directory): shutil.rmtree(directory)
+        self.directory = directory
+        self.engine = EmbeddedElasticsearch(directory=directory)
+        logger.info(f"Embedded ElasticSearch engine started (persistence={directory})")
+
+    def start(self, not_exist_ok=False): return
+
+    def stop(self, not_exist_ok=False): self.engine.flush()
+
+    def force_delete(self):
+        if self.directory is not None and os.path.exists(self.directory): shutil.rmtree(self.directory)
+
+
+class EmbeddedElasticSearchClient(ElasticSearchClient):
+    """ElasticSearchClient whose .es is the embedded engine instead of a connection to an ElasticSearch server."""
+
+    def __init__(self, server):
+        self.hostport = "embedded"
+        self.es = server.engine
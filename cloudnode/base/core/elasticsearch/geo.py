@@ -0,0 +1,159 @@
+import threading
+import numpy
+import math
+import re
+
+# Geo helpers shared by the SwiftData geo queries, the local grid index and the embedded engine. Points are (lat, lng)
+# in degrees, as SwiftData holds them; ElasticSearch geo_point values are read in any of its forms ("lat,lng" strings,
+# [lng, lat] arrays and dict(lat, lon) objects). Distances are haversine meters over the mean earth radius, as the
+# ElasticSearch arc distance; distances are parsed from numbers (meters) or strings with units, i.e., "5km", "300m".
+#
+# GRID: GridIndex holds the points of one field in float arrays and buckets them into cells of cell_deg degrees, so that
+# a radius or bounding box query only gathers the points of the cells it overlaps and then checks them vectorized.
+
+earth_radius_m = 6371008.8
+_units = dict(mm=0.001, cm=0.01, m=1.0, km=1000.0, mi=1609.344, yd=0.9144, ft=0.3048, inch=0.0254, **{"in": 0.0254},
+              nmi=1852.0, NM=1852.0)
+_distance = re.compile(r"^\s*([0-9.]+)\s*([a-zA-Z]*)\s*$")
+_base32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def parse_distance(distance):
+    """Returns meters of a number (meters) or a string with units; i.e., 5000, "5km", "3mi", "300m"."""
+    if isinstance(distance, (int, float)): return float(distance)
+    match = _distance.match(str(distance))
+    if match is None or match.group(2) not in _units and match.group(2) != "":
+        raise ValueError(f"unrecognized distance {distance}; i.e., 5000, '5km', '3mi'")
+    return float(match.group(1)) * _units.get(match.group(2), 1.0)
+
+
+def parse_point(value):
+    """Returns (lat, lng) of "lat,lng", [lat, lng(, z)] as SwiftData holds points, or dict(lat, lon)."""
+    if isinstance(value, dict): return float(value["lat"]), float(value.get("lon", value.get("lng")))
+    if isinstance(value, str): value = value.split(",")
+    return float(value[0]), float(value[1])
+
+
+def parse_es_point(value):
+    """Returns (lat, lng) of an ElasticSearch geo_point value: "lat,lng", [lng, lat] or dict(lat, lon)."""
+    if isinstance(value, (list, tuple)): return float(value[1]), float(value[0])
+    return parse_point(value)
+
+
+def haversine_m(lat, lng, lats, lngs):
+    """Meters from (lat, lng) to each of the points of the arrays lats, lngs."""
+    lat, lng, lats, lngs = map(numpy.radians, (lat, lng, numpy.asarray(lats, dtype=float), numpy.asarray(lngs, dtype=float)))
+    a = numpy.sin((lats - lat) / 2) ** 2 + numpy.cos(lat) * numpy.cos(lats) * numpy.sin((lngs - lng) / 2) ** 2
+    return 2 * earth_radius_m * numpy.arcsin(numpy.sqrt(numpy.clip(a, 0, 1)))
+
+
+def geohash(lat, lng, precision=5):
+    """The geohash cell of (lat, lng) at precision characters, as the ElasticSearch geohash_grid keys."""
+    lat_range, lng_range, bits, even, code = [-90.0, 90.0], [-180.0, 180.0], 0, True, []
+    for i in range(precision * 5):
+        interval, value = (lng_range, lng) if even else (lat_range, lat)
+        middle = (interval[0] + interval[1]) / 2
+        bits = bits * 2 + (value >= middle)
+        interval[0 if value >= middle else 1] = middle
+        even = not even
+        if i % 5 == 4: code, bits = code + [_base32[bits]], 0
+    return "".join(code)
+
+
+def in_bbox(lats, lngs, top_left, bottom_right):
+    """Mask of the points within the box of top_left and bottom_right (lat, lng); boxes may cross the antimeridian."""
+    (top, left), (bottom, right) = top_left, bottom_right
+    lats, lngs = numpy.asarray(lats, dtype=float), numpy.asarray(lngs, dtype=float)
+    in_lngs = (lngs >= left) & (lngs <= right) if left <= right else (lngs >= left) | (lngs <= right)
+    return (lats <= top) & (lats >= bottom) & in_lngs
+
+
+class GridIndex(object):
+    """Points of one geopoint field, each owned by a record id, in float arrays bucketed into a grid of cells."""
+
+    cell_deg = 1.0
+
+    def __init__(self):
+        self.lats, self.lngs = numpy.zeros(16), numpy.zeros(16)
+        self.owners = []        # map from point => id, None for removed points
+        self.free = []          # removed points, reused by the next points set so that the arrays do not grow with updates
+        self.points = dict()    # map from id => [points]
+        self.cells = dict()     # map from (lat cell, lng cell) => set of points
+        self.lock = threading.Lock()
+
+    def cell(self, lat, lng): return int(math.floor(lat / self.cell_deg)), int(math.floor(lng / self.cell_deg))
+
+    def set(self, id, points):
+        """Replaces the points of record id; points is a list of (lat, lng)."""
+        with self.lock:
+            self.__remove(id)
+            for lat, lng in points:
+                if len(self.free) != 0: point = self.free.pop()
+                else:
+                    point = len(self.owners)
+                    self.owners.append(None)
+                    if point >= len(self.lats):
+                        self.lats, self.lngs = numpy.resize(self.lats, 2 * point), numpy.resize(self.lngs, 2 * point)
+                self.lats[point], self.lngs[point] = lat, lng
+                self.owners[point] = id
+                self.points.setdefault(id, []).append(point)
+                self.cells.setdefault(self.cell(lat, lng), set()).add(point)
+
+    def remove(self, id):
+        with self.lock: self.__remove(id)
+
+    def __remove(self, id):
+        for point in self.points.pop(id, []):
+            self.owners[point] = None
+            self.free.append(point)
+            cell = self.cell(self.lats[point], self.lngs[point])
+            self.cells[cell].discard(point)
+            if len(self.cells[cell]) == 0: del self.cells[cell]
+
+    def __gather(self, bottom, top, left, right):
+        """The live points of the cells overlapping the box; all live points if it spans too many cells."""
+        (b, l), (t, r) = self.cell(bottom, left), self.cell(top, right)
+        n_cells = (t - b + 1) * ((r - l + 1) if l <= r else (r - l + 1 + int(360 / self.cell_deg)))
+        if n_cells > len(self.cells):
+            points = [p for cell in self.cells.values() for p in cell]
+        else:
+            lng_cells = range(l, r + 1) if l <= r else list(range(l, int(180 / self.cell_deg))) + list(range(int(-180 / self.cell_deg), r + 1))
+            points = [p for i in range(b, t + 1) for j in lng_cells for p in self.cells.get((i, j), ())]
+        return numpy.asarray(points, dtype=int)
+
+    def within(self, lat, lng, radius_m):
+        """Returns dict(id=meters) of the records with a point within radius_m of (lat, lng); the nearest point each."""
+        with self.lock:
+            dlat = math.degrees(radius_m / earth_radius_m)
+            top, bottom = min(90.0, lat + dlat), max(-90.0, lat - dlat)
+            if top >= 90 or bottom <= -90 or math.cos(math.radians(lat)) < 1e-6: left, right = -180.0, 180.0 - 1e-9
+            else:
+                dlng = min(180.0, dlat / math.cos(math.radians(lat)))
+                left, right = ((lng - dlng + 180) % 360) - 180, ((lng + dlng + 180) % 360) - 180
+                if dlng >= 180: left, right = -180.0, 180.0 - 1e-9
+            points = self.__gather(bottom, top, left, right)
+            if len(points) == 0: return dict()
+            meters = haversine_m(lat, lng, self.lats[points], self.lngs[points])
+            found = dict()
+            for point, m in zip(points[meters <= radius_m], meters[meters <= radius_m]):
+                id = self.owners[point]
+                if id is not None and (id not in found or m < found[id]): found[id] = float(m)
+            return found
+
+    def in_bbox(self, top_left, bottom_right):
+        """Returns the set of ids of the records with a point within the box."""
+        with self.lock:
+            (top, left), (bottom, right) = top_left, bottom_right
+            points = self.__gather(bottom, top, left, right)
+            if len(points) == 0: return set()
+            mask = in_bbox(self.lats[points], self.lngs[points], top_left, bottom_right)
+            return set(self.owners[p] for p in points[mask] if self.owners[p] is not None)
+
+    def grid(self, precision=5, ids=None):
+        """Returns dict(geohash=number of records) of the points (of ids, if given) at precision."""
+        with self.lock:
+            cells = dict()
+            for id, points in self.points.items():
+                if ids is not None and id not in ids: continue
+                for key in set(geohash(self.lats[p], self.lngs[p], precision) for p in points): cells[key] = cells.get(key, 0) + 1
+            return cells
@@ -0,0 +1,186 @@
+import elasticsearch.exceptions
+import contextlib
+import threading
+import time
+import re
+
+import logging
+logger = logging.getLogger(__name__)
+
+# IndexMigration moves the records of a SwiftData index into a new index with the current mapping of its class without
+# downtime: the stable name of the class index is an alias onto a versioned index (i.e., index.applet.movie.
+# elasticsearchdocument.v2; see SwiftData.create_index), so that a migration builds the next version beside it and
+# swaps the alias in one atomic update_aliases request, and readers never see a half-built index.
+#
+# DUAL WRITES: the migration registers before it copies anything; every SwiftData save and delete through this process
+# which starts afterwards also writes into the new index (see IndexMigration.writing), and the writes which started
+# before are drained before the source is refreshed and copied. The copy is a server-side _reindex in parallel slices
+# with op_type=create and conflicts=proceed: records already dual-written are newer and are not overwritten by the
+# copy, and ids deleted during the copy are deleted again afterwards. Writes of other processes (or of the bulk
+# indexer) are not dual-written; migrate while they are paused.
+# LEGACY: indices created before aliases are concrete indices with the stable name; the swap then removes the legacy
+# index in the same request (remove_index), as the alias takes its name, so keep_old does not apply to them.
+# PROGRESS: the _reindex runs as a task which is polled every poll_s for .progress(): docs done, total and docs/s.
+
+
+def versioned(alias, version): return f"{alias}.v{version}"
+
+
+class IndexMigration(object):
+    """Reindexes the index behind alias into the next version with mappings while writes are dual-written, then swaps."""
+
+    active = dict()       # map from alias => the IndexMigration into which writes to alias are also written
+    generations = dict()  # map from alias => the generation of writes, bumped to drain the writes started before
+    writes = dict()       # map from (alias, generation) => number of writes in flight
+    lock = threading.Condition()
+
+    def __init__(self, es, alias, mappings, slices="auto", keep_old=False, poll_s=1.0):
+        self.es = es
+        self.alias = alias
+        self.mappings = mappings  # dict(mappings=..., settings=...) of the new index
+        self.slices = slices
+        self.keep_old = keep_old
+        self.poll_s = poll_s
+        self.source, self.target, self.legacy = None, None, False
+        self.deleted = set()      # ids deleted during the migration; deleted again from target after the copy
+        self.deleted_lock = threading.Lock()
+        self.started_s = time.time()
+        self.finished_s = None
+        self.status = dict(stage="pending", total=0, created=0, updated=0, version_conflicts=0, batches=0)
+        self.error = None
+        self.done = threading.Event()
+        self.thread = None
+
+    @staticmethod
+    @contextlib.contextmanager
+    def writing(alias):
+        """Wraps one write into alias; yields the IndexMigration of alias to also write into, if any."""
+        with IndexMigration.lock:
+            key = (alias, IndexMigration.generations.get(alias, 0))
+            IndexMigration.writes[key] = IndexMigration.writes.get(key, 0) + 1
+            migration = IndexMigration.active.get(alias)
+        try: yield migration
+        finally:
+            with IndexMigration.lock:
+                IndexMigration.writes[key] -= 1
+                if IndexMigration.writes[key] == 0: del IndexMigration.writes[key]
+                IndexMigration.lock.notify_all()
+
+    def index(self, id, document):
+        """The dual write of a save: document replaces id in the new index."""
+        with self.deleted_lock:  # NOTE: held across the write, so that the replay of deletes cannot remove it after
+            self.deleted.discard(str(id))
+            self.es.index(index=self.target, id=id, document=document)
+
+    def delete(self, id):
+        """The dual write of a delete: id is deleted from the new index now, and again after the copy."""
+        with self.deleted_lock:
+            self.deleted.add(str(id))
+            try: self.es.delete(index=self.target, id=id)
+            except elasticsearch.exceptions.NotFoundError: pass  # not copied yet
+
+    ####################################################################################################################
+    # migration
+    ####################################################################################################################
+
+    def start(self):
+        with IndexMigration.lock:
+            if self.alias in IndexMigration.active: raise RuntimeError(f"{self.alias} is already being migrated")
+            self.source, self.legacy = self.__source()
+            version = 1 if self.legacy else int(re.search(r"\.v(\d+)$", self.source).group(1)) + 1
+            self.target = versioned(self.alias, version)
+            self.es.indices.create(index=self.target, **self.mappings)
+            IndexMigration.active[self.alias] = self  # writes which start from here are dual-written
+        self.thread = threading.Thread(target=self.__run, name=f"migrate={self.alias}", daemon=True)
+        self.thread.start()
+        return self
+
+    def wait(self, timeout_s=None):
+        """Blocks until the alias has been swapped; returns the final progress, or raises the error of the migration."""
+        if not self.done.wait(timeout_s): raise TimeoutError(f"migration of {self.alias} not done after {timeout_s}s")
+        if self.error is not None: raise self.error
+        return self.progress()
+
+    def progress(self):
+        """Returns dict(stage, done, total, created, version_conflicts, ratio, docs_per_s, elapsed_s, remaining_s)."""
+        status = dict(self.status)
+        copied = status["created"] + status["updated"] + status["version_conflicts"]
+        elapsed_s = (self.finished_s or time.time()) - self.started_s
+        docs_per_s = copied / max(1e-9, elapsed_s)
+        return status | dict(alias=self.alias, source=self.source, target=self.target, done=self.done.is_set(),
+                             copied=copied, ratio=copied / max(1, status["total"]), elapsed_s=elapsed_s,
+                             docs_per_s=docs_per_s, deleted=len(self.deleted), error=None if self.error is None else str(self.error),
+                             remaining_s=0.0 if self.done.is_set() else (status["total"] - copied) / max(1e-9, docs_per_s))
+
+    def __source(self):
+        """Returns (the index behind alias, whether it is a legacy concrete index named alias)."""
+        try: indices = list(self.es.indices.get_alias(name=self.alias).body)
+        except elasticsearch.exceptions.NotFoundError:
+            if self.es.indices.exists(index=self.alias): return self.alias, True
+            raise KeyError(f"index {self.alias} does not exist")
+        if len(indices) != 1 or re.search(r"\.v(\d+)$", indices[0]) is None:
+            raise RuntimeError(f"{self.alias} must alias one versioned index to be migrated: {indices}")
+        return indices[0], False
+
+    def __run(self):
+        swapped = False
+        try:
+            self.__stage("draining")
+            self.__drain()
+            self.es.indices.refresh(index=self.source)
+            self.__stage("copying")
+            task = self.es.reindex(source=dict(index=self.source), dest=dict(index=self.target, op_type="create"),
+                                   conflicts="proceed", slices=self.slices, wait_for_completion=False).body["task"]
+            self.__poll(task)
+            with self.deleted_lock: deleted = list(self.deleted)
+            for id in deleted:
+                with self.deleted_lock:
+                    if id not in self.deleted: continue  # saved again since
+                    try: self.es.delete(index=self.target, id=id)
+                    except elasticsearch.exceptions.NotFoundError: pass
+            self.es.indices.refresh(index=self.target)
+            self.__stage("swapping")
+            removal = dict(remove_index=dict(index=self.source)) if self.legacy else dict(remove=dict(index=self.source, alias=self.alias))
+            self.es.indices.update_aliases(actions=[dict(add=dict(index=self.target, alias=self.alias, is_write_index=True)), removal])
+            swapped = True
+            self.__drain()  # deletes started before the swap may still address the source
+            if not (self.legacy or self.keep_old): self.es.indices.delete(index=self.source)
+            self.__stage("done")
+        except Exception as e:
+            self.error = e
+            self.__stage("failed")
+            logger.warning(f"MIGRATE {self.alias} failed: {e}")
+            if not swapped:
+                try: self.es.indices.delete(index=self.target)
+                except elasticsearch.exceptions.ApiError: pass
+        finally:
+            with IndexMigration.lock: IndexMigration.active.pop(self.alias, None)
+            self.finished_s = time.time()
+            self.done.set()
+        if self.error is None:
+            p = self.progress()
+            logger.info(f"MIGRATE {self.alias} done: {p['copied']} records {self.source} => {self.target} in "
+                        f"{p['elapsed_s']:.1f}s ({p['docs_per_s']:.0f} docs/s), {p['deleted']} deleted while copying")
+
+    def __drain(self):
+        """Waits until the writes into alias which started before now have finished."""
+        with IndexMigration.lock:
+            generation = IndexMigration.generations.get(self.alias, 0)
+            IndexMigration.generations[self.alias] = generation + 1
+            IndexMigration.lock.wait_for(lambda: all(k[0] != self.alias or k[1] > generation for k in IndexMigration.writes))
+
+    def __poll(self, task):
+        while True:
+            response = self.es.tasks.get(task_id=task).body
+            status = response["task"]["status"]
+            self.status.update({k: status.get(k, 0) for k in ["total", "created", "updated", "version_conflicts", "batches"]})
+            if response.get("completed"):
+                if response.get("error") is not None: raise RuntimeError(f"reindex into {self.target} failed: {response['error']}")
+                failures = response.get("response", dict()).get("failures", [])
+                if len(failures) != 0: raise RuntimeError(f"reindex into {self.target} failed: {failures[:3]}")
+                return
+            p = self.progress()
+            logger.info(f"MIGRATE {self.alias}: {p['copied']}/{p['total']} ({100 * p['ratio']:.0f}%) at {p['docs_per_s']:.0f} docs/s")
+            time.sleep(self.poll_s)
+
+    def __stage(self, stage): self.status["stage"] = stage
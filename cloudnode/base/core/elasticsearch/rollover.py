@@ -0,0 +1,218 @@
+from cloudnode.base.core.elasticsearch import timebuckets
+from cloudnode.base.core.elasticsearch.searchbar import date_math
+import elasticsearch.exceptions
+import dataclasses
+import threading
+import datetime
+import time
+import re
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Rollover splits the records of a SwiftData class (i.e., log lines) into one index per period of a timestamp field,
+# i.e., index.applet.logline.elasticsearchdocument.2024.01.31-000001, so that retention drops whole indices instead of
+# deleting by query, and windows on the field search only the indices of the periods they overlap instead of all. The
+# class name stays an alias onto every rolled index; its write index is the newest, and saves of the current period go
+# through it. Records of past periods (late arrivals) are written into the newest index of their own period.
+#
+# SIZE: within a period the write index also rolls over to the next index of the period (-000002, ...) beyond max_docs
+# or max_size_mb, checked by .maintain() (see SwiftData.rollover), which also drops the indices beyond retention.
+# LOCAL: the local filesystem store of a rolled class keeps one directory per period, so that retention removes
+# directories; see SwiftDataBackend.create_stub.
+# NOTE: records are placed by the period of their field when saved; the field is expected not to change (i.e., the time
+# of the event), as a changed value would place a second copy into another period.
+
+
+@dataclasses.dataclass(frozen=True)
+class Rollover:
+    """The rollover policy of a SwiftData class, i.e., class LogLine(SwiftData, rollover=Rollover("timestamp"))."""
+    field: str                 # the timestamp field which places records into periods
+    period: str = "1d"         # the width of a period, as time buckets: "1h", "1d", "7d"
+    max_docs: int = None       # rolls over to the next index of the period beyond this many records
+    max_size_mb: float = None  # or beyond this primary store size
+    keep: int = None           # retention: the number of periods kept, the current one included; None keeps all
+
+    @property
+    def seconds(self): return timebuckets.parse_width(self.period)
+
+    def format(self):
+        """The strftime format of period keys; keys sort as their periods do."""
+        if self.seconds % 86400 == 0: return "%Y.%m.%d"
+        if self.seconds % 3600 == 0: return "%Y.%m.%d.%H"
+        return "%Y.%m.%d.%H.%M" if self.seconds % 60 == 0 else "%Y.%m.%d.%H.%M.%S"
+
+    def start_of(self, value):
+        """Epoch seconds of the start of the period of a timestamp (datetime, isoformat or epoch seconds); now if None."""
+        if value is None: epoch = time.time()
+        elif isinstance(value, (int, float)) and not isinstance(value, bool): epoch = float(value)
+        else: epoch = timebuckets.epoch_of(value)
+        return epoch // self.seconds * self.seconds
+
+    def key_of(self, value):
+        """The period key of a timestamp; i.e., 2024.01.31 for daily periods."""
+        start = datetime.datetime.fromtimestamp(self.start_of(value), tz=datetime.timezone.utc)
+        return start.strftime(self.format())
+
+    def oldest_kept(self, now=None):
+        """The key of the oldest period within retention; None if all are kept."""
+        if self.keep is None: return None
+        return self.key_of(self.start_of(now) - (self.keep - 1) * self.seconds)
+
+    def keys_of_window(self, bounds, max_periods=1024):
+        """The keys of the periods overlapping range bounds (gte, gt, lte, lt; dates or date math); None when the window
+        is open-ended, unparsable or spans more than max_periods, i.e., when it cannot narrow the indices searched."""
+        lower = bounds.get("gte", bounds.get("gt"))
+        upper = bounds.get("lte", bounds.get("lt"))
+        if lower is None or upper is None: return None
+        try: a, b = date_math(lower).timestamp(), date_math(upper, round_up=True).timestamp()
+        except (TypeError, ValueError, OverflowError, AttributeError): return None
+        start, end = self.start_of(a), self.start_of(b)
+        if end < start: return []
+        if (end - start) / self.seconds >= max_periods: return None
+        return [self.key_of(start + i * self.seconds) for i in range(int((end - start) // self.seconds) + 1)]
+
+
+def rolled_name(alias, key, n=1): return f"{alias}.{key}-{n:06d}"
+
+
+class RolledIndex(object):
+    """The rolled indices behind one alias: where records are written, which indices a window searches, retention."""
+
+    known = dict()  # map from alias => RolledIndex; one per alias per process
+    known_lock = threading.Lock()
+
+    def __init__(self, es, alias, policy, mappings):
+        self.es = es
+        self.alias = alias
+        self.policy = policy
+        self.mappings = mappings       # dict(mappings=..., settings=...) of each new index
+        self.indices = None            # map from index => (key, n, is_write_index); see .load()
+        self.lock = threading.RLock()
+        self.pattern = re.compile(rf"^{re.escape(alias)}\.(?P<key>[0-9.]+)-(?P<n>\d{{6}})$")
+
+    @staticmethod
+    def of(es, es_index, policy):
+        """The RolledIndex of the alias of an elasticsearch-dsl Index, whose mappings each new rolled index takes."""
+        with RolledIndex.known_lock:
+            known = RolledIndex.known.get(es_index._name)
+            if known is None or known.es is not es or known.policy != policy:
+                known = RolledIndex.known[es_index._name] = RolledIndex(es, es_index._name, policy, es_index.to_dict())
+            return known
+
+    def load(self):
+        """Lists the indices behind the alias; called once, and again whenever another process may have rolled them."""
+        with self.lock:
+            try: found = self.es.indices.get_alias(name=self.alias).body
+            except elasticsearch.exceptions.NotFoundError:
+                if self.es.indices.exists(index=self.alias):
+                    raise RuntimeError(f"{self.alias} is an index without rollover; migrate its records into a new index name")
+                found = dict()
+            self.indices = dict()
+            for name, props in found.items():
+                match = self.pattern.match(name)
+                if match is None: continue
+                is_write = props.get("aliases", dict()).get(self.alias, dict()).get("is_write_index", len(found) == 1)
+                self.indices[name] = (match.group("key"), int(match.group("n")), bool(is_write))
+            return self
+
+    def write_index(self):
+        """The name of the write index of the alias, or None."""
+        with self.lock:
+            if self.indices is None: self.load()
+            return next((name for name, (_, _, is_write) in self.indices.items() if is_write), None)
+
+    def latest_of(self, key):
+        """The newest index of the period key, or None."""
+        with self.lock:
+            if self.indices is None: self.load()
+            names = [(n, name) for name, (k, n, _) in self.indices.items() if k == key]
+            return max(names)[1] if len(names) != 0 else None
+
+    def locate(self, ids):
+        """Returns dict(id=document) of the ids found in any rolled index, the newest first; one mget request, which is
+        realtime as a get is, rather than a search of ids which only sees refreshed documents."""
+        with self.lock:
+            if self.indices is None: self.load()
+            names = sorted(self.indices, key=lambda name: self.indices[name][:2], reverse=True)
+        if len(names) == 0: return dict()
+        found = dict()
+        for doc in self.es.mget(docs=[dict(_index=name, _id=str(id)) for id in ids for name in names]).body["docs"]:
+            if doc.get("found"): found.setdefault(doc["_id"], doc)
+        return found
+
+    def target_of(self, value):
+        """Returns the index to write a record of timestamp value into: None for the write alias (the current period),
+        or the newest index of a past period; rolls over to a new period, or creates the first index, as needed."""
+        key = self.policy.key_of(value)
+        with self.lock:
+            write = self.write_index()
+            if write is not None and self.indices[write][0] == key: return None
+            if write is None or self.indices[write][0] < key: return self.__roll(key, 1)
+            if self.latest_of(key) is None: self.__create(rolled_name(self.alias, key, 1), is_write=False)
+            return self.latest_of(key)
+
+    def ensure(self):
+        """Creates the index of the current period, if there is no index behind the alias yet."""
+        with self.lock:
+            if self.write_index() is None: self.__roll(self.policy.key_of(None), 1)
+        return self
+
+    def routed(self, windows):
+        """The indices to search for the window clauses of a search bar on the policy field, as a list of patterns (an
+        intersection across clauses of the union of the periods of their values); None to search the whole alias."""
+        keys = None
+        for values in windows:
+            periods = [self.policy.keys_of_window(bounds) for bounds in values]
+            if any(p is None for p in periods): continue
+            union = {k for p in periods for k in p}
+            keys = union if keys is None else keys & union
+        if keys is None: return None
+        if len(keys) == 0: return [f"{self.alias}.none-*"]  # an empty window: a pattern which matches no index
+        return [f"{self.alias}.{key}-*" for key in sorted(keys)]
+
+    def maintain(self, now=None):
+        """Rolls the write index over to the next index of its period beyond max_docs or max_size_mb, and drops the
+        indices of the periods beyond retention; returns dict(rolled=new index or None, dropped=[indices])."""
+        with self.lock:
+            self.load()
+            rolled, write = None, self.write_index()
+            if write is not None and (self.policy.max_docs is not None or self.policy.max_size_mb is not None):
+                stats = self.es.indices.stats(index=write, metric="docs,store").body["_all"]["primaries"]
+                n_docs, size_mb = stats["docs"]["count"], stats["store"]["size_in_bytes"] / 2**20
+                if (self.policy.max_docs is not None and n_docs >= self.policy.max_docs) or \
+                        (self.policy.max_size_mb is not None and size_mb >= self.policy.max_size_mb):
+                    key, n, _ = self.indices[write]
+                    rolled = self.__roll(key, n + 1)
+                    logger.info(f"ROLLOVER {self.alias}: {write} => {rolled} at {n_docs} docs, {size_mb:.1f}MB")
+            oldest, dropped = self.policy.oldest_kept(now), []
+            if oldest is not None:
+                dropped = [name for name, (key, _, is_write) in self.indices.items() if key < oldest and not is_write]
+                if len(dropped) != 0:
+                    self.es.indices.delete(index=",".join(dropped))
+                    for name in dropped: self.indices.pop(name)
+                    logger.info(f"ROLLOVER {self.alias}: dropped {len(dropped)} indices before {oldest}")
+            return dict(rolled=rolled, dropped=dropped)
+
+    def __create(self, name, is_write):
+        """Creates an index behind the alias; returns False if another process has created it first."""
+        try: self.es.indices.create(index=name, aliases={self.alias: dict(is_write_index=is_write)}, **self.mappings)
+        except elasticsearch.exceptions.BadRequestError as e:
+            if e.body["error"]["type"] != "resource_already_exists_exception": raise
+            self.load()
+            return False
+        match = self.pattern.match(name)
+        self.indices[name] = (match.group("key"), int(match.group("n")), is_write)
+        return True
+
+    def __roll(self, key, n):
+        """Creates index n of period key and makes it the write index in one alias update; returns it."""
+        name, previous = rolled_name(self.alias, key, n), self.write_index()
+        if not self.__create(name, is_write=previous is None): return name  # rolled over by another process
+        if previous is not None:
+            self.es.indices.update_aliases(actions=[dict(add=dict(index=name, alias=self.alias, is_write_index=True)),
+                                                    dict(add=dict(index=previous, alias=self.alias, is_write_index=False))])
+            self.indices[name] = self.indices[name][:2] + (True,)
+            if previous in self.indices: self.indices[previous] = self.indices[previous][:2] + (False,)
+        return name
+
@@ -1,15 +1,17 @@
 from cloudnode.base.core.thirdparty.DockerClient import DockerClient
 from cloudnode.base.core.lightweight_utilities.misc import TemporarilySuppressLoggingEqualOrHigher
+from cloudnode.base.core.elasticsearch.searchbar import SearchBarPlan
+from cloudnode.base.core.elasticsearch import searchbar
+from cloudnode.base.core.elasticsearch.bulk import BulkIndexer
+from cloudnode.base.core.elasticsearch.transport import TransportProfile, TransportMetrics, PooledHttpNode
 from cloudnode.config import RuntimeConfig
 from elasticsearch_dsl import Search, Q
 from elasticsearch import Elasticsearch, helpers
 import elasticsearch.exceptions
-import tempfile
+import threading
 import urllib3
 import datetime
-import yaml
 import time
-import re
 import os
 
 import logging
@@ -49,9 +51,15 @@ class ElasticSearchServer(object):
     port = "9200"
     name = "elasticsearch"
 
-    def __init__(self, password=None, exist_ok=False, run_ok=False):
+    # NOTE: the container is configured at creation through its environment (the image maps environment variables
+    # named as settings, i.e., path.repo, into elasticsearch.yml), so that no config is copied out, edited, copied back
+    # and restarted; ES_JAVA_OPTS sets the JVM heap from the memory of the host (see heap_mb_for_host).
+
+    def __init__(self, password=None, exist_ok=False, run_ok=False, heap_mb=None):
         self.docker = DockerClient()
+        self.timings = dict()  # map from startup phase => seconds; see also ElasticSearchClient.wait_for_ready
         name = ElasticSearchServer.name
+        s = time.time()
         if self.docker.container_is_built(name):
             if not exist_ok:
                 raise RuntimeError(f"ElasticSearch server already exists: {name}")
@@ -61,34 +69,42 @@ class ElasticSearchServer(object):
                     logger.info(f"ElasticSearch server already running: {name}")
                     return
                 raise RuntimeError(f"ElasticSearch server already running: {name}")
-            logger.info(f"ElasticSearch server restarting procedure (about 30 seconds): {name}")
+            logger.info(f"ElasticSearch server restarting: {name}")
             self.start()
+            self.timings["container_start_s"] = time.time() - s
             return
 
         # container is not built
-        logger.info(f"ElasticSearch server startup procedure (about 30 seconds): {name}")
-        environment = {"discovery.type": "single-node",
-                       "xpack.security.http.ssl.enabled": "false",
-                       "xpack.license.self_generated.type": "trial"}
-        if password is not None: environment.update(ELASTIC_PASSWORD=password)
+        logger.info(f"ElasticSearch server startup procedure: {name}")
         directory = os.path.join(RuntimeConfig.directory_base_local, "_subsystem/swiftdata/_snapshots/elasticsearch/")
+        os.makedirs(directory, exist_ok=True)
+        environment = ElasticSearchServer.environment(password=password, snapshot_directory=directory, heap_mb=heap_mb)
         mounts = [dict(target=directory, source=directory, type="bind", read_only=False)]
         self.docker.container_build(ElasticSearchServer.docker_container,
                                     ElasticSearchServer.port,
                                     name=name, mounts=mounts, detach=True,
                                     environment=environment, censor=["ELASTIC_PASSWORD"])
+        self.timings["container_create_s"] = time.time() - s
+
+    @staticmethod
+    def environment(password=None, snapshot_directory=None, heap_mb=None):
+        """The container environment: single node, http without ssl, snapshot repository path and JVM heap."""
+        heap_mb = ElasticSearchServer.heap_mb_for_host() if heap_mb is None else heap_mb
+        environment = {"discovery.type": "single-node",
+                       "xpack.security.http.ssl.enabled": "false",
+                       "xpack.license.self_generated.type": "trial",
+                       "ES_JAVA_OPTS": f"-Xms{heap_mb}m -Xmx{heap_mb}m"}
+        if snapshot_directory is not None: environment["path.repo"] = snapshot_directory
+        if password is not None: environment.update(ELASTIC_PASSWORD=password)
+        return environment
 
-        # now we edit its elasticsearch.yaml to accept snapshots and restart
-        tmp = tempfile.NamedTemporaryFile(suffix=".yaml", delete=True)
-        in_container_config_yaml = "/usr/share/elasticsearch/config/elasticsearch.yml"
-        self.docker.copy_from_container(name, in_container_config_yaml, tmp.name)
-        with open(tmp.name, "r") as f: config = yaml.safe_load(f)
-        if "path.repo" not in config: config["path.repo"] = [directory]
-        if directory not in config["path.repo"]: config["path.repo"].append(directory)
-        with open(tmp.name, "w") as f: yaml.safe_dump(config, f)
-        self.docker.copy_to_container(name, tmp.name, in_container_config_yaml)
-        self.docker.container_stop(name, wait=True)
-        self.docker.container_start(name)
+    @staticmethod
+    def heap_mb_for_host(fraction=0.5, min_mb=512, max_mb=31 * 1024):
+        """JVM heap of half the host memory, as ElasticSearch advises; under 31GB so that the JVM compresses oops."""
+        # NOTE: Xms equal to Xmx avoids heap resizing pauses; the other half of memory is left to the filesystem cache
+        try: host_mb = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // 2**20
+        except (ValueError, OSError, AttributeError): return 1024
+        return int(max(min_mb, min(max_mb, host_mb * fraction)))
 
     @staticmethod
     def force_delete():
@@ -105,14 +121,49 @@ class ElasticSearchServer(object):
         DockerClient().container_start(ElasticSearchServer.name, not_exist_ok=not_exist_ok)
 
 
+class _ThreadClientCloser(object):
+    """Closes the client of a thread when the thread local which holds it is released."""
+
+    def __init__(self, es): self.es = es
+
+    def __del__(self):
+        try: self.es.close()
+        except Exception: pass
+
+
 class ElasticSearchClient(object):
 
-    def __init__(self, hostport=None, password=None):
+    profile = None
+    metrics = None
+
+    def __init__(self, hostport=None, password=None, profile=None):
         if hostport is None: hostport = f"127.0.0.1:{ElasticSearchServer.port}"
         self.hostport = hostport
-        kwargs = dict(hosts=[f"http://{hostport}"])  # SSL would use https://
-        if password is not None: kwargs["basic_auth"] = ("elastic", password)
-        self.es = Elasticsearch(**kwargs)
+        self.profile = TransportProfile() if profile is None else profile
+        self.metrics = TransportMetrics()
+        self.kwargs = dict(hosts=[f"http://{hostport}"])  # SSL would use https://
+        self.kwargs.update(self.profile.client_kwargs(PooledHttpNode.bound(self.profile, self.metrics)))
+        if password is not None: self.kwargs["basic_auth"] = ("elastic", password)
+        self.local = threading.local()
+        self.es = Elasticsearch(**self.kwargs)
+
+    @property
+    def es(self):
+        """The Elasticsearch client; with profile.per_thread, the client (and connection pool) of the calling thread."""
+        if self.profile is None or not self.profile.per_thread: return self._es
+        if getattr(self.local, "es", None) is None:
+            self.local.es = Elasticsearch(**self.kwargs)
+            # NOTE: the local of a thread is released when the thread ends (i.e., each request thread of werkzeug), so
+            # its client is closed then, and its pool with it, rather than left open for the life of the process
+            self.local.closer = _ThreadClientCloser(self.local.es)
+        return self.local.es
+
+    @es.setter
+    def es(self, es): self._es = es
+
+    def transport_metrics(self):
+        """Returns the connection pool utilization, saturation, backoff and compression metrics; None if unpooled."""
+        return None if self.metrics is None else self.metrics.snapshot()
 
     def is_active(self):
         """Convenience method that checks for active connection: will fail if either ping or connection fails."""
@@ -136,6 +187,30 @@ class ElasticSearchClient(object):
             logger.info(f"Waiting {until} for ES {self.hostport} to Launch. Pausing one second at {time.ctime()}")
             time.sleep(1)
 
+    def wait_for_ready(self, timeout_s=None, status="yellow", poll_s=0.1):
+        """Blocks until the cluster health reaches status; returns the seconds to first response and to ready."""
+        # NOTE: the first phase polls quickly (poll_s, doubling to 1s) until the node answers http; the second phase is
+        # a single long poll by _cluster/health?wait_for_status=yellow which returns as soon as the shards are allocated
+        s = time.time()
+        timings = dict()
+        while True:
+            try:
+                with TemporarilySuppressLoggingEqualOrHigher(logging.ERROR):
+                    health = self.es.options(request_timeout=30).cluster.health(wait_for_status=status, timeout="25s")
+                timings.setdefault("first_response_s", time.time() - s)
+                if not health.body.get("timed_out", False): break
+                logger.info(f"ElasticSearch {self.hostport} is {health.body.get('status')}; waiting for {status}")
+            except elasticsearch.exceptions.ApiError as e:
+                timings.setdefault("first_response_s", time.time() - s)  # i.e., 503 while the node is recovering
+                time.sleep(poll_s)
+            except Exception as e:
+                time.sleep(poll_s)
+                poll_s = min(1.0, poll_s * 2)
+            if timeout_s is not None and time.time() - s > timeout_s:
+                raise TimeoutError(f"ElasticSearch server has not reached {status} after {timeout_s} seconds.")
+        timings["ready_s"] = time.time() - s
+        return timings
+
     def index_exists(self, index_name):
         """Identify whether an INDEX exists."""
         # XHEAD "/<index_name>?pretty" returns 200 if exists and 404 if not.
@@ -167,13 +242,21 @@ class ElasticSearchClient(object):
         # NOTE: POST /_snapshot/APPLET/SAVE_NAME/_restore { "indices": "*" }
         if indices is None: indices = ["*"]
         logger.info(f"INDICES CLOSE {applet} {indices}")
-        open_indices_s = self.perform_request("GET", "/_cat/indices")
-        open_indices_s = [line.strip() for line in open_indices_s.split("\n") if line.strip() != ""]
-        open_indices = [line.split(" ")[2] for line in open_indices_s if len(line.split(" ")) > 3]
-        [self.perform_request("POST", f"/{index}/_close") for index in indices if index in open_indices]
+        self.indices_close(indices)
         logger.info(f"SNAPSHOT LOAD {applet} {save_name}")
         return self.perform_request("POST", f"/_snapshot/{applet.lower()}/{save_name.lower()}/_restore", data=dict(indices=indices))
 
+    def indices_close(self, patterns):
+        """Closes the open indices of patterns (names, aliases or wildcards) in one request by name; returns them."""
+        # NOTE: ElasticSearch 8 rejects _close of wildcards and _all (action.destructive_requires_name defaults to true)
+        # NOTE: so patterns are resolved into the names of open indices first: GET /_resolve/index/PATTERNS
+        options = "ignore_unavailable=true&allow_no_indices=true&expand_wildcards=open"
+        resolved = self.perform_request("GET", f"/_resolve/index/{','.join(patterns)}?{options}").body
+        names = [i["name"] for i in resolved.get("indices", []) if "closed" not in i.get("attributes", [])]
+        names += [n for alias in resolved.get("aliases", []) for n in alias.get("indices", []) if n not in names]
+        if len(names) != 0: self.perform_request("POST", f"/{','.join(names)}/_close?ignore_unavailable=true")
+        return names
+
     def snapshot_latest(self, applet):
         """Convenience function for getting the most recent instance for reloading state of an ElasticSearch index"""
         results = self.snapshot_list(applet)
@@ -210,19 +293,32 @@ class ElasticSearchClient(object):
         headers = {} if data is None else {"accept": "application/json", "content-type": "application/json"}
         return self.es.perform_request(method, path, headers=headers, body=data)
 
-    def streaming_bulk_upsert(self, objs):
-        """Creates a streaming bulk insert or upsert: ElasticSearch seems to suggest these are identical actions."""
+    def streaming_bulk_upsert(self, objs, raise_on_error=True):
+        """Creates a streaming bulk insert or upsert: ElasticSearch seems to suggest these are identical actions. Returns
+        the metrics of its BulkIndexer; raises BulkIndexError if any failed, unless raise_on_error=False."""
         # NOTE: objs are elasticsearch_dsl Documents
         # NOTE: is superfluous: https://github.com/elastic/elasticsearch-dsl-py/issues/403#issuecomment-392803588
         # NOTE: optimal bulk size? total MB is what matters, about 50MB (100MB max); 5MB ideal, about 1K to 5K docs per
         # NOTE: https://stackoverflow.com/questions/18488747/what-is-the-ideal-bulk-size-formula-in-elasticsearch
-        return list(helpers.streaming_bulk(self.es, [obj.to_dict(True) for obj in objs]))
-
-    def count(self, index):
-        """Returns count of all documents in index."""
-        self.es.indices.refresh(index=index)
-        result = self.es.cat.count(index=index, params={"format": "json"})
-        return int(result[0]["count"]) if (result is not None and isinstance(result, list) and "count" in result[0]) else None
+        # NOTE: objs may be any iterable, i.e., a generator; it is streamed through a BulkIndexer and never materialized
+        with self.bulk_indexer() as indexer: indexer.add_all(objs)
+        metrics = indexer.metrics()
+        if raise_on_error and metrics["failures"] != 0:
+            raise helpers.BulkIndexError(f"{metrics['failures']} document(s) failed to index.", indexer.failures())
+        return metrics
+
+    def bulk_indexer(self, **kwargs):
+        """Returns a started BulkIndexer into this connection; see BulkIndexer for kwargs, i.e., n_workers."""
+        return BulkIndexer(self.es, **kwargs).start()
+
+    def count(self, index, query=None, fresh=False):
+        """Returns count of documents in index matching query (all if None); fresh=True forces an index refresh first."""
+        # NOTE: _count is the programmatic api; _cat is meant for humans and forced refreshes stall bulk ingest throughput
+        # NOTE: without fresh=True the count reflects the last scheduled refresh (1s default) which is enough for most uses
+        if fresh: self.es.indices.refresh(index=index)
+        if query is not None and hasattr(query, "to_dict"): query = query.to_dict()
+        result = self.es.count(index=index, query=query)
+        return int(result["count"]) if (result is not None and "count" in result) else None
 
 
 class ElasticSearchDslClient(object):
@@ -241,7 +337,26 @@ class ElasticSearchDslClient(object):
         return [h.meta.id for h in s.scan()]
 
     @staticmethod
-    def search_bar(s):
+    def scan_batches(es, es_index_name, dsl_q=None, source=None, batch_size=1000, preserve_order=False, max_results=None):
+        """Yields the hits of dsl_q (all if None) as lists of up to batch_size, by scroll; source is the _source fields
+        (all if None); preserve_order keeps the order by score, at the cost of a sorted scroll"""
+        body = dict() if dsl_q is None else dict(query=dsl_q.to_dict() if hasattr(dsl_q, "to_dict") else dsl_q)
+        if source is not None: body["_source"] = source
+        hits = helpers.scan(es, query=body, index=es_index_name, size=batch_size, preserve_order=preserve_order)
+        batch, n = [], 0
+        try:
+            for hit in hits:
+                batch.append(hit)
+                n += 1
+                if len(batch) == batch_size or n == max_results:
+                    yield batch
+                    batch = []
+                if n == max_results: break
+            if len(batch) != 0: yield batch
+        finally: hits.close()  # clears the scroll when stopped at max_results
+
+    @staticmethod
+    def search_bar(s, mapping=None):
         """Creates an ElasticSearch Query using a familiar search bar: ~title:bucket cast:"jack nicholson"""
         # NOTE: ~title:bucket cast:"jack nicholson" bruce
         # NOTE: ~ is NOT.
@@ -249,31 +364,18 @@ class ElasticSearchDslClient(object):
         # NOTE: a phase in quotes implies a direct match of that phrase: i.e., "jack nicholson" does not match "jack"
         # NOTE: all <field>: text next <field>: queries into field, i.e., search cast field for "jack nicholson" bruce
         # NOTE: multiple phrases within a <field>: implies OR: i.e., "phrase1" word2 => "phrase1" OR word2
-        # (Q("match_phrase", cast='jack nicholson') | Q("match", cast='bruce')) & Q("bool", filter=[~Q("match", title="bucket")])
-        items = s.lower().split(" ")
-        is_field = [i for i, item in enumerate(items) if ":" in item] + [len(items)]  # makes next line one line
-        items = [" ".join(items[is_field[i]:is_field[i+1]]) for i in range(len(is_field)-1)]
-        components = []
-        for i, item in enumerate(items):
-            q = item.split(":")  # e.g., ~title:bucket ==> is_not=True, q_key=title
-            qfield, qvalue = q[0], ":".join(q[1:])
-            is_not = qfield.startswith("~")
-            field = qfield[1:] if is_not else qfield  # ~title => title   or title => title
-            pattern = '"([^"]*)"'
-            quoted_strings = [g.group(1) for g in re.finditer(pattern, qvalue)]
-            non_quoted_strings = [p.strip() for p in re.sub(pattern, "", qvalue).split(" ") if p.strip() != ""]
-            ops = []
-            for qs in quoted_strings: ops.append(Q(name_or_query="match_phrase", **{field: qs}))
-            for qs in non_quoted_strings: ops.append(Q(name_or_query="match", **{field: qs}))
-            if len(ops) == 0: continue
-            op = ops[0]
-            for o in ops[1:]: op = op.__or__(o)
-            if is_not: op = op.__invert__()
-            components.append(op) if i == 0 else components.append(Q(name_or_query="bool", filter=[op]))
-        if len(components) == 0: raise RuntimeError("No query found.")
-        query = components[0]
-        for c in components[1:]: query = query.__and__(c)
-        return query
+        # NOTE: mapping is dict(field=es_field_cls_name) and plans each clause into scoring or filter context; see plan.
+        return ElasticSearchDslClient.plan_search_bar(s, mapping=mapping).to_query()
+
+    @staticmethod
+    def plan_search_bar(s, mapping=None, name="SwiftData"):
+        """Plans a search bar query so that only analyzed text scores and all exact predicates are cached filters."""
+        # NOTE: Text fields are scored with match and match_phrase; Keyword, Date and numeric fields become term, terms,
+        # and range clauses in the non-scoring filter context: i.e., labels:politics sports => terms, year:>=1980 =>
+        # range, now:2024-01-01..2024-02-01 => range; negations are must_not, which is also non-scoring and cached.
+        # NOTE: with a mapping, unknown fields raise KeyError; with no mapping all fields keep match/match_phrase clauses.
+        # NOTE: parsing is cached by normalized input; see searchbar.py for the query AST and its local compilation.
+        return SearchBarPlan.compile(searchbar.parse(s), mapping=mapping, name=name)
 
     ####################################################################################################################
     # Queries
@@ -285,6 +387,50 @@ class ElasticSearchDslClient(object):
     #     matches = [Q('match', **{field: v}) for v in values]
     #     return Q('bool', should=matches, minimum_should_match=1)
 
+    @staticmethod
+    def perform_raw_query(es, es_index_name, dsl_q, max_results=50, filter_path=None):
+        """Executes queries returning the plain json response; no per-hit Document construction (c.f. perform_dsl_query)"""
+        return ElasticSearchDslClient.perform_raw_search(es, es_index_name, dsl_q, max_results, filter_path).body
+
+    @staticmethod
+    def perform_raw_search(es, es_index_name, dsl_q, max_results=50, filter_path=None, profile=False, sort=None):
+        """As perform_raw_query, but returns the response (with .meta) and profile=True requests the ES query profile"""
+        # NOTE: filter_path trims the response to the hit ids and sources; fewer bytes on the wire and fewer to parse
+        s = Search(index=es_index_name).extra(size=max_results)
+        if dsl_q is not None: s = s.query(dsl_q)
+        if sort is not None: s = s.sort(*sort)
+        if profile: s = s.extra(profile=True)
+        if filter_path is None: filter_path = ["took", "hits.hits._id", "hits.hits._source"] + (["profile"] if profile else [])
+        return es.search(index=es_index_name, body=s.to_dict(), filter_path=filter_path)
+
+    @staticmethod
+    def perform_stats(es, es_index_name, field, dsl_q=None):
+        """Returns dict(count, min, max, avg, sum) of a numeric field over the documents matching dsl_q (all if None)"""
+        body = dict(size=0, aggs=dict(stats=dict(stats=dict(field=field))))
+        if dsl_q is not None: body["query"] = dsl_q.to_dict() if hasattr(dsl_q, "to_dict") else dsl_q
+        return es.search(index=es_index_name, body=body, filter_path=["aggregations"]).body["aggregations"]["stats"]
+
+    @staticmethod
+    def perform_geo_grid(es, es_index_name, field, precision=5, dsl_q=None):
+        """Returns dict(geohash=number of documents) of a geo_point field over the documents matching dsl_q (all if None)"""
+        body = dict(size=0, aggs=dict(grid=dict(geohash_grid=dict(field=field, precision=precision, size=65536))))
+        if dsl_q is not None: body["query"] = dsl_q.to_dict() if hasattr(dsl_q, "to_dict") else dsl_q
+        raw = es.search(index=es_index_name, body=body, filter_path=["aggregations"]).body
+        return {bucket["key"]: bucket["doc_count"] for bucket in raw.get("aggregations", dict()).get("grid", dict()).get("buckets", [])}
+
+    @staticmethod
+    def perform_suggest(es, es_index_name, field, prefix, k=10):
+        """Returns up to k distinct values of the completion multi-field field.suggest which start with prefix"""
+        suggest = dict(completion=dict(prefix=prefix, completion=dict(field=f"{field}.suggest", size=k, skip_duplicates=True)))
+        raw = es.search(index=es_index_name, body=dict(suggest=suggest, _source=False),
+                        filter_path=["suggest.completion.options.text"]).body
+        return [option["text"] for entry in raw.get("suggest", dict()).get("completion", []) for option in entry.get("options", [])]
+
+    @staticmethod
+    def hits_of(raw):
+        """Returns the list of hits of a raw search response (filter_path omits hits entirely when there are none)"""
+        return raw.get("hits", dict()).get("hits", [])
+
     @staticmethod
     def perform_dsl_query(es, es_cls, dsl_q, max_results=50):
         """Executes queries using the elasticsearch-dsl query structured objects"""
@@ -297,3 +443,4 @@ class ElasticSearchDslClient(object):
             d.meta.id = h["_id"]
             es_objs.append(d)
         return es_objs
+
@@ -0,0 +1,392 @@
+from cloudnode.base.core.elasticsearch import timebuckets
+from elasticsearch_dsl import Q
+import dataclasses
+import functools
+import datetime
+import dateparser
+import json
+import re
+
+import logging
+logger = logging.getLogger(__name__)
+
+# The search bar is parsed once into a small typed AST which is cached by its normalized string, i.e., the whitespace of
+# the search bar is collapsed, so that repeated searches skip tokenizing and regex work entirely. The AST does not know
+# about any backend: it is compiled into an elasticsearch-dsl query (see SearchBarPlan, which plans each clause into the
+# scoring or the cached filter context) or into a predicate over records held in the local in-process index (see
+# compile_to_local). Both compilers take mapping=dict(field=es_field_cls_name) and validate the fields up front, so that
+# a misspelled field is rejected before any network round trip.
+#
+# SYNTAX: free text "a phrase" field:value "a phrase" ~field:value field:>=5 field:1..3 field:2024-01-01..*
+# NOTE: free text before the first field searches all analyzed text fields; ~ is NOT; AND is implied between fields;
+# multiple values within a field are OR; quoted values are phrases (text) or exact values (keywords); ranges are parsed
+# from >x, >=x, <x, <=x and x..y (either side may be *) but only applied to Date, Integer and Float fields. The keys of
+# flattened fields (sd.flags) are fields of their own as field.key, i.e., flags.scraped:done, matched as exact values.
+# Windows on timestamps with buckets (see timebuckets) compile into terms over the hidden bucket fields, not ranges.
+# NOW: bounds relative to now (now-1d, yesterday) keep windows as ranges, even on timestamps with buckets: ElasticSearch
+# resolves their date math itself, and the local index resolves them into UTC dates when a query is compiled; only the
+# AST of such queries is cached, and they are compiled again each time they run.
+
+
+@dataclasses.dataclass(frozen=True)
+class Value:
+    text: str
+    phrase: bool = False  # quoted in the search bar
+
+
+@dataclasses.dataclass(frozen=True)
+class Range:
+    text: str             # as written in the search bar, used as a plain value for fields that are not rangeable
+    gte: str = None
+    gt: str = None
+    lte: str = None
+    lt: str = None
+
+    def bounds(self): return {k: v for k, v in dataclasses.asdict(self).items() if k != "text" and v is not None}
+
+
+@dataclasses.dataclass(frozen=True)
+class FieldClause:
+    field: str
+    values: tuple         # of Value and Range; OR between values
+    negate: bool = False
+
+
+@dataclasses.dataclass(frozen=True)
+class SearchBarQuery:
+    s: str                # the normalized search bar
+    text: tuple           # of Value; free text searched across all analyzed text fields
+    clauses: tuple        # of FieldClause; AND between clauses
+
+    def fields(self): return [c.field for c in self.clauses]
+
+    def is_relative(self):
+        """True if a range bound depends on when it is evaluated (now-1d, yesterday); its compiled forms are not cached."""
+        return any(is_relative_bound(bound) for c in self.clauses for v in c.values if isinstance(v, Range) for bound in v.bounds().values())
+
+
+def is_relative_bound(bound):
+    """True for bounds which are neither numbers nor iso dates, i.e., date math relative to now or words for dateparser."""
+    if str(bound).lower().startswith("now"): return True
+    try:
+        float(bound)
+        return False
+    except ValueError: pass
+    try:
+        datetime.datetime.fromisoformat(str(bound))
+        return False
+    except ValueError: return True
+
+
+def normalize(s):
+    """Normalized form of a search bar; used as the cache key of parse."""
+    return " ".join(s.split())
+
+
+def parse(s):
+    """Parses a search bar into its SearchBarQuery; cached by normalized input."""
+    return _parse_normalized(normalize(s))
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_normalized(s):
+    items = s.split(" ") if len(s) != 0 else []
+    is_field = [i for i, item in enumerate(items) if ":" in item and not item.startswith('"')] + [len(items)]
+    text = _parse_values(" ".join(items[:is_field[0]]), ranges=False)
+    clauses = []
+    for i in range(len(is_field) - 1):
+        item = " ".join(items[is_field[i]:is_field[i+1]])
+        qfield, qvalue = item.split(":", 1)  # e.g., ~title:bucket ==> negate=True, field=title
+        negate = qfield.startswith("~")
+        values = _parse_values(qvalue, ranges=True)
+        if len(values) == 0: continue
+        clauses.append(FieldClause(field=qfield[1:] if negate else qfield, values=values, negate=negate))
+    if len(text) + len(clauses) == 0: raise RuntimeError("No query found.")
+    return SearchBarQuery(s=s, text=text, clauses=tuple(clauses))
+
+
+_quoted = re.compile('"([^"]*)"')
+_range_op = re.compile(r"^(>=|<=|>|<)(.+)$")
+_range_names = {">=": "gte", "<=": "lte", ">": "gt", "<": "lt"}
+
+
+def _parse_values(s, ranges=True):
+    values = [Value(text=g.group(1), phrase=True) for g in _quoted.finditer(s) if g.group(1).strip() != ""]
+    for p in _quoted.sub("", s).split(" "):
+        if p.strip() == "": continue
+        as_range = _parse_range(p) if ranges else None
+        values.append(Value(text=p) if as_range is None else as_range)
+    return tuple(values)
+
+
+def _parse_range(p):
+    match = _range_op.match(p)
+    if match is not None: return Range(text=p, **{_range_names[match.group(1)]: match.group(2)})
+    if ".." in p:
+        lower, upper = p.split("..", 1)
+        lower, upper = (None if lower in ["", "*"] else lower), (None if upper in ["", "*"] else upper)
+        if lower is not None or upper is not None: return Range(text=p, gte=lower, lte=upper)
+    return None
+
+
+def resolve_fields(query, mapping, name="SwiftData"):
+    """Maps (case-insensitively) the fields of query into mapping fields; raises KeyError for any unknown field."""
+    # NOTE: field.key of a flattened field resolves to the case-insensitive field and the key as written (keys are exact)
+    by_lower = {f.lower(): f for f in mapping}
+    resolved, unknown = dict(), []
+    for f in query.fields():
+        base, _, key = f.partition(".")
+        if f.lower() in by_lower: resolved[f] = by_lower[f.lower()]
+        elif key != "" and mapping.get(by_lower.get(base.lower())) in keyed_kinds: resolved[f] = f"{by_lower[base.lower()]}.{key}"
+        else: unknown.append(f)
+    if len(unknown) != 0: raise KeyError(f"search bar fields {unknown} not found in {name}: fields={list(mapping.keys())}")
+    return resolved
+
+
+keyed_kinds = ["Flattened"]
+
+
+def kind_of(field, mapping):
+    """The kind of a resolved field; the keys of flattened fields are exact values (Keyword)."""
+    return mapping[field] if field in mapping else "Keyword"
+
+
+########################################################################################################################
+# compile to elasticsearch-dsl
+########################################################################################################################
+
+
+class SearchBarPlan(object):
+    """A search bar query plan: analyzed text clauses score in query context; exact predicates are cached filters."""
+
+    filter_kinds = ["Keyword", "Date", "Integer", "Float", "Boolean", "Flattened"]
+    range_kinds = ["Date", "Integer", "Float"]
+
+    def __init__(self, s, buckets=None):
+        self.s = s
+        self.buckets = dict() if buckets is None else buckets  # map from Date field => [(width, seconds)]
+        self.must, self.filter, self.must_not = [], [], []
+        self.windows = dict()  # map from Date field => [[bounds]] of its window clauses (an OR of bounds each); for routing
+        self.steps = []  # (context, field, kind, q) in the order planned; for explain
+
+    @staticmethod
+    def compile(query, mapping=None, name="SwiftData", buckets=None):
+        """Compiles a SearchBarQuery; with mapping=None fields are not validated and are scored as match clauses;
+        buckets=dict(field=[(width, seconds)]) of the Date fields with time buckets."""
+        plan = SearchBarPlan(query.s, buckets=buckets)
+        fields = {f: f for f in query.fields()} if mapping is None else resolve_fields(query, mapping, name=name)
+        if len(query.text) != 0:
+            text_fields = [] if mapping is None else [f for f, kind in mapping.items() if kind == "Text"]
+            plan.add_text_clause(text_fields, query.text)
+        for clause in query.clauses:
+            field = fields[clause.field]
+            plan.add_field_clause(field, None if mapping is None else kind_of(field, mapping), clause.values, clause.negate)
+        return plan
+
+    def add_text_clause(self, fields, values):
+        """Plans free text as multi_match across the analyzed text fields (all fields if empty) in scoring context."""
+        kwargs = dict() if len(fields) == 0 else dict(fields=fields)
+        ops = [Q("multi_match", query=v.text, type="phrase", **kwargs) for v in values if v.phrase]
+        words = [v.text for v in values if not v.phrase]
+        if len(words) != 0: ops.append(Q("multi_match", query=" ".join(words), **kwargs))
+        op = ops[0] if len(ops) == 1 else Q("bool", should=ops, minimum_should_match=1)
+        self.must.append(op)
+        self.steps.append(("must", "*", "Text", op))
+        return self
+
+    def add_field_clause(self, field, kind, values, is_not=False):
+        """Plans one <field>:<values> clause; multiple values within a field are an OR of its values."""
+        if kind == "Date" and not is_not and all(isinstance(v, Range) for v in values):
+            self.windows.setdefault(field, []).append([v.bounds() for v in values])
+        if kind in SearchBarPlan.filter_kinds:
+            is_range = kind in SearchBarPlan.range_kinds
+            ranges = [self.range_op(field, v) for v in values if is_range and isinstance(v, Range)]
+            terms = [v.text for v in values if not (is_range and isinstance(v, Range))]
+            if len(terms) == 1: ranges.append(Q("term", **{field: terms[0]}))
+            elif len(terms) > 1: ranges.append(Q("terms", **{field: terms}))
+            ops, context = ranges, "must_not" if is_not else "filter"
+        else:
+            ops = [Q("match_phrase" if isinstance(v, Value) and v.phrase else "match", **{field: v.text}) for v in values]
+            context = "must_not" if is_not else "must"
+        op = ops[0] if len(ops) == 1 else Q("bool", should=ops, minimum_should_match=1)
+        getattr(self, context).append(op)
+        self.steps.append((context, field, "unmapped" if kind is None else kind, op))
+        return self
+
+    def range_op(self, field, value):
+        """A range, or for a window on a Date field with buckets, terms of its whole buckets (and ranges of the edges)"""
+        covered = None if field not in self.buckets else timebuckets.cover(value.bounds(), self.buckets[field])
+        if covered is None: return Q("range", **{field: value.bounds()})
+        terms, edges = covered
+        ops = [Q("terms", **{timebuckets.bucket_field(field, width): keys}) for width, keys in terms.items()]
+        ops += [Q("bool", filter=[Q("term", **{timebuckets.bucket_field(field, width): key}), Q("range", **{field: bounds})])
+                for width, key, bounds in edges]
+        return ops[0] if len(ops) == 1 else Q("bool", should=ops, minimum_should_match=1)
+
+    def to_query(self):
+        """Combines planned clauses; a single scoring clause is returned as is, otherwise as one bool query."""
+        if len(self.steps) == 0: raise RuntimeError("No query found.")
+        if len(self.must) == 1 and len(self.filter) == 0 and len(self.must_not) == 0: return self.must[0]
+        parts = dict(must=self.must, filter=self.filter, must_not=self.must_not)
+        return Q("bool", **{context: ops for context, ops in parts.items() if len(ops) != 0})
+
+    def explain(self):
+        """Human readable plan: which clauses score (must), which are cached filters (filter and must_not)."""
+        lines = [f"search_bar plan: {self.s}"]
+        for context, field, kind, op in self.steps:
+            lines.append(f"{context:>8s} {field} ({kind}): {json.dumps(op.to_dict())}")
+        return "\n".join(lines)
+
+
+########################################################################################################################
+# compile to the local in-process index
+########################################################################################################################
+
+
+_token = re.compile(r"\w+")
+
+
+def analyze(value):
+    """Approximates the ElasticSearch standard analyzer for local use: lowercased unicode word tokens."""
+    if value is None: return []
+    if isinstance(value, (list, tuple)): return [t for v in value for t in analyze(v)]
+    return _token.findall(str(value).lower())
+
+
+def compile_to_local(query, mapping, name="SwiftData", buckets=None):
+    """Compiles a SearchBarQuery into predicate(values, tokens) over a record's dict of values and analyzed tokens."""
+    # NOTE: tokens is dict(field=analyze(value)) of the Text fields, kept by the local index so that no record is
+    # re-analyzed per query; matching follows ES defaults: match is any token, match_phrase is contiguous tokens.
+    fields = resolve_fields(query, mapping, name=name)
+    tests = []
+    if len(query.text) != 0:
+        text_fields = [f for f, kind in mapping.items() if kind == "Text"]
+        matchers = [_local_text_matcher(v) for v in query.text]
+        tests.append(lambda values, tokens: any(m(tokens.get(f, [])) for f in text_fields for m in matchers))
+    for clause in query.clauses:
+        field = fields[clause.field]
+        tests.append(_local_clause(field, kind_of(field, mapping), clause, keyed=field not in mapping))
+    predicate = lambda values, tokens: all(test(values, tokens) for test in tests)
+    predicate.ranges = _local_ranges(query, fields, mapping)
+    predicate.keyed = _local_keyed(query, fields, mapping)
+    predicate.windows = _local_windows(query, fields, dict() if buckets is None else buckets)
+    return predicate
+
+
+def _local_keyed(query, fields, mapping):
+    """Returns [(field, key, [values])] of the exact clauses on keys of flattened fields (an OR of values each), which a
+    local index may look up in its per-key index before evaluating the predicate; negated clauses are left to it."""
+    keyed = []
+    for clause in query.clauses:
+        field = fields[clause.field]
+        if field in mapping or clause.negate: continue
+        base, key = field.split(".", 1)
+        keyed.append((base, key, [v.text for v in clause.values]))
+    return keyed
+
+
+def _local_ranges(query, fields, mapping):
+    """Returns [(field, [bounds])] of the numeric range clauses (an OR of bounds each) which a local index may apply to
+    its numeric columns before evaluating the predicate; clauses with negation or plain values are left to it."""
+    ranges = []
+    for clause in query.clauses:
+        field = fields[clause.field]
+        if kind_of(field, mapping) not in ["Integer", "Float"] or clause.negate: continue
+        if not all(isinstance(v, Range) for v in clause.values): continue
+        try: ranges.append((field, [{op: float(bound) for op, bound in v.bounds().items()} for v in clause.values]))
+        except ValueError: continue
+    return ranges
+
+
+def _local_windows(query, fields, buckets):
+    """Returns [(field, [dict(width=[keys])])] of the window clauses on Date fields with buckets (an OR of the outer
+    bucket covers each), which a local index may look up before evaluating the predicate; as _local_ranges."""
+    windows = []
+    for clause in query.clauses:
+        field = fields[clause.field]
+        if field not in buckets or clause.negate or not all(isinstance(v, Range) for v in clause.values): continue
+        covers = [timebuckets.cover(v.bounds(), buckets[field], outer=True) for v in clause.values]
+        if all(c is not None for c in covers): windows.append((field, [terms for terms, _ in covers]))
+    return windows
+
+
+def _local_clause(field, kind, clause, keyed=False):
+    if kind == "Text":
+        matchers = [_local_text_matcher(v) for v in clause.values]
+        test = lambda values, tokens: any(m(tokens.get(field, [])) for m in matchers)
+    else:
+        matchers = [_local_value_matcher(kind, v) for v in clause.values]
+        base, _, key = field.partition(".")
+        def test(values, tokens):
+            value = (values.get(base) or dict()).get(key) if keyed else values.get(field)
+            if kind == "Flattened": value = list(value.values()) if isinstance(value, dict) else value  # any key
+            candidates = value if isinstance(value, (list, tuple)) and kind not in ["DenseVector", "GeoPoint"] else [value]
+            return any(m(c) for c in candidates if c is not None for m in matchers)
+    return (lambda values, tokens: not test(values, tokens)) if clause.negate else test
+
+
+def _local_text_matcher(value):
+    query_tokens = analyze(value.text)
+    if isinstance(value, Value) and value.phrase:
+        n = len(query_tokens)
+        return lambda tokens: n != 0 and any(tokens[i:i+n] == query_tokens for i in range(len(tokens) - n + 1))
+    query_tokens = set(query_tokens)
+    return lambda tokens: not query_tokens.isdisjoint(tokens)
+
+
+def _local_value_matcher(kind, value):
+    coerce = _local_coercions.get(kind, str)
+    if isinstance(value, Range) and kind in SearchBarPlan.range_kinds:
+        bounds = [(op, _local_bound(kind, op, bound)) for op, bound in value.bounds().items()]
+        return lambda v: all(_compare[op](coerce(v), bound) for op, bound in bounds)
+    expected = coerce(value.text)
+    return lambda v: coerce(v) == expected
+
+
+def _local_bound(kind, op, bound):
+    """A range bound as compared locally; gt and lte bounds of dates round up, as in ElasticSearch (see date_math)."""
+    if kind == "Date": return date_math(bound, round_up=op in ["lte", "gt"])
+    return _local_coercions.get(kind, str)(bound)
+
+
+_date_math = re.compile(r"^now(?P<ops>([+-]\d+[smhdwMy])*)(/(?P<round>[smhdwMy]))?$")
+_date_units = dict(s=1, m=60, h=3600, d=86400, w=7*86400, M=30*86400, y=365*86400)  # M and y are approximate
+_dateparser_settings = dict(TIMEZONE="UTC", RETURN_AS_TIMEZONE_AWARE=True)  # NOTE: words are resolved in UTC, not host time
+
+
+def date_math(value, round_up=False):
+    """Parses dates, including ElasticSearch date math relative to now: i.e., now, now-1d, now-1h/d, now/d; round_up
+    (the gt and lte bounds of ranges) rounds a date without a time up to the end of its day, as ElasticSearch does."""
+    match = _date_math.match(str(value))
+    if match is None:
+        date = as_utc_datetime(value)
+        if round_up and timebuckets.is_date_only(value): date += datetime.timedelta(days=1, milliseconds=-1)
+        return date
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for sign, n, unit in re.findall(r"([+-])(\d+)([smhdwMy])", match.group("ops") or ""):
+        now += datetime.timedelta(seconds=(1 if sign == "+" else -1) * int(n) * _date_units[unit])
+    if match.group("round") is not None:
+        unit = _date_units[match.group("round")]
+        floor = datetime.datetime.fromtimestamp(now.timestamp() // unit * unit, tz=datetime.timezone.utc)
+        now = floor + datetime.timedelta(seconds=unit, milliseconds=-1) if round_up else floor
+    return now
+
+
+def as_utc_datetime(value):
+    """Parses a date into an aware datetime: iso dates (UTC if naive), date math (see date_math), and words for dateparser
+    (yesterday, 2 hours ago), which are resolved in UTC so that windows do not move with the timezone of the host"""
+    if not isinstance(value, datetime.datetime):
+        if _date_math.match(str(value)) is not None: return date_math(value)
+        try: parsed = datetime.datetime.fromisoformat(str(value))
+        except ValueError: parsed = dateparser.parse(str(value), settings=_dateparser_settings)
+        if parsed is None: raise ValueError(f"failed to parse date [{value}]")
+        value = parsed
+    return value if value.tzinfo is not None else value.replace(tzinfo=datetime.timezone.utc)
+
+
+def _as_boolean(value):
+    return value if isinstance(value, bool) else str(value).lower() in ["true", "1", "yes"]
+
+
+_local_coercions = dict(Integer=float, Float=float, Date=as_utc_datetime, Boolean=_as_boolean)
+_compare = dict(gte=lambda a, b: a >= b, gt=lambda a, b: a > b, lte=lambda a, b: a <= b, lt=lambda a, b: a < b)
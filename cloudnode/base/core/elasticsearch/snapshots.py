@@ -0,0 +1,180 @@
+from cloudnode.base.core.lightweight_utilities.parallel import ScheduledRun
+import elasticsearch.exceptions
+import threading
+import datetime
+import weakref
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+# The SnapshotManager takes scheduled snapshots of ElasticSearch into one fs repository (i.e., of one applet) and prunes
+# them by retention. ElasticSearch snapshots are incremental: each snapshot only copies the segments which no previous
+# snapshot of the repository holds, and deleting a snapshot only deletes the segments no other snapshot references, so
+# frequent snapshots with retention cost little more than the changes between them.
+#
+# SCHEDULE: the manager is a ScheduledRun of .run() so that it runs from the Infrastructure cron loop (see
+# Infrastructure.add_cron); each run starts the snapshot without waiting for it, skips if the previous is still in
+# progress, then prunes. Only snapshots named with the manager's prefix are pruned; manual ones are kept.
+# RESTORE: selected indices are closed in one request, restored in one request without waiting, and RestoreProgress
+# polls _recovery in the background so that callers may .wait() or read .progress() for bytes/s and the time remaining.
+
+
+class SnapshotManager(ScheduledRun):
+    """Scheduled incremental snapshots of one fs repository with retention, and index-selective restores."""
+
+    registered = weakref.WeakKeyDictionary()  # map from client => {(repository, location)} registered through it
+    registered_lock = threading.Lock()
+
+    def __init__(self, client, repository, location, every_s=3600, keep_last=24, max_age_s=None, indices=None,
+                 prefix="scheduled-"):
+        self.client = client
+        self.repository = repository.lower()  # NOTE: ElasticSearch requires lowercase repository and snapshot names
+        self.location = location
+        self.keep_last = keep_last
+        self.max_age_s = max_age_s
+        self.indices = ["*"] if indices is None else indices
+        self.prefix = prefix
+        super().__init__(self.run, f"snapshot={self.repository}", every_s)
+
+    def ensure_repository(self):
+        """Registers the repository once per client, rather than before every snapshot call."""
+        # NOTE: per client, since a client of a restarted backend is a new server (i.e., a rebuilt container or engine)
+        key = (self.repository, self.location)
+        with SnapshotManager.registered_lock:
+            registered = SnapshotManager.registered.setdefault(self.client, set())
+            if key in registered: return self
+            self.client.snapshot_directory_set(self.location, self.repository)
+            registered.add(key)
+        return self
+
+    ####################################################################################################################
+    # snapshots and retention
+    ####################################################################################################################
+
+    def save(self, name=None, indices=None, wait=False):
+        """Starts an incremental snapshot; returns its name. wait=True blocks until it has completed."""
+        self.ensure_repository()
+        if name is None: name = f"{self.prefix}{datetime.datetime.now(datetime.timezone.utc):%Y.%m.%d-%H.%M.%S}"
+        name = name.lower()
+        indices = self.indices if indices is None else indices
+        data = dict(indices=",".join(indices), include_global_state=False)
+        path = f"/_snapshot/{self.repository}/{name}?wait_for_completion={str(wait).lower()}"
+        logger.info(f"SNAPSHOT SAVE {self.repository} {name} indices={indices}")
+        self.client.perform_request("PUT", path, data=data)
+        return name
+
+    def in_progress(self):
+        """Returns the names of the snapshots of the repository that are currently running."""
+        self.ensure_repository()
+        results = self.client.perform_request("GET", f"/_snapshot/{self.repository}/_current")
+        return [s["snapshot"] for s in results.body.get("snapshots", [])]
+
+    def list(self):
+        """Returns dict(snapshot, state, start_time_in_millis, indices) of all snapshots, latest first."""
+        self.ensure_repository()
+        results = self.client.perform_request("GET", f"/_snapshot/{self.repository}/*?sort=start_time&order=desc")
+        return results.body.get("snapshots", [])
+
+    def latest(self, state="SUCCESS"):
+        """Returns the name of the most recent snapshot in state, or None."""
+        snapshots = [s for s in self.list() if state is None or s.get("state") == state]
+        return snapshots[0]["snapshot"] if len(snapshots) != 0 else None
+
+    def prune(self):
+        """Deletes the manager's snapshots beyond keep_last or older than max_age_s, in one request; returns them."""
+        now_ms = time.time() * 1000
+        owned = [s for s in self.list() if s["snapshot"].startswith(self.prefix) and s.get("state") != "IN_PROGRESS"]
+        expired = owned[self.keep_last:] if self.keep_last is not None else []
+        if self.max_age_s is not None:
+            expired += [s for s in owned[:self.keep_last] if now_ms - s["start_time_in_millis"] > 1000 * self.max_age_s]
+        names = [s["snapshot"] for s in expired]
+        if len(names) == 0: return names
+        logger.info(f"SNAPSHOT PRUNE {self.repository} n={len(names)}: {names}")
+        self.client.perform_request("DELETE", f"/_snapshot/{self.repository}/{','.join(names)}")
+        return names
+
+    def run(self):
+        """One scheduled run: starts a snapshot unless one is still running, then applies retention."""
+        try:
+            running = self.in_progress()
+            if len(running) != 0: logger.warning(f"SNAPSHOT {self.repository} still in progress: {running}; skipping")
+            else: self.save()
+            self.prune()
+        except elasticsearch.exceptions.ApiError as e:
+            logger.error(f"SNAPSHOT scheduled run of {self.repository} failed: {e}", exc_info=True)
+
+    ####################################################################################################################
+    # restore
+    ####################################################################################################################
+
+    def restore(self, name=None, indices=None, wait=False, poll_s=1.0):
+        """Restores indices (patterns; all if None) from snapshot name (latest if None); returns a RestoreProgress."""
+        self.ensure_repository()
+        name = self.latest() if name is None else name.lower()
+        if name is None: raise RuntimeError(f"no snapshot to restore in repository {self.repository}")
+        indices = ["*"] if indices is None else indices
+        # NOTE: restoring into an open index fails: the open indices selected are closed by name, in one request
+        self.client.indices_close(indices)
+        logger.info(f"SNAPSHOT RESTORE {self.repository} {name} indices={indices}")
+        data = dict(indices=",".join(indices), include_global_state=False)
+        response = self.client.perform_request("POST", f"/_snapshot/{self.repository}/{name}/_restore", data=data)
+        restored = response.body.get("snapshot", dict()).get("indices")
+        progress = RestoreProgress(self.client, name, indices if restored is None else restored, poll_s=poll_s).start()
+        return progress.wait() if wait else progress
+
+
+class RestoreProgress(object):
+    """Polls _recovery of the restoring indices in the background: bytes recovered, bytes/s and time remaining."""
+
+    def __init__(self, client, snapshot, indices, poll_s=1.0):
+        self.client = client
+        self.snapshot = snapshot
+        self.indices = indices
+        self.poll_s = poll_s
+        self.started_s = time.time()
+        self.finished_s = None
+        self.status = dict(total_bytes=0, recovered_bytes=0, shards=0, shards_done=0)
+        self.done = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.__poll, name=f"restore={self.snapshot}", daemon=True)
+        self.thread.start()
+        return self
+
+    def wait(self, timeout_s=None):
+        """Blocks until all shards are restored; returns the final progress."""
+        if not self.done.wait(timeout_s): raise TimeoutError(f"restore of {self.snapshot} not done after {timeout_s}s")
+        return self.progress()
+
+    def progress(self):
+        """Returns dict(done, recovered_bytes, total_bytes, ratio, bytes_per_s, mb_per_s, elapsed_s, remaining_s)."""
+        status = dict(self.status)
+        elapsed_s = (self.finished_s or time.time()) - self.started_s
+        bytes_per_s = status["recovered_bytes"] / max(1e-9, elapsed_s)
+        remaining = status["total_bytes"] - status["recovered_bytes"]
+        return status | dict(snapshot=self.snapshot, done=self.done.is_set(), elapsed_s=elapsed_s,
+                             ratio=status["recovered_bytes"] / max(1, status["total_bytes"]),
+                             bytes_per_s=bytes_per_s, mb_per_s=bytes_per_s / 2**20,
+                             remaining_s=0.0 if self.done.is_set() else remaining / max(1e-9, bytes_per_s))
+
+    def __poll(self):
+        while not self.done.is_set():
+            try:
+                response = self.client.perform_request("GET", f"/{','.join(self.indices)}/_recovery")
+                shards = [shard for index in response.body.values() for shard in index.get("shards", [])
+                          if shard.get("type") == "SNAPSHOT"]
+                self.status = dict(total_bytes=sum(s["index"]["size"]["total_in_bytes"] for s in shards),
+                                   recovered_bytes=sum(s["index"]["size"]["recovered_in_bytes"] for s in shards),
+                                   shards=len(shards), shards_done=sum(1 for s in shards if s["stage"] == "DONE"))
+                if len(shards) != 0 and self.status["shards_done"] == len(shards):
+                    self.finished_s = time.time()
+                    self.done.set()
+                    p = self.progress()
+                    logger.info(f"RESTORE {self.snapshot} done: {p['total_bytes'] / 2**20:.1f}MB in {p['elapsed_s']:.1f}s "
+                                f"({p['mb_per_s']:.1f}MB/s) over {len(shards)} shards")
+                    return
+            except elasticsearch.exceptions.ApiError as e:
+                logger.warning(f"RESTORE {self.snapshot} progress unavailable: {e}")
+            time.sleep(self.poll_s)
@@ -0,0 +1,99 @@
+import datetime
+import math
+import re
+
+# Time buckets turn window filters on timestamps into exact matches, as suggested in the notes of search.py: a timestamp
+# declared with sd.timestamp(buckets=["5m", "1h", "1d"]) also writes one hidden keyword field per bucket width (i.e.,
+# now_bucket_1h) holding the start of the bucket the timestamp falls in, as epoch seconds. A window such as
+# now:2024-01-01..2024-01-03 is then covered by the fewest whole buckets (two 1d keys instead of 576 5m keys) and is a
+# terms filter on keywords: postings lookups which ElasticSearch caches per segment, instead of a range over points.
+#
+# EDGES: windows whose bounds are not aligned to the finest bucket keep a range within the partial edge buckets only (the
+# term of the edge bucket and the range, so that the range only tests the records of that bucket): the rewrite is exact;
+# windows smaller than a bucket, open-ended or relative (date math, i.e., now-1d, which would be frozen into the cached
+# plan) are left as plain ranges. The local index looks the buckets up by key (the outer cover, edges included) for its
+# candidates and leaves exactness to the predicate.
+# DAYS: as ElasticSearch rounds a date without a time, a date-only lte or gt bound is the end of its day (lte 2024-01-03
+# includes all of January 3rd) and a date-only gte or lt bound is its start.
+
+_width = re.compile(r"^(\d+)([smhd])$")
+_date_only = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+_seconds = dict(s=1, m=60, h=3600, d=86400)
+max_terms = 1024  # windows which would need more bucket keys than this are left as plain ranges
+
+
+def parse_width(width):
+    """Seconds of a bucket width; i.e., "5m" is 300. Units are s, m, h and d (days are UTC days)."""
+    match = _width.match(str(width))
+    if match is None or int(match.group(1)) == 0: raise ValueError(f"bucket width must be as 30s, 5m, 1h or 1d: {width}")
+    return int(match.group(1)) * _seconds[match.group(2)]
+
+
+def widths_of(buckets):
+    """Returns [(width, seconds)], the widest first; every width must be a multiple of the finest, so that they tile."""
+    widths = sorted(((width, parse_width(width)) for width in buckets), key=lambda item: -item[1])
+    if len(widths) == 0: raise ValueError("buckets must not be empty")
+    if any(seconds % widths[-1][1] != 0 for _, seconds in widths):
+        raise ValueError(f"bucket widths must be multiples of the finest width {widths[-1][0]}: {list(buckets)}")
+    return widths
+
+
+def bucket_field(field, width):
+    """The hidden keyword field of the buckets of width of field; single underscores, as elasticsearch-dsl reads __ as ."""
+    return f"{field}_bucket_{width}"
+
+
+def epoch_of(value):
+    """Epoch seconds of a datetime or isoformat string; naive values are UTC. Raises ValueError for anything else."""
+    if not isinstance(value, datetime.datetime): value = datetime.datetime.fromisoformat(str(value))
+    return (value if value.tzinfo is not None else value.replace(tzinfo=datetime.timezone.utc)).timestamp()
+
+
+def epoch_of_bound(op, bound):
+    """Epoch seconds of a range bound of op (gte, gt, lte or lt); a date-only lte or gt bound is the end of its day."""
+    epoch = epoch_of(bound)
+    return epoch + 86400 - 1e-3 if op in ["lte", "gt"] and is_date_only(bound) else epoch
+
+
+def is_date_only(bound): return isinstance(bound, str) and _date_only.match(bound) is not None
+
+
+def iso_of(epoch): return datetime.datetime.fromtimestamp(epoch, tz=datetime.timezone.utc).isoformat()
+
+
+def bucket_keys(value, seconds):
+    """The bucket keys of a timestamp (or list of them) in buckets of seconds; [] for None."""
+    if value is None: return []
+    values = value if isinstance(value, (list, tuple)) else [value]
+    return [str(int(epoch_of(v) // seconds * seconds)) for v in values if v is not None]
+
+
+def cover(bounds, widths, outer=False):
+    """Covers the window of range bounds (gte or gt, and lte or lt) with the fewest whole buckets of widths: returns
+    (dict(width=[keys]), [(width, key, range bounds)] of the partial edge buckets) or None if the window is not rewritable.
+    outer=True also covers the partial edge buckets by keys, a superset of the window, and returns no edges."""
+    lower_op = "gte" if "gte" in bounds else "gt" if "gt" in bounds else None
+    upper_op = "lt" if "lt" in bounds else "lte" if "lte" in bounds else None
+    if lower_op is None or upper_op is None: return None
+    try: a, b = epoch_of_bound(lower_op, bounds[lower_op]), epoch_of_bound(upper_op, bounds[upper_op])
+    except (TypeError, ValueError): return None
+    finest, widest = widths[-1][1], widths[0][1]
+    if outer: start, end = math.floor(a / finest) * finest, math.floor(b / finest) * finest + finest
+    else: start, end = math.ceil(a / finest) * finest + (finest if lower_op == "gt" and a % finest == 0 else 0), math.floor(b / finest) * finest
+    if start >= end or (end - start) / widest > max_terms: return None
+    terms = dict()
+    for width, key in _tile(start, end, widths): terms.setdefault(width, []).append(str(key))
+    if sum(len(keys) for keys in terms.values()) > max_terms: return None
+    edges, finest_width = [], widths[-1][0]
+    if not outer and start > a: edges.append((finest_width, str(start - finest), {lower_op: bounds[lower_op], "lt": iso_of(start)}))
+    if not outer and (end < b or upper_op == "lte"): edges.append((finest_width, str(end), {"gte": iso_of(end), upper_op: bounds[upper_op]}))
+    return terms, edges
+
+
+def _tile(start, end, widths):
+    """[(width, key)] of the widest aligned buckets within [start, end), recursing into the narrower widths at the sides."""
+    if start >= end or len(widths) == 0: return []
+    (width, seconds), narrower = widths[0], widths[1:]
+    s, e = math.ceil(start / seconds) * seconds, math.floor(end / seconds) * seconds
+    if s >= e: return _tile(start, end, narrower)
+    return _tile(start, s, narrower) + [(width, key) for key in range(s, e, seconds)] + _tile(e, end, narrower)
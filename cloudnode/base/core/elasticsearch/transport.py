@@ -0,0 +1,155 @@
+from elastic_transport import Urllib3HttpNode
+import dataclasses
+import threading
+import gzip
+import time
+
+import logging
+logger = logging.getLogger(__name__)
+
+# The transport profile tunes the HTTP transport between SwiftData and ElasticSearch. The default Elasticsearch client
+# keeps connections_per_node=10 connections, does not compress, does not back off and only retries on connection errors
+# and 502/503/504, so under concurrent servlet load requests queue for a connection behind a small pool and bulk bodies
+# travel uncompressed. TransportProfile sizes the pool to the servlet concurrency, gzips large request bodies (bulk),
+# turns sniffing off (a single node behind a known address; sniffing only adds requests) and retries 429 and 503 with
+# exponential backoff (honoring Retry-After) so that a busy cluster is given time to drain its queues.
+#
+# METRICS: PooledHttpNode counts each request through TransportMetrics: in_flight against pool_size is the utilization
+# of the pool; saturated counts requests which found all connections busy, i.e., which had to wait for one, so a growing
+# saturated count means connections_per_node is too small for the concurrency of the servlet.
+
+
+@dataclasses.dataclass
+class TransportProfile:
+    connections_per_node: int = 10     # size of the connection pool; as many as the concurrent servlet requests
+    request_timeout: float = 10.0      # seconds
+    gzip: bool = True                  # compresses request bodies of at least compress_min_bytes, and bulk bodies
+    compress_min_bytes: int = 4096
+    sniff: bool = False                # sniffing is only useful for multi-node clusters without a load balancer
+    max_retries: int = 3
+    retry_on_status: tuple = (429, 503)
+    retry_on_timeout: bool = True
+    initial_backoff_s: float = 0.1     # doubles on each consecutive 429/503 of a thread, up to max_backoff_s
+    max_backoff_s: float = 5.0
+    per_thread: bool = False           # each thread owns a client with its own pool of connections_per_node
+
+    @staticmethod
+    def for_concurrency(n_threads, **kwargs):
+        """Returns the profile for a servlet serving n_threads concurrent requests."""
+        return TransportProfile(connections_per_node=max(1, n_threads), **kwargs)
+
+    def client_kwargs(self, node_class):
+        """The Elasticsearch(...) keyword arguments of this profile."""
+        return dict(node_class=node_class, connections_per_node=self.connections_per_node,
+                    request_timeout=self.request_timeout, max_retries=self.max_retries,
+                    retry_on_status=tuple(self.retry_on_status), retry_on_timeout=self.retry_on_timeout,
+                    sniff_on_start=self.sniff, sniff_on_node_failure=self.sniff,
+                    http_compress=False)  # NOTE: compression is by size within PooledHttpNode, not of every body
+
+
+class TransportMetrics(object):
+    """Counters of the connection pool(s) of one ElasticSearchClient; shared by all of its nodes and threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pool_size = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests = 0
+        self.saturated = 0
+        self.backoffs = 0
+        self.backoff_s = 0.0
+        self.request_s = 0.0
+        self.bytes_raw = 0
+        self.bytes_sent = 0
+
+    def add_pool(self, size):
+        with self.lock: self.pool_size += size
+
+    def begin(self):
+        with self.lock:
+            self.requests += 1
+            if self.in_flight >= self.pool_size: self.saturated += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+
+    def end(self, duration_s, bytes_raw, bytes_sent):
+        with self.lock:
+            self.in_flight -= 1
+            self.request_s += duration_s
+            self.bytes_raw += bytes_raw
+            self.bytes_sent += bytes_sent
+
+    def backoff(self, s):
+        with self.lock: self.backoffs, self.backoff_s = self.backoffs + 1, self.backoff_s + s
+
+    def snapshot(self):
+        """Returns the metrics as a dict; utilization is in_flight / pool_size."""
+        with self.lock:
+            return dict(pool_size=self.pool_size, in_flight=self.in_flight, peak_in_flight=self.peak_in_flight,
+                        utilization=self.in_flight / max(1, self.pool_size),
+                        peak_utilization=self.peak_in_flight / max(1, self.pool_size),
+                        requests=self.requests, saturated=self.saturated,
+                        saturated_ratio=self.saturated / max(1, self.requests),
+                        mean_request_ms=1000 * self.request_s / max(1, self.requests),
+                        backoffs=self.backoffs, backoff_s=self.backoff_s,
+                        bytes_raw=self.bytes_raw, bytes_sent=self.bytes_sent,
+                        compression_ratio=self.bytes_sent / max(1, self.bytes_raw))
+
+
+class PooledHttpNode(Urllib3HttpNode):
+    """Urllib3HttpNode that compresses by size, backs off on 429/503 and counts its pool in TransportMetrics."""
+
+    profile = TransportProfile()
+    metrics = None
+    consecutive = threading.local()  # per thread number of consecutive 429/503 responses; for exponential backoff
+
+    # NOTE: the backoff of a 429/503 is slept before the retry rather than after the response, since only the transport
+    # knows whether one follows (max_retries, per request by .options); the transport retries a request with the same
+    # headers object, so that a request with the headers of the last 429/503 of the thread is its retry
+
+    def __init__(self, config):
+        super().__init__(config)
+        if self.profile.gzip: self._headers["accept-encoding"] = "gzip"
+        self.metrics.add_pool(config.connections_per_node)
+
+    @staticmethod
+    def bound(profile, metrics):
+        """Returns the node class bound to profile and metrics; passed to Elasticsearch(node_class=...)."""
+        return type("PooledHttpNode", (PooledHttpNode,), dict(profile=profile, metrics=metrics))
+
+    def perform_request(self, method, target, body=None, headers=None, **kwargs):
+        backoff = getattr(PooledHttpNode.consecutive, "backoff", None)
+        PooledHttpNode.consecutive.backoff = None
+        if backoff is not None and backoff[0] is headers and headers is not None: self.__sleep(backoff[1])
+        request_headers = headers
+        bytes_raw = len(body) if body else 0
+        if body and self.profile.gzip and (bytes_raw >= self.profile.compress_min_bytes or "/_bulk" in target):
+            body = gzip.compress(body, compresslevel=1)  # NOTE: level 1 is most of the size reduction at a fraction of cpu
+            headers = headers.copy() if headers is not None else dict()
+            headers["content-encoding"] = "gzip"
+        self.metrics.begin()
+        s = time.time()
+        try: response = super().perform_request(method, target, body=body, headers=headers, **kwargs)
+        finally: self.metrics.end(time.time() - s, bytes_raw, len(body) if body else 0)
+        if response.meta.status in self.profile.retry_on_status:
+            PooledHttpNode.consecutive.backoff = (request_headers, self.__backoff_s(response))
+        else: PooledHttpNode.consecutive.n = 0
+        return response
+
+    def close(self):
+        super().close()
+        self.metrics.add_pool(-self.config.connections_per_node)
+
+    def __backoff_s(self, response):
+        n = getattr(PooledHttpNode.consecutive, "n", 0)
+        PooledHttpNode.consecutive.n = n + 1
+        s = min(self.profile.max_backoff_s, self.profile.initial_backoff_s * 2 ** n)
+        retry_after = response.meta.headers.get("retry-after")
+        if retry_after is not None and retry_after.isdigit(): s = min(self.profile.max_backoff_s, float(retry_after))
+        logger.warning(f"ElasticSearch responded {response.meta.status}; backing off {s:.2f}s if retried")
+        return s
+
+    def __sleep(self, s):
+        self.metrics.backoff(s)
+        time.sleep(s)
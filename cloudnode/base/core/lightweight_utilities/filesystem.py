@@ -1,5 +1,6 @@
 from cloudnode.base.core.lightweight_utilities.files import construct_data_uri, convert_uri_to_bytesio
 import requests
+import shutil
 import time
 import os
 import io
@@ -58,6 +59,22 @@ class FileSystem(object):
                 return handler.delete(stub)
         raise FileNotFoundError(f"Stub does not conform to known protocols {list(handlers.keys())}: {stub}")
 
+    @staticmethod
+    def easy_listdirs(directory):
+        """Easily list the subdirectories of a directory"""
+        for protocol, handler in handlers.items():
+            if directory.lower().startswith(protocol):
+                return handler.listdirs(directory)
+        raise FileNotFoundError(f"Directory does not conform to known stub protocols {list(handlers.keys())}: {directory}")
+
+    @staticmethod
+    def easy_delete_directory(directory):
+        """Easily delete a directory and all of its stubs"""
+        for protocol, handler in handlers.items():
+            if directory.lower().startswith(protocol):
+                return handler.delete_directory(directory)
+        raise FileNotFoundError(f"Directory does not conform to known stub protocols {list(handlers.keys())}: {directory}")
+
 
 ########################################################################################################################
 # internal system code below this line
@@ -71,6 +88,10 @@ class Handler(object):
     def upload(source_file_obj, stub): raise NotImplementedError("protocol does not supported upload operation.")
     @staticmethod
     def listdir(directory): raise NotImplementedError("protocol does not supported listdir operation.")
+    @staticmethod
+    def listdirs(directory): raise NotImplementedError("protocol does not supported listdirs operation.")
+    @staticmethod
+    def delete_directory(directory): raise NotImplementedError("protocol does not supported delete_directory operation.")
 
 
 class HttpStubHandler(Handler):
@@ -123,6 +144,18 @@ class LocalFileStubHandler(Handler):
         directory = LocalFileStubHandler._parse_stub(directory)
         return [f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f))]
 
+    @staticmethod
+    def listdirs(directory):
+        """Returns list of basenames of the subdirectories of the directory."""
+        directory = LocalFileStubHandler._parse_stub(directory)
+        return [f for f in os.listdir(directory) if os.path.isdir(os.path.join(directory, f))]
+
+    @staticmethod
+    def delete_directory(directory):
+        """Deletes a directory and its files from the local filesystem."""
+        shutil.rmtree(LocalFileStubHandler._parse_stub(directory))
+        logger.info(f"Directory {directory} deleted.")
+
     @staticmethod
     def delete(stub):
         """Deletes a File from the local filesystem."""
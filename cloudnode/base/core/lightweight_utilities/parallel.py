@@ -1,4 +1,5 @@
 from multiprocessing import pool
+import threading
 import time
 
 import logging
@@ -70,3 +71,29 @@ class ParallelClient(object):
         failures = [i for i,r in enumerate(results) if r is None]
         successes = {i: r for i,r in enumerate(results) if r is not None}
         return successes, failures
+
+
+class ScheduledRun(object):
+    """Runs a function in a background thread every every_s from the Infrastructure cron loop (the EasyCron protocol),
+    skipping a run while the previous one is still running; see Infrastructure.add_cron."""
+
+    def __init__(self, function, name, every_s):
+        self.function = function
+        self.name = name
+        self.every_s = every_s
+        self.last_request_s = None
+        self.thread = None
+
+    def do_if_time_has_lapsed(self):
+        now = time.time()
+        if self.last_request_s is not None and now < self.last_request_s + self.every_s: return
+        self.last_request_s = now
+        if self.thread is not None and self.thread.is_alive():
+            logger.warning(f"CRON {self.name} previous scheduled run is still running")
+            return
+        self.thread = threading.Thread(target=self.__run, name=f"cron={self.name}_ts={now}", daemon=True)
+        self.thread.start()
+
+    def __run(self):
+        try: self.function()
+        except Exception as e: logger.warning(f"CRON {self.name} failed: {e}", exc_info=True)
@@ -0,0 +1,61 @@
+from pandas.api.types import union_categoricals
+import pandas
+import numpy
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Frames materialize query results as pandas DataFrames straight from the json of the hits (or the values of local
+# records), column by column, rather than through a SwiftData object and a deep-copying as_dict() per record: each batch
+# of hits becomes one typed chunk per column, and the chunks are concatenated once at the end, so that beyond the frame
+# itself only one batch of hits is held at a time (see SwiftData.query_frame and scan_frame).
+#
+# TYPES: Date fields are datetime64 (UTC), Integer and Boolean are the nullable Int64 and boolean dtypes, Float is
+# float64 (missing values are NaN), Keyword fields are categorical (the categories of all chunks are unioned), vectors
+# are float32 numpy arrays per row (as SwiftData holds them), and Text, geopoint, flags and list fields are objects.
+
+
+class FrameBuilder(object):
+    """Builds a DataFrame of fields from batches of hits or records, one typed chunk per column per batch."""
+
+    def __init__(self, fields, mapping, codecs):
+        self.fields = fields
+        self.kinds = {field: mapping.get(field) for field in fields}
+        self.codecs = {field: decode for field, decode in codecs if field in fields}  # for vectors, see models.VECTOR
+        self.chunks = {field: [] for field in fields}
+        self.n = 0
+
+    def add(self, sources, ids=None):
+        """Adds one batch: sources are _source dicts of hits (or vars of records), ids are their ids if not in sources."""
+        if len(sources) == 0: return self
+        for field in self.fields:
+            values = ids if field == "id" and ids is not None else [source.get(field) for source in sources]
+            self.chunks[field].append(self.__column(field, values))
+        self.n += len(sources)
+        return self
+
+    def frame(self):
+        """Concatenates the chunks of each column into the DataFrame, once."""
+        columns = dict()
+        for field in self.fields:
+            chunks = self.chunks.pop(field)
+            self.chunks[field] = []
+            if len(chunks) == 0: columns[field] = pandas.Series([], dtype=object)
+            elif all(isinstance(c, pandas.Categorical) for c in chunks): columns[field] = pandas.Series(union_categoricals(chunks))
+            else: columns[field] = pandas.concat([pandas.Series(c) for c in chunks], ignore_index=True)
+        return pandas.DataFrame(columns)
+
+    def __column(self, field, values):
+        kind = self.kinds[field]
+        if any(isinstance(v, (list, tuple)) for v in values) and kind != "DenseVector":
+            return pandas.array(values, dtype=object)  # list fields
+        if kind == "Date": return pandas.to_datetime(pandas.Series(values, dtype=object), utc=True, format="ISO8601").array
+        if kind == "Integer": return pandas.array(values, dtype="Int64")
+        if kind == "Boolean": return pandas.array(values, dtype="boolean")
+        if kind == "Float": return numpy.array([numpy.nan if v is None else v for v in values], dtype=numpy.float64)
+        if kind == "Keyword" and field != "id": return pandas.Categorical(values)
+        if kind == "DenseVector":
+            decode = self.codecs.get(field)
+            return pandas.array([None if v is None else numpy.asarray(v if decode is None else decode(v), dtype=numpy.float32)
+                                 for v in values], dtype=object)
+        return pandas.array(values, dtype=object)
@@ -0,0 +1,37 @@
+# Rank fusion merges the rankings of different retrievers, i.e., BM25 over text and kNN over vectors, into one ranking.
+# Their scores are not comparable (BM25 is unbounded and depends on the corpus, cosine is within [-1, 1]), so:
+#   rrf      reciprocal rank fusion uses ranks only: score(d) = sum over rankings of weight / (rank_constant + rank(d));
+#            robust without tuning; rank_constant=60 as in the original paper (Cormack et al.) and ElasticSearch.
+#   weighted min-max normalizes the scores of each ranking into [0, 1] and sums them by weight; better when one of the
+#            retrievers is known to be more reliable, but sensitive to outliers of the scores.
+# Items missing from a ranking contribute nothing for it.
+
+fusions = ["rrf", "weighted"]
+
+
+def reciprocal_rank_fusion(rankings, weights=None, rank_constant=60):
+    """rankings are lists of [(id, score)], best first; returns [(id, fused score)], best first."""
+    weights = [1.0] * len(rankings) if weights is None else weights
+    fused = dict()
+    for ranking, weight in zip(rankings, weights):
+        for rank, (id, _) in enumerate(ranking, start=1): fused[id] = fused.get(id, 0.0) + weight / (rank_constant + rank)
+    return sorted(fused.items(), key=lambda item: -item[1])
+
+
+def weighted_fusion(rankings, weights=None):
+    """rankings are lists of [(id, score)]; returns [(id, weighted sum of min-max normalized scores)], best first."""
+    weights = [1.0] * len(rankings) if weights is None else weights
+    fused = dict()
+    for ranking, weight in zip(rankings, weights):
+        if len(ranking) == 0: continue
+        lo, hi = min(score for _, score in ranking), max(score for _, score in ranking)
+        for id, score in ranking:
+            normalized = 1.0 if hi == lo else (score - lo) / (hi - lo)
+            fused[id] = fused.get(id, 0.0) + weight * normalized
+    return sorted(fused.items(), key=lambda item: -item[1])
+
+
+def fuse(rankings, fusion="rrf", weights=None, rank_constant=60):
+    if fusion not in fusions: raise ValueError(f"fusion must be one of {fusions}")
+    if fusion == "rrf": return reciprocal_rank_fusion(rankings, weights=weights, rank_constant=rank_constant)
+    return weighted_fusion(rankings, weights=weights)
@@ -0,0 +1,331 @@
+from cloudnode.base.core.elasticsearch.searchbar import analyze
+from cloudnode.base.core.elasticsearch.geo import GridIndex
+from cloudnode.base.core.elasticsearch import timebuckets
+from cloudnode.base.core.swiftdata.suggest import Completions
+import collections
+import threading
+import heapq
+import numpy
+import math
+import copy
+
+import logging
+logger = logging.getLogger(__name__)
+
+# The LocalIndex is the in-process index of the SwiftData records of one class in one index of the local filesystem. It
+# is loaded from disk on its first use and then kept current by SwiftData.save and SwiftData.delete (es=False) so that
+# local queries never re-read or re-parse the record files. Text fields are analyzed once, when a record enters the
+# index, so that compiled search bar predicates (see searchbar.compile_to_local) only compare tokens. Records written by
+# other processes into the same directory are only seen after a fresh=True rebuild of the index. Suggest fields keep
+# their Completions current in the same upsert and remove; see swiftdata.suggest. Document frequencies and lengths of
+# text fields are kept current too, so that rank() scores BM25 (as ElasticSearch) together with vector similarity in
+# a single pass over the records; see SwiftData.hybrid_search.
+#
+# COLUMNS: the values of numeric fields (Integer, Float and Boolean; not lists) are also held in numpy columns, one row
+# per record in the order of the records, so that numeric range clauses of search bar predicates select their candidate
+# rows vectorized before the predicate runs on those only, and so that sorts and stats never touch the objects. Removed
+# records leave an empty row until the columns are compacted.
+# FLAGS: flattened fields (sd.flags) keep a secondary index per key, value => ids, so that exact clauses on their keys
+# (i.e., flags.scraped:done, the next batch of a pipeline state) are a lookup rather than a scan of the records.
+# GEO: geopoint fields keep their points in a GridIndex (see elasticsearch.geo), so that radius and bounding box queries
+# check only the points of the grid cells they overlap, vectorized, and sort by the distance of the nearest point.
+# WINDOWS: timestamp fields with buckets keep an index per bucket width, key => ids, so that window clauses select their
+# candidates by the keys of the buckets covering them (see elasticsearch.timebuckets) rather than by a scan.
+
+
+class LocalIndex(object):
+    """In-process index of the local filesystem records of one SwiftData class in one index."""
+
+    built = dict()  # map from (index, cls_name) => LocalIndex already loaded
+    built_lock = threading.Lock()
+
+    def __init__(self, swift_cls, index, mapping, suggest_fields=(), buckets=None):
+        self.swift_cls = swift_cls
+        self.index = index
+        self.text_fields = [field for field, kind in mapping.items() if kind == "Text"]
+        self.completions = {field: Completions() for field in suggest_fields}  # map from field => Completions
+        self.records = dict()  # map from id => (SwiftData object, dict(field=analyzed tokens) of its Text fields)
+        self.df = {field: collections.Counter() for field in self.text_fields}  # map from field => token => n records
+        self.lengths = {field: 0 for field in self.text_fields}                  # map from field => total tokens
+        self.columns = {field: numpy.full(16, numpy.nan) for field, kind in mapping.items() if kind in numeric_kinds}
+        self.keyed = {field: dict() for field, kind in mapping.items() if kind == "Flattened"}  # field => key => value => ids
+        self.grids = {field: GridIndex() for field, kind in mapping.items() if kind == "GeoPoint"}
+        self.buckets = dict() if buckets is None else buckets  # map from field => [(width, seconds)]
+        self.windows = {field: {width: dict() for width, _ in widths} for field, widths in self.buckets.items()}  # => key => ids
+        self.rows = dict()   # map from id => row of the columns
+        self.row_ids = []    # map from row => id, None for rows of removed records
+        self.n_removed = 0
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def of(swift_cls, index, mapping, load, fresh=False, suggest_fields=(), buckets=None):
+        """Returns the LocalIndex of swift_cls in index; load() returns all its records and is called when building."""
+        key = (index, swift_cls.__name__)
+        with LocalIndex.built_lock:
+            if key in LocalIndex.built and not fresh: return LocalIndex.built[key]
+            local_index = LocalIndex(swift_cls, index, mapping, suggest_fields=suggest_fields, buckets=buckets)
+            for obj in load(): local_index.upsert(obj)
+            logger.info(f"LocalIndex built for {swift_cls.__name__} in {index} with n={len(local_index.records)} records")
+            LocalIndex.built[key] = local_index
+            return local_index
+
+    @staticmethod
+    def if_built(swift_cls, index):
+        """Returns the LocalIndex if it has been built, otherwise None; writes to unbuilt indices need no upkeep."""
+        return LocalIndex.built.get((index, swift_cls.__name__))
+
+    def upsert(self, obj):
+        obj = copy.copy(obj)  # the index holds the saved state, not the caller's object which may continue to change
+        values = vars(obj)
+        tokens = {field: analyze(values.get(field)) for field in self.text_fields}
+        with self.lock:
+            previous = self.records.get(obj.id)
+            self.records[obj.id] = (obj, tokens)
+            self.__complete(previous[0] if previous is not None else None, obj)
+            self.__count(previous[1] if previous is not None else None, tokens)
+            self.__store(obj.id, values)
+            self.__key(obj.id, vars(previous[0]) if previous is not None else None, values)
+            self.__bucket(obj.id, vars(previous[0]) if previous is not None else None, values)
+            for field, grid in self.grids.items(): grid.set(obj.id, _points(values.get(field)))
+
+    def remove(self, id):
+        with self.lock:
+            previous = self.records.pop(id, None)
+            if previous is not None:
+                self.__complete(previous[0], None)
+                self.__count(previous[1], None)
+                self.__unstore(id)
+                self.__key(id, vars(previous[0]), None)
+                self.__bucket(id, vars(previous[0]), None)
+                for grid in self.grids.values(): grid.remove(id)
+
+    def complete(self, field, prefix, k=10):
+        """Returns up to k values of suggest field starting with prefix, the most frequent first."""
+        if field not in self.completions: raise KeyError(f"{self.swift_cls.__name__}.{field} is not a suggest field")
+        return self.completions[field].complete(prefix, k=k)
+
+    def generation(self, field):
+        return self.completions[field].generation
+
+    def __complete(self, removed, added):
+        for field, completions in self.completions.items():
+            if removed is not None: completions.remove(_values(vars(removed).get(field)))
+            if added is not None: completions.add(_values(vars(added).get(field)))
+
+    def __count(self, removed, added):
+        for field in self.text_fields:
+            if removed is not None:
+                self.df[field].subtract(set(removed[field]))
+                self.lengths[field] -= len(removed[field])
+            if added is not None:
+                self.df[field].update(set(added[field]))
+                self.lengths[field] += len(added[field])
+
+    def __store(self, id, values):
+        row = self.rows.get(id)
+        if row is None:
+            row = self.rows[id] = len(self.row_ids)
+            self.row_ids.append(id)
+        for field in list(self.columns):
+            column, value = self.columns[field], values.get(field)
+            if isinstance(value, (list, tuple)):  # list fields are not columnar; they are left to the predicates
+                del self.columns[field]
+                continue
+            if row >= len(column): column = self.columns[field] = numpy.concatenate([column, numpy.full(len(column), numpy.nan)])
+            column[row] = numpy.nan if value is None else float(value)
+
+    def __unstore(self, id):
+        row = self.rows.pop(id)
+        self.row_ids[row] = None
+        for column in self.columns.values(): column[row] = numpy.nan
+        self.n_removed += 1
+        if self.n_removed > 1024 and self.n_removed > len(self.row_ids) // 2: self.__compact()
+
+    def __compact(self):
+        kept = [row for row, id in enumerate(self.row_ids) if id is not None]
+        for field, column in self.columns.items():
+            compacted = numpy.full(max(16, 2 * len(kept)), numpy.nan)
+            compacted[:len(kept)] = column[kept]
+            self.columns[field] = compacted
+        self.row_ids = [self.row_ids[row] for row in kept]
+        self.rows = {id: row for row, id in enumerate(self.row_ids)}
+        self.n_removed = 0
+
+    def __key(self, id, removed, added):
+        for field, index in self.keyed.items():
+            for values, update in [(removed, set.discard), (added, set.add)]:
+                flags = None if values is None else values.get(field)
+                if not isinstance(flags, dict): continue
+                for key, value in flags.items(): update(index.setdefault(key, dict()).setdefault(str(value), set()), id)
+
+    def __bucket(self, id, removed, added):
+        for field, widths in self.buckets.items():
+            for values, update in [(removed, set.discard), (added, set.add)]:
+                if values is None: continue
+                for width, seconds in widths:
+                    for key in timebuckets.bucket_keys(values.get(field), seconds):
+                        update(self.windows[field][width].setdefault(key, set()), id)
+
+    def __candidates(self, predicate):
+        """Returns the [(obj, tokens)] of the records selected by the flag and bucket lookups and numeric ranges of
+        predicate, in the order of the records (all records if it has none of them)."""
+        ranges = [(field, bounds) for field, bounds in getattr(predicate, "ranges", []) if field in self.columns]
+        keyed = [(field, key, values) for field, key, values in getattr(predicate, "keyed", []) if field in self.keyed]
+        windows = [(field, covers) for field, covers in getattr(predicate, "windows", []) if field in self.windows]
+        with self.lock:
+            if len(ranges) == 0 and len(keyed) == 0 and len(windows) == 0: return list(self.records.values())
+            ids = None
+            for field, key, values in keyed:
+                found = set().union(*[self.keyed[field].get(key, dict()).get(str(v), set()) for v in values])
+                ids = found if ids is None else ids & found
+            for field, covers in windows:
+                found = set().union(*[self.windows[field][width].get(k, set()) for terms in covers
+                                      for width, keys in terms.items() for k in keys])
+                ids = found if ids is None else ids & found
+            if len(ranges) == 0: return [self.records[id] for id in sorted(ids, key=self.rows.get)]
+            n = len(self.row_ids)
+            selected = numpy.ones(n, dtype=bool)
+            for field, alternatives in ranges:
+                column, matches = self.columns[field][:n], numpy.zeros(n, dtype=bool)
+                for bounds in alternatives:
+                    match = ~numpy.isnan(column)
+                    for op, bound in bounds.items(): match &= _compare[op](column, bound)
+                    matches |= match
+                selected &= matches
+            if ids is not None: selected &= numpy.isin(numpy.arange(n), [self.rows[id] for id in ids])
+            return [self.records[self.row_ids[row]] for row in numpy.flatnonzero(selected)]
+
+    def __len__(self): return len(self.records)
+
+    def column(self, field, predicate=None):
+        """Returns (ids, values) of the numeric column of field for the records matching predicate; NaN where None."""
+        if field not in self.columns: raise KeyError(f"{self.swift_cls.__name__}.{field} is not a numeric (non-list) field")
+        items = self.__candidates(predicate)
+        if predicate is not None: items = [(obj, tokens) for obj, tokens in items if predicate(vars(obj), tokens)]
+        with self.lock:
+            ids = [obj.id for obj, _ in items]
+            values = self.columns[field][[self.rows[id] for id in ids]] if len(ids) != 0 else numpy.zeros(0)
+        return ids, values
+
+    def flagged(self, field, key, value, max_results=50):
+        """Returns up to max_results records whose flags field has key == value, in the order of the records."""
+        if field not in self.keyed: raise KeyError(f"{self.swift_cls.__name__}.{field} is not a flags field")
+        with self.lock:
+            ids = sorted(self.keyed[field].get(key, dict()).get(str(value), set()), key=self.rows.get)
+            return [self.records[id][0] for id in ids[:max_results]]
+
+    def stats(self, field, predicate=None):
+        """Returns dict(count, min, max, avg, sum) of field over the records matching predicate, as ElasticSearch."""
+        _, values = self.column(field, predicate)
+        values = values[~numpy.isnan(values)]
+        if len(values) == 0: return dict(count=0, min=None, max=None, avg=None, sum=0.0)
+        return dict(count=int(len(values)), min=float(values.min()), max=float(values.max()),
+                    avg=float(values.mean()), sum=float(values.sum()))
+
+    def sorted_by(self, field, predicate=None, descending=False, max_results=50):
+        """Returns the records matching predicate sorted by field; records without a value are last."""
+        ids, values = self.column(field, predicate)
+        keys = numpy.where(numpy.isnan(values), numpy.inf, -values if descending else values)
+        order = numpy.argsort(keys, kind="stable")[:max_results]
+        with self.lock: return [self.records[ids[i]][0] for i in order if ids[i] in self.records]
+
+    def within(self, field, lat, lng, radius_m, predicate=None, max_results=50):
+        """Returns up to max_results records with a point of field within radius_m of (lat, lng) and matching predicate,
+        the nearest first, as [(obj, meters)]"""
+        found = self.__grid(field).within(lat, lng, radius_m)
+        with self.lock: items = [(self.records[id], m) for id, m in sorted(found.items(), key=lambda item: item[1]) if id in self.records]
+        results = [(obj, m) for (obj, tokens), m in items if predicate is None or predicate(vars(obj), tokens)]
+        return results if max_results is None else results[:max_results]
+
+    def in_bbox(self, field, top_left, bottom_right, predicate=None, max_results=50):
+        """Returns up to max_results records with a point of field within the box and matching predicate, in the order
+        of the records"""
+        found = self.__grid(field).in_bbox(top_left, bottom_right)
+        with self.lock: items = [self.records[id] for id in sorted(found, key=self.rows.get) if id in self.records]
+        results = [obj for obj, tokens in items if predicate is None or predicate(vars(obj), tokens)]
+        return results if max_results is None else results[:max_results]
+
+    def geo_grid(self, field, precision=5, predicate=None):
+        """Returns dict(geohash=number of records) of the points of field of the records matching predicate"""
+        grid = self.__grid(field)
+        if predicate is None: return grid.grid(precision)
+        return grid.grid(precision, ids=set(obj.id for obj, tokens in self.__candidates(predicate) if predicate(vars(obj), tokens)))
+
+    def __grid(self, field):
+        if field not in self.grids: raise KeyError(f"{self.swift_cls.__name__}.{field} is not a geopoint field")
+        return self.grids[field]
+
+    def bm25(self, tokens, field, query_tokens, k1=1.2, b=0.75):
+        """The BM25 score of the analyzed tokens of field for query_tokens, as ElasticSearch scores it."""
+        field_tokens = tokens.get(field)
+        if not field_tokens: return 0.0
+        n, average = len(self.records), self.lengths[field] / max(1, len(self.records))
+        counts, score = collections.Counter(field_tokens), 0.0
+        for token in query_tokens:
+            f = counts.get(token, 0)
+            if f == 0: continue
+            df = self.df[field][token]
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            score += idf * f * (k1 + 1) / (f + k1 * (1 - b + b * len(field_tokens) / max(average, 1e-9)))
+        return score
+
+    def rank(self, predicate=None, query_tokens=None, fields=(), vector_field=None, vector=None, k=10):
+        """One pass over the records matching predicate: returns (lexical, semantic), the top-k [(id, score)] by BM25
+        of query_tokens (the best of fields) and by cosine similarity of vector_field to vector; either may be None."""
+        with self.lock: items = list(self.records.values())
+        lexical, ids, vectors = [], [], []
+        for obj, tokens in items:
+            values = vars(obj)
+            if predicate is not None and not predicate(values, tokens): continue
+            if query_tokens:
+                score = max((self.bm25(tokens, field, query_tokens) for field in fields), default=0.0)
+                if score > 0: lexical.append((obj.id, score))
+            if vector is not None and values.get(vector_field) is not None:
+                ids.append(obj.id)
+                vectors.append(values[vector_field])
+        semantic = None
+        if vector is not None:
+            semantic = []
+            if len(vectors) != 0:
+                q, m = numpy.asarray(vector, dtype=numpy.float32), numpy.asarray(vectors, dtype=numpy.float32)
+                norms = numpy.linalg.norm(m, axis=1) * numpy.linalg.norm(q)
+                scores = (m @ q) / numpy.where(norms == 0, numpy.inf, norms)
+                top = numpy.argsort(-scores)[:k]
+                semantic = [(ids[i], float(scores[i])) for i in top]
+        lexical = heapq.nlargest(k, lexical, key=lambda item: item[1]) if query_tokens else None
+        return lexical, semantic
+
+    def get(self, id):
+        with self.lock:
+            record = self.records.get(id)
+        return None if record is None else record[0]
+
+    def search(self, predicate, max_results=50):
+        """Returns up to max_results records for which predicate(values, tokens) is True, in insertion order."""
+        items = self.__candidates(predicate)
+        results = []
+        for obj, tokens in items:
+            if predicate(vars(obj), tokens):
+                results.append(obj)
+                if max_results is not None and len(results) >= max_results: break
+        return results
+
+    def count(self, predicate=None):
+        if predicate is None: return len(self.records)
+        items = self.__candidates(predicate)
+        return sum(1 for obj, tokens in items if predicate(vars(obj), tokens))
+
+
+numeric_kinds = ["Integer", "Float", "Boolean"]
+_compare = dict(gte=numpy.greater_equal, gt=numpy.greater, lte=numpy.less_equal, lt=numpy.less)
+
+
+def _points(value):
+    """The [(lat, lng)] of a geopoint field value: None, a point [lat, lng(, z)] or a list of points"""
+    if value is None or len(value) == 0: return []
+    return [(p[0], p[1]) for p in value] if isinstance(value[0], (list, tuple)) else [(value[0], value[1])]
+
+
+def _values(value):
+    if value is None: return []
+    return [v for v in value if v is not None] if isinstance(value, (list, tuple)) else [value]
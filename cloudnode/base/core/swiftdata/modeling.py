@@ -1,12 +1,34 @@
 from cloudnode.base.core.elasticsearch.search import ElasticSearchDslClient, ElasticSearchServer, ElasticSearchClient
+from cloudnode.base.core.elasticsearch.snapshots import SnapshotManager
+from cloudnode.base.core.elasticsearch.migration import IndexMigration, versioned
+from cloudnode.base.core.elasticsearch.rollover import Rollover, RolledIndex
+from cloudnode.base.core.elasticsearch.embedded import EmbeddedElasticSearchServer, EmbeddedElasticSearchClient
 from cloudnode.base.core.lightweight_utilities.filesystem import FileSystem
 from cloudnode.base.core.lightweight_utilities.cloudnode import create_programmatic_directory
+from cloudnode.base.core.lightweight_utilities.parallel import ScheduledRun
+from cloudnode.base.core.elasticsearch.searchbar import SearchBarPlan
+from cloudnode.base.core.elasticsearch import searchbar
+from cloudnode.base.core.elasticsearch import geo
+from cloudnode.base.core.elasticsearch import timebuckets
 from cloudnode.base.core.swiftdata.models import sd, descriptions_of_sd
+from cloudnode.base.core.swiftdata.local import LocalIndex
+from cloudnode.base.core.swiftdata.querylog import QueryLog, QueryRecord, now_iso, body_bytes
+from cloudnode.base.core.swiftdata.suggest import SuggestCache, normalize
+from cloudnode.base.core.swiftdata.tiering import Tiering, ColdStore, merged_stats, merged_sorted
+from cloudnode.base.core.swiftdata.watch import SavedQuery, Watches
+from cloudnode.base.core.swiftdata.frames import FrameBuilder
+from cloudnode.base.core.swiftdata import fusion as rank_fusion
 from cloudnode.config import RuntimeConfig
 from elasticsearch_dsl import Document, Integer, Keyword, Text, Date, Index, Float, Boolean, GeoPoint, DenseVector, Q
+from elasticsearch_dsl import Object, Completion, Field
+import elasticsearch.exceptions
+import elasticsearch.helpers
 import dataclasses
+import functools
+import threading
 import datetime
 import json
+import time
 import uuid
 import os
 import io
@@ -28,14 +50,25 @@ logger = logging.getLogger(__name__)
 # Document objects at points of data writing to ElasticSearch; and transformed back from ElasticSearch after queries.
 # This is memory and performance efficient because ESD are simply containers for json rest api calls in the es format.
 
+# ES: the record operations (save, get, exists, list, delete, count) default to es=False, the local filesystem; and
+# queries (search_bar, flagged, stats, sort_by, geo, hybrid_search, suggest, frames) default to es=True, ElasticSearch.
+
+# MAPPING: the ElasticSearch Document of a SwiftData class declares every field at creation, so that indices are created
+# with an explicit mapping rather than the dynamic mapping ElasticSearch guesses from the first record: flags map to a
+# flattened field, and geopoints are written as "lat,lng" strings (ElasticSearch reads geo_point arrays as [lng, lat]).
+# Indices created before mappings were explicit keep their dynamic mapping, in which geopoints are numbers;
+# cls.migrate(index) moves their records into an index with the explicit mapping.
+
 
 @dataclasses.dataclass
 class SwiftData:
     id: sd.string()
     ts: sd.string()
     # ts: sd.timestamp()
+    rollover_policy = None  # a Rollover, set by class X(SwiftData, rollover=Rollover("timestamp", period="1d", keep=30))
+    tiering_policy = None   # a Tiering, set by class X(SwiftData, tiering=Tiering("ts", older_than="30d"))
 
-    def __init_subclass__(cls):
+    def __init_subclass__(cls, rollover=None, tiering=None, **kwargs):
         """This method is called after any SubClass /definition/ and servers the purpose of set/get of its fields."""
         # NOTE: there are instances in which fields (i.e., timestamps) should have data wranglers when set or get (i.e.
         # the user may set the timestamp field with a string instead of a datetime; which is then parsed in the setter
@@ -43,7 +76,14 @@ class SwiftData:
         # dataclass use conventional styles (strings) for storage on object by allows the user to have the full suite of
         # expectations (i.e., gps = "lat,lng" or ["lat", "lng"] or [lat, lng]) all while seamlessly connecting from the
         # dataclass to its json to its elasticsearch document (where json has its wrangler into elasticsearch too)
-        super().__init_subclass__()
+        super().__init_subclass__(**kwargs)
+        if rollover is not None:
+            if not isinstance(rollover, Rollover): raise ValueError(f"rollover of {cls.__name__} must be a Rollover: {rollover}")
+            cls.rollover_policy = rollover
+        if tiering is not None:
+            if not isinstance(tiering, Tiering): raise ValueError(f"tiering of {cls.__name__} must be a Tiering: {tiering}")
+            if cls.rollover_policy is not None: raise ValueError(f"{cls.__name__} may have a rollover or a tiering policy, not both")
+            cls.tiering_policy = tiering
         for field in dataclasses.fields(cls):
             if hasattr(field.type, "upon_get") or hasattr(field.type, "upon_set"):
                 private = f"__{field.name}"
@@ -87,81 +127,126 @@ class SwiftData:
 
     def save(self, index, exist_ok=True, es=False):
         if es:
-            es_client, es_cls = SwiftDataBackend.operation_context(index, self.__class__)
-            return es_cls(**SwiftDataInternal.swiftdata_obj_es_init(self)).save(using=es_client)
+            es_client, es_cls, es_index = SwiftDataBackend.operation_context(index, self.__class__, with_index=True)
+            es_obj = es_cls(**SwiftDataInternal.swiftdata_obj_es_init(self))
+            rolled = SwiftDataInternal.rolled_of(self.__class__, index)
+            target = None if rolled is None else rolled.target_of(getattr(self, self.rollover_policy.field))
+            with IndexMigration.writing(es_index._name) as migration:  # also written into the index being migrated to
+                result = es_obj.save(using=es_client, index=target)  # the write alias, or the index of a past period
+                if migration is not None: migration.index(self.id, es_obj.to_dict())
+            cold = SwiftDataInternal.cold_of(self.__class__, index)
+            if cold is not None and self.id in cold: cold.remove([self.id])  # saved again, the record is hot again
+            SwiftDataInternal.match_watches(self.__class__, index, [self])
+            return result
         else:
-            stub = SwiftDataBackend.create_stub(self.id, self.__class__.__name__, index)
-            if not exist_ok and FileSystem.easy_exists(stub):
+            policy = self.rollover_policy
+            period = None if policy is None else policy.key_of(getattr(self, policy.field))
+            stub = SwiftDataBackend.create_stub(self.id, self.__class__.__name__, index, period=period)
+            is_counted = SwiftDataBackend.local_count_is_seeded(index, self.__class__.__name__)
+            exists = FileSystem.easy_exists(stub) if (not exist_ok or is_counted) else None
+            if not exist_ok and exists:
                 raise RuntimeError(f"item exists in database {self}")
-            as_dict = self.as_dict()
-            for field in dataclasses.fields(self.__class__):
-                if hasattr(field.type, "upon_disk_storage") and field.name in as_dict:
-                    as_dict[field.name] = field.type.upon_disk_storage(as_dict[field.name])
-            FileSystem.easy_upload(io.StringIO(json.dumps(as_dict)), stub)
+            FileSystem.easy_upload(io.StringIO(json.dumps(SwiftDataInternal.disk_form_of(self))), stub)
+            if is_counted and not exists: SwiftDataBackend.local_count_add(index, self.__class__.__name__, 1)
+            local_index = LocalIndex.if_built(self.__class__, index)
+            if local_index is not None: local_index.upsert(self)
+            SwiftDataInternal.match_watches(self.__class__, index, [self])
         return "created"  # follows the ElasticSearch response convention.
 
     @classmethod
     def delete(cls, index, id, es=False):
         if es:
-            es_client, es_cls = SwiftDataBackend.operation_context(index, cls)
-            return cls.get(index, id, es=True).delete(using=es_client)  # there is some strange oddity here
+            es_client, es_cls, es_index = SwiftDataBackend.operation_context(index, cls, with_index=True)
+            cold = SwiftDataInternal.cold_of(cls, index)
+            if cold is not None and cold.remove([id]) != 0 and not es_cls.exists(id=id, using=es_client): return None  # cold only
+            with IndexMigration.writing(es_index._name) as migration:
+                result = cls.get(index, id, es=True).delete(using=es_client)  # there is some strange oddity here
+                if migration is not None: migration.delete(id)
+            return result
             # return es_cls(**SwiftDataInternal.swiftdata_obj_es_init(cls.new(id=id))).delete(using=es_client)
         else:
-            stub = SwiftDataBackend.create_stub(id, cls.__name__, index)
-            return FileSystem.easy_delete(stub)
+            stub = SwiftDataBackend.local_stub_of(cls, index, id)
+            result = FileSystem.easy_delete(stub)
+            SwiftDataBackend.local_count_add(index, cls.__name__, -1)
+            local_index = LocalIndex.if_built(cls, index)
+            if local_index is not None: local_index.remove(id)
+            return result
 
     @classmethod
     def get(cls, index, id, es=False):
         if es:
             es_client, es_cls = SwiftDataBackend.operation_context(index, cls)
+            rolled = SwiftDataInternal.rolled_of(cls, index)
+            if rolled is not None:  # NOTE: get by id is not supported over an alias of many indices; see RolledIndex.locate
+                found = rolled.locate(id if isinstance(id, (tuple, list)) else [id])
+                if isinstance(id, (tuple, list)): return [es_cls.from_es(found[str(i)]) if str(i) in found else None for i in id]
+                return es_cls.from_es(found[str(id)]) if str(id) in found else es_cls.get(id=id, using=es_client, index=rolled.write_index())
+            cold = SwiftDataInternal.cold_of(cls, index)
+            if cold is not None:  # the hot record first, then the cold store for the ids not found in ElasticSearch
+                as_es = lambda obj: es_cls(**SwiftDataInternal.swiftdata_obj_es_init(obj))
+                if isinstance(id, (tuple, list)):
+                    hot = es_cls.mget(id, using=es_client)
+                    found = cold.get([i for i, obj in zip(id, hot) if obj is None])
+                    return [obj if obj is not None else as_es(found[str(i)]) if str(i) in found else None for i, obj in zip(id, hot)]
+                try: return es_cls.get(id=id, using=es_client)
+                except elasticsearch.exceptions.NotFoundError:
+                    found = cold.get([id])
+                    if str(id) not in found: raise
+                    return as_es(found[str(id)])
             if isinstance(id, (tuple, list)):
-                return es_cls.mget(id=id, using=es_client)
+                return es_cls.mget(id, using=es_client)
             else: return es_cls.get(id=id, using=es_client)
         else:
             if not isinstance(id, (tuple, list)): id = [id]
             objects = []
             for _id in id:
-                if not cls.exists(index, _id): result = None
+                stub = SwiftDataBackend.local_stub_of(cls, index, _id)
+                if not FileSystem.easy_exists(stub): result = None
                 else:
-                    stub = SwiftDataBackend.create_stub(id, cls.__name__, index)
                     file_obj = FileSystem.easy_download(stub)
-                    result = cls.new(json.load(file_obj))
+                    result = SwiftDataInternal.decode(cls, json.load(file_obj))
                 objects.append(result)
             return objects
 
     @classmethod
     def getAll(cls, index, es=False, max_results=50):
         if es:
-            es_client, es_cls = SwiftDataBackend.operation_context(index, cls)
-            es_objs = ElasticSearchDslClient.getAll(es_client, es_cls, max_results=max_results)
-            return [cls(**SwiftDataInternal.es_obj_swiftdata_init(obj)) for obj in es_objs]
+            hot = cls.expert_query(index, None, max_results=max_results)
+            cold = SwiftDataInternal.cold_of(cls, index)
+            if cold is None or (max_results is not None and len(hot) >= max_results): return hot
+            hot_ids = {obj.id for obj in hot}
+            ids = [id for id in cold.ids() if id not in hot_ids]
+            found = cold.get(ids if max_results is None else ids[:max_results - len(hot)])
+            return hot + list(found.values())
         else:
             objs = []
-            for id in cls.list(index)[:max_results]:
-                stub = SwiftDataBackend.create_stub(id, cls.__name__, index)
+            for id, stub in SwiftDataBackend.local_stubs(cls, index)[:max_results]:
                 file_obj = FileSystem.easy_download(stub)
-                objs.append(cls.new(**json.load(file_obj)))
+                objs.append(SwiftDataInternal.decode(cls, json.load(file_obj)))
             return objs
 
     @classmethod
     def exists(cls, index, id, es=False):
         if es:
             es_client, es_cls = SwiftDataBackend.operation_context(index, cls)
-            return es_cls.exists(id=id, using=es_client)
+            rolled = SwiftDataInternal.rolled_of(cls, index)
+            if rolled is not None: return str(id) in rolled.locate([id])
+            cold = SwiftDataInternal.cold_of(cls, index)
+            return es_cls.exists(id=id, using=es_client) or (cold is not None and id in cold)
         else:
-            stub = SwiftDataBackend.create_stub(id, cls.__name__, index)
+            stub = SwiftDataBackend.local_stub_of(cls, index, id)
             return FileSystem.easy_exists(stub)
 
     @classmethod
     def list(cls, index, es=False):
         if es:
             es_client, es_cls, es_index = SwiftDataBackend.operation_context(index, cls, with_index=True)
-            return ElasticSearchDslClient.listAll(es_client, es_index._name, es_cls)
+            ids = ElasticSearchDslClient.listAll(es_client, es_index._name, es_cls)
+            cold = SwiftDataInternal.cold_of(cls, index)
+            if cold is not None: ids += [id for id in cold.ids() if id not in set(ids)]
+            return ids
         else:
-            directory = SwiftDataBackend.create_stub(None, cls.__name__, index)
-            filenames = FileSystem.easy_listdir(directory)
-            pattern = re.compile(f"swift.{index}.{cls.__name__}.(.*?).json".lower())
-            return [pattern.match(filename).group(1) for filename in filenames if pattern.match(filename)]
+            return [id for id, _ in SwiftDataBackend.local_stubs(cls, index)]
 
     @classmethod
     def refresh_index(cls, index, es=False):
@@ -170,35 +255,362 @@ class SwiftData:
             es_client.indices.refresh(index=es_index._name)
 
     @classmethod
-    def count(cls, index, es=False):
+    def count(cls, index, es=False, q=None, fresh=False):
+        """counts records matching q, if any, a search bar string or Q (es=True); fresh=True refreshes at a real cost"""
+        # NOTE: the local filesystem count is listed once and then maintained by save and delete; fresh=True re-lists
+        # the directory, which is only necessary when other processes write into the same index directory.
         if es:
             _, es_cls, es_index = SwiftDataBackend.operation_context(index, cls, with_index=True)
-            return SwiftDataBackend.client.count(es_index._name)
+            indices = es_index._name
+            cold, predicate = SwiftDataInternal.cold_query_of(cls, index, q)
+            if isinstance(q, str): q, indices = SwiftDataInternal.routed_search_bar(cls, index, q)
+            n = SwiftDataBackend.client.count(indices, query=q, fresh=fresh)
+            if cold is None: return n
+            return n + (len(cold) if predicate is None else cold.local_index().count(predicate))
         else:
-            return len(cls.list(index))
+            if q is not None:
+                predicate = SwiftDataInternal.local_predicate_of(cls, q, "count")
+                return cls.local_index(index, fresh=fresh).count(predicate)
+            if fresh or not SwiftDataBackend.local_count_is_seeded(index, cls.__name__):
+                SwiftDataBackend.local_count_seed(index, cls.__name__, len(cls.list(index)))
+            return SwiftDataBackend.local_count(index, cls.__name__)
 
     @classmethod
     def create_index(cls, index, exist_ok=False):
         """makes explicit for the user the creation of the elastic search document index for the first time"""
+        # NOTE: the index is created as {name}.v1 behind the alias {name}, so that .migrate() can swap in a new version;
+        # classes with a rollover policy create the index of the current period instead, see .rollover()
         es_client, es_cls, es_index = SwiftDataBackend.operation_context(index, cls, with_index=True)
         if not SwiftDataBackend.client.index_exists(es_index._name):
             logger.info(f"creating index {es_index._name} for {es_cls.__name__} for its first use")
-            es_index.create(using=SwiftDataBackend.client.es)
+            if cls.rollover_policy is not None: SwiftDataInternal.rolled_of(cls, index).ensure()
+            else: es_index.clone(name=versioned(es_index._name, 1)).aliases(**{es_index._name: dict(is_write_index=True)}).create(using=es_client)
         else:
             if exist_ok: return
             raise RuntimeError(f"index {es_index._name} for {es_cls.__name__} already exists")
 
     @classmethod
-    def expert_query(cls, index, q, max_results=50):
-        """performs a search using any elasticsearch-dsl Q query construction"""
-        es_client, es_cls = SwiftDataBackend.operation_context(index, cls)
-        es_objs = ElasticSearchDslClient.perform_dsl_query(es_client, es_cls, q, max_results=max_results)
-        return [cls(**SwiftDataInternal.es_obj_swiftdata_init(obj)) for obj in es_objs]
+    def migrate(cls, index, slices="auto", keep_old=False, wait=True, poll_s=1.0):
+        """moves the records of index into a new index with the current mapping of the class (i.e., after adding fields
+        or changing their types) without downtime: a server-side reindex in parallel slices while saves and deletes are
+        dual-written, then an atomic alias swap; returns the final progress, or the IndexMigration with wait=False"""
+        # NOTE: .progress() reports the records copied of total and docs/s while copying; keep_old keeps the previous
+        # version of the index (not of indices created before aliases, whose name the alias takes)
+        es_client, es_cls, es_index = SwiftDataBackend.operation_context(index, cls, with_index=True)
+        if cls.rollover_policy is not None: raise NotImplementedError("SwiftData migrate is not supported for classes with rollover.")
+        migration = IndexMigration(es_client, es_index._name, es_index.to_dict(), slices=slices, keep_old=keep_old, poll_s=poll_s).start()
+        return migration.wait() if wait else migration
+
+    @classmethod
+    def rollover(cls, index, es=True, now=None):
+        """for classes with a rollover policy: rolls the write index over to the next index of its period beyond max_docs
+        or max_size_mb and drops the periods beyond retention; es=False drops the local period directories instead.
+        Returns dict(rolled=new index or None, dropped=[indices or periods]); see rollover_schedule to run it by cron"""
+        policy = cls.rollover_policy
+        if policy is None: raise KeyError(f"{cls.__name__} has no rollover policy")
+        if es: return SwiftDataInternal.rolled_of(cls, index).maintain(now=now)
+        oldest, dropped = policy.oldest_kept(now), []
+        if oldest is None: return dict(rolled=None, dropped=dropped)
+        local_index = LocalIndex.if_built(cls, index)
+        for period in SwiftDataBackend.local_periods(cls, index):
+            if period >= oldest: continue
+            ids = [id for id, _ in SwiftDataBackend.local_stubs(cls, index, periods=[period])]
+            FileSystem.easy_delete_directory(SwiftDataBackend.create_stub(None, cls.__name__, index, period=period))
+            SwiftDataBackend.local_count_add(index, cls.__name__, -len(ids))
+            if local_index is not None: [local_index.remove(id) for id in ids]
+            dropped.append(period)
+        if len(dropped) != 0: logger.info(f"ROLLOVER {cls.__name__} in {index}: dropped local periods {dropped}")
+        return dict(rolled=None, dropped=dropped)
 
     @classmethod
-    def search_bar(cls, index, s, max_results=50):
+    def rollover_schedule(cls, index, every_s=300, es=True):
+        """returns the ScheduledRun of .rollover(index), i.e., Infrastructure.add_cron(LogLine.rollover_schedule(index))"""
+        return ScheduledRun(functools.partial(cls.rollover, index, es=es), f"rollover={cls.__name__}.{index}", every_s)
+
+    @classmethod
+    def tier(cls, index, now=None):
+        """for classes with a tiering policy: moves the records older than the cutoff from ElasticSearch into the cold
+        store on the local filesystem, a batch at a time; returns dict(moved=n, cold=n records in the cold tier), and
+        raises BulkIndexError if records fail to delete from ElasticSearch; see tier_schedule to run it by cron, and
+        Tiering for how reads route across the tiers"""
+        # NOTE: each batch is written into the cold store before it is deleted from ElasticSearch; records are expected
+        # not to be saved again once older than the cutoff, as a save between the two would be deleted with the batch
+        policy = cls.tiering_policy
+        if policy is None: raise KeyError(f"{cls.__name__} has no tiering policy")
+        es_client, es_cls, es_index = SwiftDataBackend.operation_context(index, cls, with_index=True)
+        cold = SwiftDataInternal.cold_of(cls, index)
+        older = Q("range", **{policy.field: dict(lt=policy.cutoff_value(now))})
+        filter_path = ["hits.hits._id", "hits.hits._index", "hits.hits._source"]
+        moved, s = 0, time.time()
+        while True:
+            raw = ElasticSearchDslClient.perform_raw_search(es_client, es_index._name, older, policy.batch_size, filter_path=filter_path)
+            hits = ElasticSearchDslClient.hits_of(raw.body)
+            if len(hits) == 0: break
+            cold.append(SwiftDataInternal.decode_hits(cls, hits))
+            with IndexMigration.writing(es_index._name) as migration:
+                response = es_client.bulk(operations=[dict(delete=dict(_index=h["_index"], _id=h["_id"])) for h in hits], refresh=True)
+                results = [list(item.values())[0] for item in response.body["items"]]
+                failed = [r for r in results if "error" in r]  # not_found is no error: deleted meanwhile
+                deleted = [r["_id"] for r in results if "error" not in r]
+                if migration is not None: [migration.delete(id) for id in deleted]
+            moved += len(deleted)
+            if len(failed) != 0 or len(deleted) != len(hits):
+                # NOTE: stops rather than searching again, which would find the same records for ever; the failed ones
+                # stay in both tiers (reads prefer the hot copy) until a later run moves them
+                message = f"TIERING {cls.__name__} in {index}: {len(failed)} record(s) failed to delete after moving {moved}"
+                raise elasticsearch.helpers.BulkIndexError(message, failed)
+            if len(hits) < policy.batch_size: break
+        if moved != 0: logger.info(f"TIERING {cls.__name__} in {index}: moved {moved} records to the cold tier in {time.time() - s:.1f}s")
+        return dict(moved=moved, cold=len(cold))
+
+    @classmethod
+    def tier_schedule(cls, index, every_s=3600):
+        """returns the ScheduledRun of .tier(index), i.e., Infrastructure.add_cron(Reading.tier_schedule(index))"""
+        return ScheduledRun(functools.partial(cls.tier, index), f"tiering={cls.__name__}.{index}", every_s)
+
+    @classmethod
+    def watch(cls, index, query, callback_endpoint, batch_size=100, linger_s=1.0, send=None):
+        """matches the records saved into index, or indexed into it in bulk, against the search bar query as they are
+        written, instead of re-running the query by cron; those matching are posted to callback_endpoint in batches of
+        up to batch_size, or linger_s after the first, by send(endpoint, data, rtype) (the default of Watches.set_sender
+        if None, i.e., AetherClient.request). Returns the SavedQuery: .stats(), and .close() to stop watching"""
+        send = Watches.send if send is None else send
+        if send is None: raise ValueError("SwiftData.watch requires send, or a default by Watches.set_sender (i.e., Infrastructure)")
+        predicate = SwiftDataInternal.compiled_search_bar(cls, query, local=True)  # unknown fields raise KeyError here
+        if searchbar.parse(query).is_relative():  # windows relative to now move with each record tested
+            predicate = lambda values, tokens: SwiftDataInternal.compiled_search_bar(cls, query, local=True)(values, tokens)
+        es_cls, es_index = SwiftDataInternal.build_es_class_from_swift_class(cls, index)
+        return Watches.register(SavedQuery(cls, index, es_index._name, query, predicate, callback_endpoint, SwiftDataInternal.disk_form_of,
+                                           functools.partial(SwiftDataInternal.decode, cls), send, batch_size=batch_size, linger_s=linger_s))
+
+    @classmethod
+    def expert_query(cls, index, q, max_results=50, as_columns=False, profile=False, sort=None, indices=None):
+        """performs a search using any elasticsearch-dsl Q query construction; as_columns returns dict(field=list);
+        profile=True returns (results, record) with the ElasticSearch profile, took, network and decode times;
+        sort is a list of ElasticSearch sort keys, i.e., ["-views", "ts"]; indices narrows the indices searched (i.e.,
+        the rolled indices of the periods of a window) instead of the whole index of the class"""
+        # NOTE: hits are decoded from the plain json response straight into SwiftData through the codecs of its fields;
+        # as_columns skips building objects entirely, i.e., for analytics over many hits.
+        # NOTE: queries slower than QueryLog.slow_ms, sampled or profiled are recorded; see SwiftDataBackend.query_log
+        es_client, es_cls, es_index = SwiftDataBackend.operation_context(index, cls, with_index=True)
+        profiled = profile or QueryLog.is_sampled()
+        search = functools.partial(ElasticSearchDslClient.perform_raw_search, es_client, indices or es_index._name, q, max_results, sort=sort)
+        s = time.perf_counter()
+        response = search(profile=profiled)
+        search_ms = (time.perf_counter() - s) * 1000
+        hits = ElasticSearchDslClient.hits_of(response.body)
+        decode = SwiftDataInternal.decode_hits_as_columns if as_columns else SwiftDataInternal.decode_hits
+        results, decode_ms = QueryLog.decode(cls.__name__, lambda h: decode(cls, h), hits, profiled)
+        slow = QueryLog.is_slow(search_ms + decode_ms)
+        if not (profiled or slow): return results
+        took_ms = response.body.get("took")
+        record = QueryLog.record(QueryRecord(cls_name=cls.__name__, index=index, ts=now_iso(), slow=slow,
+                                             total_ms=search_ms + decode_ms, took_ms=took_ms, decode_ms=decode_ms,
+                                             network_ms=search_ms - (took_ms or 0), n_hits=len(hits),
+                                             bytes=body_bytes(response), profile=response.body.get("profile"),
+                                             query=q.to_dict() if hasattr(q, "to_dict") else q))
+        if slow and not profiled: QueryLog.reprofile(record, search)
+        return (results, record.as_dict()) if profile else results
+
+    @classmethod
+    def query_frame(cls, index, q=None, fields=None, max_results=10000, batch_size=1000, es=True):
+        """returns a pandas DataFrame of up to max_results records matching q (a search bar string, or Q with es=True;
+        all if None) by score, with typed columns of fields (all if None; only these are requested); hits stream into
+        the columns batch_size at a time, without building SwiftData objects; see frames.FrameBuilder"""
+        return SwiftDataInternal.frame_of(cls, index, q, fields, max_results, batch_size, es, ranked=True)
+
+    @classmethod
+    def scan_frame(cls, index, q=None, fields=None, batch_size=1000, es=True):
+        """returns a pandas DataFrame of every record matching q (a search bar string, or Q with es=True; all if None),
+        in no particular order, by scroll, batch_size hits at a time; i.e., for analytics over a whole index"""
+        return SwiftDataInternal.frame_of(cls, index, q, fields, None, batch_size, es, ranked=False)
+
+    @classmethod
+    def search_bar(cls, index, s, max_results=50, es=True):
         """performs a search bar like query on a string with field prompts, i.e., "cast: david year: 1980" """
-        return cls.expert_query(index, ElasticSearchDslClient.search_bar(s), max_results=max_results)
+        # NOTE: s is parsed and compiled once per class (cached by normalized s) and unknown fields raise KeyError here,
+        # before any request is made; es=False searches the local in-process index of the filesystem records instead.
+        if es:
+            q, indices = SwiftDataInternal.routed_search_bar(cls, index, s)
+            hot = cls.expert_query(index, q, max_results=max_results, indices=indices)
+            cold, predicate = SwiftDataInternal.cold_query_of(cls, index, s)
+            if cold is None or (max_results is not None and len(hot) >= max_results): return hot
+            hot_ids = {obj.id for obj in hot}
+            found = cold.local_index().search(predicate, max_results=None if max_results is None else max_results + len(hot))
+            return (hot + [obj for obj in found if obj.id not in hot_ids])[:max_results]
+        predicate = SwiftDataInternal.compiled_search_bar(cls, s, local=True)
+        return cls.local_index(index).search(predicate, max_results=max_results)
+
+    @classmethod
+    def flagged(cls, index, flag, value, max_results=50, es=True):
+        """returns up to max_results records whose flag (field.key of a flags field, i.e., "flags.scraped") is value;
+        i.e., the next batch of a pipeline state, looked up in the per-key index of the local records with es=False"""
+        field, _, key = flag.partition(".")
+        if SwiftDataInternal.mapping_of(cls).get(field) != "Flattened" or key == "":
+            raise KeyError(f"{cls.__name__}.{flag} is not the key of a flags field")
+        if es: return cls.expert_query(index, Q("term", **{flag: value}), max_results=max_results)
+        return cls.local_index(index).flagged(field, key, value, max_results=max_results)
+
+    @classmethod
+    def stats(cls, index, field, q=None, es=True):
+        """returns dict(count, min, max, avg, sum) of a numeric field over records matching q (a search bar string, or
+        Q with es=True), if any; es=True aggregates in ElasticSearch and es=False over the numeric local columns"""
+        if SwiftDataInternal.mapping_of(cls).get(field) not in ["Integer", "Float", "Boolean"]:
+            raise KeyError(f"{cls.__name__}.{field} is not a numeric field")
+        if es:
+            _, es_cls, es_index = SwiftDataBackend.operation_context(index, cls, with_index=True)
+            indices = es_index._name
+            cold, predicate = SwiftDataInternal.cold_query_of(cls, index, q)
+            if isinstance(q, str): q, indices = SwiftDataInternal.routed_search_bar(cls, index, q)
+            hot = ElasticSearchDslClient.perform_stats(SwiftDataBackend.client.es, indices, field, q)
+            return hot if cold is None else merged_stats(hot, cold.local_index().stats(field, predicate))
+        predicate = SwiftDataInternal.local_predicate_of(cls, q, "stats")
+        return cls.local_index(index).stats(field, predicate)
+
+    @classmethod
+    def sort_by(cls, index, field, q=None, descending=False, max_results=50, es=True):
+        """returns up to max_results records matching q (a search bar string, or Q with es=True), if any, sorted by a
+        numeric field; records without a value are last"""
+        if SwiftDataInternal.mapping_of(cls).get(field) not in ["Integer", "Float", "Boolean"]:
+            raise KeyError(f"{cls.__name__}.{field} is not a numeric field")
+        if es:
+            indices = None
+            cold, predicate = SwiftDataInternal.cold_query_of(cls, index, q)
+            if isinstance(q, str): q, indices = SwiftDataInternal.routed_search_bar(cls, index, q)
+            sort = [{field: dict(order="desc" if descending else "asc", missing="_last")}]
+            hot = cls.expert_query(index, q, max_results=max_results, sort=sort, indices=indices)
+            if cold is None: return hot
+            hot_ids = {obj.id for obj in hot}
+            found = cold.local_index().sorted_by(field, predicate, descending=descending, max_results=max_results + len(hot))
+            return merged_sorted(hot, [obj for obj in found if obj.id not in hot_ids], field, descending=descending, max_results=max_results)
+        predicate = SwiftDataInternal.local_predicate_of(cls, q, "sort_by")
+        return cls.local_index(index).sorted_by(field, predicate, descending=descending, max_results=max_results)
+
+    @classmethod
+    def within(cls, index, field, center, radius, q=None, max_results=50, es=True):
+        """returns up to max_results records with a point of geopoint field within radius (meters, or i.e., "5km",
+        "3mi") of center ("lat,lng" or [lat, lng]) and matching q (a search bar string, or Q with es=True), if any; the
+        nearest first, by the nearest point of list fields"""
+        # NOTE: es=True filters by geo_distance and sorts by _geo_distance; es=False checks the points of the grid cells
+        # around center in the local index, vectorized, rather than every record
+        lat, lng = SwiftDataInternal.geopoint_query_of(cls, field, center)
+        meters = geo.parse_distance(radius)
+        if es:
+            if isinstance(q, str): q = SwiftDataInternal.compiled_search_bar(cls, q).to_query()
+            located = Q("geo_distance", distance=f"{meters}m", **{field: f"{lat},{lng}"})
+            sort = [{"_geo_distance": {field: f"{lat},{lng}", "order": "asc", "unit": "m", "mode": "min"}}]
+            return cls.expert_query(index, Q("bool", filter=[located] + ([] if q is None else [q])), max_results=max_results, sort=sort)
+        predicate = SwiftDataInternal.local_predicate_of(cls, q, "within")
+        return [obj for obj, _ in cls.local_index(index).within(field, lat, lng, meters, predicate, max_results=max_results)]
+
+    @classmethod
+    def in_bbox(cls, index, field, top_left, bottom_right, q=None, max_results=50, es=True):
+        """returns up to max_results records with a point of geopoint field within the box of top_left and bottom_right
+        ("lat,lng" or [lat, lng]) and matching q (a search bar string, or Q with es=True), if any"""
+        (top, left), (bottom, right) = [SwiftDataInternal.geopoint_query_of(cls, field, p) for p in [top_left, bottom_right]]
+        if es:
+            if isinstance(q, str): q = SwiftDataInternal.compiled_search_bar(cls, q).to_query()
+            boxed = Q("geo_bounding_box", **{field: dict(top_left=f"{top},{left}", bottom_right=f"{bottom},{right}")})
+            return cls.expert_query(index, Q("bool", filter=[boxed] + ([] if q is None else [q])), max_results=max_results)
+        predicate = SwiftDataInternal.local_predicate_of(cls, q, "in_bbox")
+        return cls.local_index(index).in_bbox(field, (top, left), (bottom, right), predicate, max_results=max_results)
+
+    @classmethod
+    def geo_grid(cls, index, field, precision=5, q=None, es=True):
+        """returns dict(geohash=number of records) of the points of geopoint field, at geohash precision (1 to 12; 5 is
+        about 5km cells), over records matching q (a search bar string, or Q with es=True), if any; i.e., for heatmaps"""
+        if SwiftDataInternal.mapping_of(cls).get(field) != "GeoPoint": raise KeyError(f"{cls.__name__}.{field} is not a geopoint field")
+        if es:
+            _, es_cls, es_index = SwiftDataBackend.operation_context(index, cls, with_index=True)
+            if isinstance(q, str): q = SwiftDataInternal.compiled_search_bar(cls, q).to_query()
+            return ElasticSearchDslClient.perform_geo_grid(SwiftDataBackend.client.es, es_index._name, field, precision, q)
+        predicate = SwiftDataInternal.local_predicate_of(cls, q, "geo_grid")
+        return cls.local_index(index).geo_grid(field, precision=precision, predicate=predicate)
+
+    @classmethod
+    def hybrid_search(cls, index, text, vector_field, vector, k=10, filter=None, fields=None, fusion="rrf",
+                      weights=(1.0, 1.0), rank_constant=60, window=None, es=True):
+        """returns the top-k records by fusing the BM25 ranking of text (over fields; all text fields if None) with the
+        kNN ranking of vector in vector_field; filter (a search bar string, or Q with es=True) applies before both;
+        fusion is "rrf" (reciprocal rank) or "weighted" (min-max normalized scores), weights are (lexical, vector)"""
+        # NOTE: es=True sends both retrievers in one _msearch request, the kNN with filter as its pre-filter so that k
+        # neighbors are found among the filtered records rather than filtered after; es=False ranks both in one pass
+        # over the local index. Each retriever ranks window (2k by default) candidates before fusion.
+        if SwiftDataInternal.mapping_of(cls).get(vector_field) != "DenseVector":
+            raise KeyError(f"{cls.__name__}.{vector_field} is not a vector field")
+        if fields is None: fields = [f for f, kind in SwiftDataInternal.mapping_of(cls).items() if kind == "Text" and f not in ["id", "ts"]]
+        window = 2 * k if window is None else window
+        if not es:
+            predicate = SwiftDataInternal.local_predicate_of(cls, filter, "hybrid_search")
+            local_index = cls.local_index(index)
+            rankings = local_index.rank(predicate, query_tokens=searchbar.analyze(text) if text else None, fields=fields,
+                                        vector_field=vector_field, vector=vector, k=window)
+            pairs = [(ranking, weight) for ranking, weight in zip(rankings, weights) if ranking is not None]
+            fused = rank_fusion.fuse([r for r, _ in pairs], fusion, [w for _, w in pairs], rank_constant)
+            return [local_index.get(id) for id, _ in fused[:k]]
+        es_client, es_cls, es_index = SwiftDataBackend.operation_context(index, cls, with_index=True)
+        if isinstance(filter, str): filter = SwiftDataInternal.compiled_search_bar(cls, filter).to_query()
+        filters = [] if filter is None else [filter.to_dict() if hasattr(filter, "to_dict") else filter]
+        searches, search_weights = [], []
+        if text:
+            lexical = Q("bool", must=[Q("multi_match", query=text, fields=fields)], filter=filters)
+            searches.append(dict(size=window, query=lexical.to_dict()))
+            search_weights.append(weights[0])
+        if vector is not None:
+            # NOTE: the query vector is encoded as the field is indexed, i.e., quantized into bytes for int8 fields
+            query_vector = dict(SwiftDataInternal.encoders_of(cls))[vector_field](vector)
+            knn = dict(field=vector_field, query_vector=query_vector, k=window, num_candidates=max(100, 2 * window), filter=filters)
+            searches.append(dict(size=window, knn=knn))
+            search_weights.append(weights[1])
+        if len(searches) == 0: return []
+        body = [line for search in searches for line in [dict(index=es_index._name), search]]
+        responses = es_client.msearch(searches=body).body["responses"]
+        rankings, sources = [], dict()
+        for response in responses:
+            if "error" in response: raise RuntimeError(f"hybrid_search of {cls.__name__} in {index} failed: {response['error']}")
+            hits = ElasticSearchDslClient.hits_of(response)
+            rankings.append([(h["_id"], h["_score"]) for h in hits])
+            sources.update((h["_id"], h) for h in hits)
+        fused = rank_fusion.fuse(rankings, fusion, search_weights, rank_constant)
+        return SwiftDataInternal.decode_hits(cls, [sources[id] for id, _ in fused[:k]])
+
+    @classmethod
+    def suggest(cls, index, field, prefix, k=10, es=True):
+        """returns up to k completions of prefix from the values of field, declared as sd.string(suggest=True); for
+        search-as-you-type, i.e., per keystroke, where a search_bar query per keystroke is too slow"""
+        # NOTE: es=True asks the ElasticSearch completion suggester of field.suggest (whole values by prefix) and es=False
+        # the Completions of the local index (the most frequent values first); the top-k of hot prefixes are cached by
+        # SuggestCache, local entries until the next write and ElasticSearch entries for SuggestCache.ttl_s
+        if field not in SwiftDataInternal.suggest_fields_of(cls): raise KeyError(f"{cls.__name__}.{field} is not a suggest field")
+        if es:
+            key = (cls.__name__, index, field, normalize(prefix), k, None)
+            cached = SuggestCache.get(key)
+            if cached is not None: return cached
+            es_client, es_cls, es_index = SwiftDataBackend.operation_context(index, cls, with_index=True)
+            completions = ElasticSearchDslClient.perform_suggest(es_client, es_index._name, field, prefix, k=k)
+            return SuggestCache.put(key, completions, ttl_s=SuggestCache.ttl_s)
+        local_index = cls.local_index(index)
+        key = (cls.__name__, index, field, normalize(prefix), k, local_index.generation(field))
+        cached = SuggestCache.get(key)
+        if cached is not None: return cached
+        return SuggestCache.put(key, local_index.complete(field, prefix, k=k))
+
+    @classmethod
+    def query_records(cls, index=None, slow_only=False):
+        """returns the recorded slow, sampled and profiled queries of this class (in index if given) as dicts"""
+        return QueryLog.query(cls_name=cls.__name__, index=index, slow_only=slow_only)
+
+    @classmethod
+    def explain(cls, s):
+        """returns the search_bar query plan of s: which clauses are scored and which are cached exact filters"""
+        return SwiftDataInternal.compiled_search_bar(cls, s).explain()
+
+    @classmethod
+    def local_index(cls, index, fresh=False):
+        """returns the in-process index of the local filesystem records; built on first use; fresh=True rebuilds it"""
+        load = lambda: cls.getAll(index, es=False, max_results=None)
+        return LocalIndex.of(cls, index, SwiftDataInternal.mapping_of(cls), load, fresh=fresh,
+                             suggest_fields=SwiftDataInternal.suggest_fields_of(cls), buckets=SwiftDataInternal.buckets_of(cls))
 
     @classmethod
     def search_any(cls, index, s, fields=None, max_results=50):
@@ -228,40 +640,105 @@ class SwiftDataBackend(object):
     server = None
     client = None
     swiftdata_base_directory = "file://" + os.path.join(RuntimeConfig.directory_base_local, "_subsystem/swiftdata/")
+    local_counts = dict()  # map from (index, cls_name) => number of records on the local filesystem; see .count()
+    local_counts_lock = threading.Lock()
+    engines = ["docker", "embedded"]
+    startup_timings = dict()
+    snapshot_managers = dict()  # map from applet => SnapshotManager; rebound to the client of each start
 
-    def start(self, password, exist_ok=False, rebuild=False):
+    def start(self, password=None, exist_ok=False, rebuild=False, engine="docker", profile=None, heap_mb=None):
+        """Starts ElasticSearch: engine="docker" runs the ElasticSearch server, "embedded" the in-process engine."""
+        # NOTE: the embedded engine serves the same es=True apis without docker or a JVM, i.e., for ci, edge devices and
+        # benchmarks; its indices persist under swiftdata_base_directory/_embedded/elasticsearch at .stop().
+        # NOTE: profile is the TransportProfile of the connection, i.e., TransportProfile.for_concurrency(n_threads) to
+        # size the connection pool to the servlet; it does not apply to the embedded engine which has no connection.
+        # NOTE: heap_mb is the JVM heap of a newly created server, half of the host memory by default; startup_timings
+        # records the seconds of each startup phase: remove (if rebuild), container create or start, and readiness.
+        if engine not in SwiftDataBackend.engines: raise ValueError(f"engine must be one of {SwiftDataBackend.engines}")
         if not exist_ok and (SwiftDataBackend.server is not None or SwiftDataBackend.client is not None):
             raise RuntimeError("SwiftDataBackend has previously been started and is not intended for parallelization.")
+        if engine == "embedded":
+            directory = os.path.join(SwiftDataBackend.swiftdata_base_directory, "_embedded/elasticsearch")[len("file://"):]
+            SwiftDataBackend.server = EmbeddedElasticSearchServer(directory=directory, rebuild=rebuild)
+            SwiftDataBackend.client = EmbeddedElasticSearchClient(SwiftDataBackend.server)
+            return self.__rebind_snapshot_managers()
+        if password is None: raise ValueError("password is required for the docker ElasticSearch engine")
+        s = time.time()
         if rebuild: ElasticSearchServer.force_delete()
-        SwiftDataBackend.server = ElasticSearchServer(password=password, exist_ok=exist_ok, run_ok=exist_ok)
-        SwiftDataBackend.client = ElasticSearchClient(password=password)
-        SwiftDataBackend.client.wait_for_active()
+        timings = dict(remove_s=time.time() - s) if rebuild else dict()
+        SwiftDataBackend.server = ElasticSearchServer(password=password, exist_ok=exist_ok, run_ok=exist_ok, heap_mb=heap_mb)
+        SwiftDataBackend.client = ElasticSearchClient(password=password, profile=profile)
+        timings.update(SwiftDataBackend.server.timings)
+        timings.update(SwiftDataBackend.client.wait_for_ready(status="yellow"))
+        timings["total_s"] = time.time() - s
+        SwiftDataBackend.startup_timings = timings
+        logger.info(f"ElasticSearch ready in {timings['total_s']:.1f}s: " + ", ".join(f"{k}={v:.2f}" for k, v in timings.items()))
+        return self.__rebind_snapshot_managers()
+
+    def __rebind_snapshot_managers(self):
+        """Binds the SnapshotManagers of a previous start (i.e., held by the crons of Infrastructure) to the new client"""
+        for manager in SwiftDataBackend.snapshot_managers.values(): manager.client = SwiftDataBackend.client
         return self
 
-    def stop(self, not_exist_ok=False): ElasticSearchServer.stop(not_exist_ok=not_exist_ok)
+    def stop(self, not_exist_ok=False):
+        if isinstance(SwiftDataBackend.server, EmbeddedElasticSearchServer): SwiftDataBackend.server.stop()
+        else: ElasticSearchServer.stop(not_exist_ok=not_exist_ok)
 
-    def snapshot_save(self, applet):
+    def transport_metrics(self):
+        """Returns the connection pool metrics of the ElasticSearch client; see TransportMetrics.snapshot()."""
+        self.__throwing_integrity_check()
+        return self.client.transport_metrics()
+
+    def bulk_indexer(self, **kwargs):
+        """Returns a started BulkIndexer: many producer threads may .add(); close() flushes and returns its metrics."""
+        # NOTE: documents indexed into watched indices are matched against their saved queries; see SwiftData.watch
         self.__throwing_integrity_check()
-        directory = os.path.join(SwiftDataBackend.swiftdata_base_directory, "_snapshots/elasticsearch/_applet", applet)[len("file://"):]
-        self.client.snapshot_directory_set(directory, applet)
+        watching = dict(watched=Watches.is_watched, on_indexed=lambda docs: Watches.match_indexed(docs, SwiftDataInternal.text_fields_of))
+        return self.client.bulk_indexer(**(watching | kwargs))
+
+    def query_log(self, slow_ms=None, sample_rate=0.0, max_records=1000, reprofile_every_s=10.0):
+        """Configures slow query capture: queries over slow_ms, and a sample_rate of all queries, are recorded per
+        class and index with took, network, decode and bytes; see SwiftData.query_records. Returns the QueryLog."""
+        return QueryLog.configure(slow_ms=slow_ms, sample_rate=sample_rate, max_records=max_records,
+                                  reprofile_every_s=reprofile_every_s)
+
+    def snapshots(self, applet, **schedule):
+        """Returns the SnapshotManager of applet: scheduled incremental snapshots (see Infrastructure.add_cron);
+        schedule sets any of every_s, keep_last, max_age_s and indices, i.e., snapshots(applet, every_s=900)"""
+        self.__throwing_integrity_check()
+        unknown = [k for k in schedule if k not in ["every_s", "keep_last", "max_age_s", "indices"]]
+        if len(unknown) != 0: raise KeyError(f"unknown snapshot schedule parameters: {unknown}")
+        if applet not in SwiftDataBackend.snapshot_managers:
+            directory = os.path.join(SwiftDataBackend.swiftdata_base_directory, "_snapshots/elasticsearch/_applet", applet)[len("file://"):]
+            SwiftDataBackend.snapshot_managers[applet] = SnapshotManager(self.client, applet, directory)
+        manager = SwiftDataBackend.snapshot_managers[applet]
+        for k, v in schedule.items(): setattr(manager, k, v)
+        return manager
+
+    def snapshot_save(self, applet):
+        self.snapshots(applet).ensure_repository()
         return self.client.snapshot_save(applet)
 
     def snapshot_load(self, applet, save_name):
-        self.__throwing_integrity_check()
-        directory = os.path.join(SwiftDataBackend.swiftdata_base_directory, "_snapshots/elasticsearch/_applet", applet)[len("file://"):]
-        self.client.snapshot_directory_set(directory, applet)
+        self.snapshots(applet).ensure_repository()
         return self.client.snapshot_load(applet, save_name)
 
+    def snapshot_restore(self, applet, save_name=None, classes=None, index=None, wait=False):
+        """Restores the indices of classes in index (all of index if classes is None; all if both are) from save_name
+        (the latest if None) without blocking; returns a RestoreProgress, i.e., .progress() is bytes/s and remaining_s"""
+        if classes is not None:
+            if index is None: raise ValueError("index is required to restore the indices of classes")
+            # NOTE: name* is the index of each class and its versions behind its alias; see SwiftData.migrate
+            indices = [f"{SwiftDataInternal.build_es_class_from_swift_class(cls, index)[1]._name}*" for cls in classes]
+        else: indices = ["*"] if index is None else [f"index.{index}.*".lower()]
+        return self.snapshots(applet).restore(save_name, indices=indices, wait=wait)
+
     def snapshot_latest(self, applet):
-        self.__throwing_integrity_check()
-        directory = os.path.join(SwiftDataBackend.swiftdata_base_directory, "_snapshots/elasticsearch/_applet", applet)[len("file://"):]
-        self.client.snapshot_directory_set(directory, applet)
+        self.snapshots(applet).ensure_repository()
         return self.client.snapshot_latest(applet)
 
     def snapshot_list(self, applet, n_most_recent=10):
-        self.__throwing_integrity_check()
-        directory = os.path.join(SwiftDataBackend.swiftdata_base_directory, "_snapshots/elasticsearch/_applet", applet)[len("file://"):]
-        self.client.snapshot_directory_set(directory, applet)
+        self.snapshots(applet).ensure_repository()
         return self.client.snapshot_list(applet, n_most_recent=n_most_recent)
 
     @staticmethod
@@ -273,14 +750,63 @@ class SwiftDataBackend(object):
         return (SwiftDataBackend.client.es, es_cls, es_index) if with_index else (SwiftDataBackend.client.es, es_cls)
 
     @staticmethod
-    def create_stub(id, cls_name, index, tags=None):
-        """Builds /{index}/{tag1}/{value1}/{tag2}/{value2}/swift.{cls_name}/ and swift.{index}.{cls_name}.{id}.json"""
+    def create_stub(id, cls_name, index, tags=None, period=None):
+        """Builds /{index}/{tag1}/{value1}/{tag2}/{value2}/swift.{cls_name}/ and swift.{index}.{cls_name}.{id}.json;
+        records of classes with a rollover policy are within the directory of their period, swift.{cls_name}/{period}/"""
         if tags is None: tags = dict()
         directory = create_programmatic_directory(SwiftDataBackend.swiftdata_base_directory, tags)
         directory = os.path.join(directory, "_index", index, f"swift.{cls_name}/")
+        if period is not None: directory = os.path.join(directory, f"{period}/")
         if id is None: return directory.lower()
         return os.path.join(directory, SwiftDataBackend.__stub_basename(index, cls_name, id)).lower()
 
+    @staticmethod
+    def local_periods(cls, index):
+        """The period directories of a class with a rollover policy, the oldest first."""
+        directory = SwiftDataBackend.create_stub(None, cls.__name__, index)
+        if cls.rollover_policy is None or not FileSystem.easy_exists(directory): return []
+        return sorted(FileSystem.easy_listdirs(directory))
+
+    @staticmethod
+    def local_stubs(cls, index, periods=None):
+        """Returns [(id, stub)] of the local records of a class; of the period directories (all if None) with rollover."""
+        pattern = re.compile(f"swift.{index}.{cls.__name__}.(.*?).json".lower())
+        if cls.rollover_policy is None: periods = [None]
+        elif periods is None: periods = SwiftDataBackend.local_periods(cls, index)
+        stubs = []
+        for period in periods:
+            directory = SwiftDataBackend.create_stub(None, cls.__name__, index, period=period)
+            if not FileSystem.easy_exists(directory): continue  # nothing has been saved into the index yet
+            matches = [pattern.match(filename) for filename in FileSystem.easy_listdir(directory)]
+            stubs.extend((match.group(1), os.path.join(directory, match.group(0))) for match in matches if match)
+        return stubs
+
+    @staticmethod
+    def local_stub_of(cls, index, id):
+        """The stub of a local record; of classes with a rollover policy, in the newest period directory holding it."""
+        if cls.rollover_policy is None: return SwiftDataBackend.create_stub(id, cls.__name__, index)
+        for period in reversed(SwiftDataBackend.local_periods(cls, index)):
+            stub = SwiftDataBackend.create_stub(id, cls.__name__, index, period=period)
+            if FileSystem.easy_exists(stub): return stub
+        return SwiftDataBackend.create_stub(id, cls.__name__, index, period=cls.rollover_policy.key_of(None))
+
+    @staticmethod
+    def local_count_is_seeded(index, cls_name): return (index, cls_name) in SwiftDataBackend.local_counts
+
+    @staticmethod
+    def local_count(index, cls_name): return SwiftDataBackend.local_counts[(index, cls_name)]
+
+    @staticmethod
+    def local_count_seed(index, cls_name, n):
+        with SwiftDataBackend.local_counts_lock: SwiftDataBackend.local_counts[(index, cls_name)] = n
+
+    @staticmethod
+    def local_count_add(index, cls_name, n):
+        """Maintains the cached local count; unseeded counts are ignored because the first .count() lists them."""
+        with SwiftDataBackend.local_counts_lock:
+            if (index, cls_name) in SwiftDataBackend.local_counts:
+                SwiftDataBackend.local_counts[(index, cls_name)] = max(0, SwiftDataBackend.local_counts[(index, cls_name)] + n)
+
     @staticmethod
     def __stub_basename(index, cls_name, id): return f"swift.{index}.{cls_name}.{id}.json".lower()
 
@@ -297,10 +823,20 @@ class SwiftDataBackend(object):
 ########################################################################################################################
 
 
+class Flattened(Field):
+    """The ElasticSearch flattened field: one field for all keys of an object, each key an exact keyword value."""
+    # NOTE: keys of sd.flags (pipeline states) are open-ended; object fields would map every new key, flattened does not
+    name = "flattened"
+
+
 class SwiftDataInternal(object):
 
     already_built = dict()  # map from SD base_cls => (ESD, ESD Index)  objects already built.
-    fieldmap = {cls.__name__: cls for cls in [Keyword, Text, Integer, Float, Date, Boolean, DenseVector, GeoPoint]}
+    mappings = dict()       # map from SD cls => dict(field=es_field_cls_name); see mapping_of
+    codecs = dict()         # map from SD cls => [(field, decode)]; see codecs_of
+    encoders = dict()       # map from SD cls => [(field, encode)] of fields whose ElasticSearch form differs; see encoders_of
+    fieldmap = {cls.__name__: cls for cls in [Keyword, Text, Integer, Float, Date, Boolean, DenseVector, GeoPoint, Object,
+                                              Flattened]}
 
     @staticmethod
     def build_es_class_from_swift_class(swift_cls, prefix=None):
@@ -310,21 +846,22 @@ class SwiftDataInternal(object):
         es_cls_name = f"{prefix}{swift_cls.__name__}.ElasticSearchDocument"
         if es_cls_name in SwiftDataInternal.already_built: return SwiftDataInternal.already_built[es_cls_name]
 
-        es_cls = type(es_cls_name, (Document,), dict())  # Build the base ESD with no attributes.
+        # NOTE: fields must be attributes at class creation; the Document metaclass only maps the fields it is created
+        # with, fields set afterwards are left out of the index mapping (and ElasticSearch would map them dynamically)
+        es_fields = dict()
         for field in dataclasses.fields(swift_cls):
-            if hasattr(field.type, "__es_field_cls_name"):  # expect every non-SwiftData build basic field to have these
-                es_field_cls_name = getattr(field.type, "__es_field_cls_name")
-                es_parameters = getattr(field.type, "__es_parameters")  # expect every SwiftData class to have these
-            else:  # using a derived class
-                try: es_parameters, es_field_cls_name = field.type.__origin__ == dict(multi=True), field.type.__args__[0].__name__
-                except AttributeError: es_parameters, es_field_cls_name = dict(multi=False), field.type.__name__
+            es_field_cls_name, es_parameters = SwiftDataInternal.es_field_of(field)
+            es_parameters = SwiftDataInternal.es_parameters_of(es_field_cls_name, es_parameters)
             if es_field_cls_name in SwiftDataInternal.fieldmap:
                 es_field = SwiftDataInternal.fieldmap[es_field_cls_name](**es_parameters)
             elif es_field_cls_name in SwiftDataInternal.already_built:
                 # if specified as list[EXISTING] need to do the split here; base_cls=EXISTING
                 es_field = SwiftDataInternal.already_built[es_field_cls_name](**es_parameters)
             else: raise KeyError(f"SwiftData {swift_cls.__name__} has unsupported field {field.name}={field.type}")
-            setattr(es_cls, field.name, es_field)  # add to the base ESD
+            es_fields[field.name] = es_field
+            for width, _ in getattr(field.type, "buckets", ()):  # the hidden bucket fields of timestamps
+                es_fields[timebuckets.bucket_field(field.name, width)] = Keyword(multi=es_parameters["multi"])
+        es_cls = type(es_cls_name, (Document,), es_fields)
 
         # create Index for each
         es_index = Index(f"index.{es_cls.__name__}".lower())
@@ -333,7 +870,237 @@ class SwiftDataInternal(object):
         return SwiftDataInternal.already_built[es_cls_name]
 
     @staticmethod
-    def swiftdata_obj_es_init(swift_obj): return vars(swift_obj) | dict(meta=dict(id=swift_obj.id))
+    def es_field_of(field):
+        """Returns the (es_field_cls_name, es_parameters) of a SwiftData dataclass field."""
+        if hasattr(field.type, "__es_field_cls_name"):  # expect every non-SwiftData build basic field to have these
+            return getattr(field.type, "__es_field_cls_name"), getattr(field.type, "__es_parameters")
+        try: return field.type.__args__[0].__name__, dict(multi=field.type.__origin__ == list)  # using a derived class
+        except AttributeError: return field.type.__name__, dict(multi=False)
+
+    @staticmethod
+    def es_parameters_of(es_field_cls_name, parameters):
+        """Translates SwiftData field parameters into the parameters of its elasticsearch-dsl field."""
+        es_parameters = dict(multi=parameters.get("multi", parameters.get("is_list", False)))
+        if parameters.get("dont_index"):
+            if es_field_cls_name == "Object": es_parameters["enabled"] = False
+            else: es_parameters["index"] = False
+        if "n_dims" in parameters: es_parameters["dims"] = parameters["n_dims"]
+        if "dtype" in parameters:
+            # NOTE: ElasticSearch has no float16 vectors; float32 and float16 are indexed as int8 quantized HNSW (a quarter
+            # of the memory of the float graph, rescored from the floats), int8 vectors are byte vectors as they are
+            es_parameters["element_type"] = "byte" if parameters["dtype"] == "int8" else "float"
+            if not parameters.get("dont_index"):
+                es_parameters["index_options"] = dict(type="hnsw" if parameters["dtype"] == "int8" else "int8_hnsw")
+        if parameters.get("suggest"): es_parameters["fields"] = dict(suggest=Completion())
+        return es_parameters
+
+    @staticmethod
+    def text_fields_of(swift_cls):
+        """Returns the names of the Text fields of swift_cls, whose values search bar predicates test as tokens."""
+        return [field for field, kind in SwiftDataInternal.mapping_of(swift_cls).items() if kind == "Text"]
+
+    @staticmethod
+    def suggest_fields_of(swift_cls):
+        """Returns the names of the fields of swift_cls declared with suggest=True."""
+        return [f.name for f in dataclasses.fields(swift_cls) if SwiftDataInternal.es_field_of(f)[1].get("suggest")]
+
+    @staticmethod
+    def buckets_of(swift_cls):
+        """Returns dict(field=[(width, seconds)]) of the timestamp fields of swift_cls declared with buckets."""
+        return {f.name: f.type.buckets for f in dataclasses.fields(swift_cls) if getattr(f.type, "buckets", None)}
+
+    @staticmethod
+    def rolled_of(swift_cls, prefix):
+        """Returns the RolledIndex of a class with a rollover policy in prefix (the index), or None."""
+        if swift_cls.rollover_policy is None: return None
+        es_cls, es_index = SwiftDataInternal.build_es_class_from_swift_class(swift_cls, prefix)
+        return RolledIndex.of(SwiftDataBackend.client.es, es_index, swift_cls.rollover_policy)
+
+    @staticmethod
+    def routed_search_bar(swift_cls, prefix, s):
+        """Returns (query, indices) of search bar s: indices are those of the periods of its windows on the rollover
+        field (see RolledIndex.routed), or the index of the class; evaluated per call, as windows may be relative"""
+        plan = SwiftDataInternal.compiled_search_bar(swift_cls, s)
+        es_cls, es_index = SwiftDataInternal.build_es_class_from_swift_class(swift_cls, prefix)
+        policy = swift_cls.rollover_policy
+        if policy is None or policy.field not in plan.windows: return plan.to_query(), es_index._name
+        routed = SwiftDataInternal.rolled_of(swift_cls, prefix).routed(plan.windows[policy.field])
+        return plan.to_query(), es_index._name if routed is None else ",".join(routed)
+
+    @staticmethod
+    def cold_of(swift_cls, prefix):
+        """Returns the ColdStore of a class with a tiering policy in prefix (the index), or None."""
+        if swift_cls.tiering_policy is None: return None
+        directory = SwiftDataBackend.create_stub(None, f"{swift_cls.__name__}.cold", prefix)
+        index_kwargs = dict(mapping=SwiftDataInternal.mapping_of(swift_cls), suggest_fields=SwiftDataInternal.suggest_fields_of(swift_cls),
+                            buckets=SwiftDataInternal.buckets_of(swift_cls))
+        return ColdStore.of(swift_cls, prefix, directory, SwiftDataInternal.disk_form_of,
+                            functools.partial(SwiftDataInternal.decode, swift_cls), index_kwargs)
+
+    @staticmethod
+    def cold_query_of(swift_cls, prefix, q):
+        """Returns (ColdStore, local predicate or None for all) of query q (a search bar string or None) on the cold tier;
+        (None, None) without a tiering policy, for Q (the hot tier only) or when a window on the tier field starts after
+        the cutoff, as no cold record can match"""
+        cold = SwiftDataInternal.cold_of(swift_cls, prefix)
+        if cold is None or q is None: return cold, None
+        if not isinstance(q, str): return None, None
+        field = swift_cls.tiering_policy.field
+        windows = SwiftDataInternal.compiled_search_bar(swift_cls, q).windows.get(field, [])
+        if any(all(swift_cls.tiering_policy.is_hot_window(bounds) for bounds in values) for values in windows): return None, None
+        return cold, SwiftDataInternal.compiled_search_bar(swift_cls, q, local=True)
+
+    @staticmethod
+    def match_watches(swift_cls, prefix, objects):
+        """Tests written records against the saved queries watched on swift_cls in prefix (the index), if any."""
+        if len(Watches.registered) == 0: return 0
+        es_cls, es_index = SwiftDataInternal.build_es_class_from_swift_class(swift_cls, prefix)
+        return Watches.match(es_index._name, objects, SwiftDataInternal.text_fields_of(swift_cls))
+
+    @staticmethod
+    def frame_of(swift_cls, prefix, q, fields, max_results, batch_size, es, ranked):
+        """Builds the DataFrame of query_frame (ranked) and scan_frame; the cold tier of a tiered class follows the hot."""
+        mapping = SwiftDataInternal.mapping_of(swift_cls)
+        fields = list(mapping) if fields is None else ["id"] + [f for f in fields if f != "id"]
+        unknown = [f for f in fields if f not in mapping]
+        if len(unknown) != 0: raise KeyError(f"{swift_cls.__name__} has no fields {unknown}")
+        builder = FrameBuilder(fields, mapping, SwiftDataInternal.codecs_of(swift_cls))
+        add_records = lambda objs: [builder.add([vars(obj) for obj in objs[i:i + batch_size]]) for i in range(0, len(objs), batch_size)]
+        if not es:
+            predicate = SwiftDataInternal.local_predicate_of(swift_cls, q, "query_frame" if ranked else "scan_frame")
+            if predicate is None: predicate = lambda values, tokens: True
+            add_records(swift_cls.local_index(prefix).search(predicate, max_results=max_results))
+            return builder.frame()
+        es_client, es_cls, es_index = SwiftDataBackend.operation_context(prefix, swift_cls, with_index=True)
+        cold, predicate = SwiftDataInternal.cold_query_of(swift_cls, prefix, q)
+        indices = es_index._name
+        if isinstance(q, str): q, indices = SwiftDataInternal.routed_search_bar(swift_cls, prefix, q)
+        source, hot_ids = [f for f in fields if f != "id"], set()
+        for hits in ElasticSearchDslClient.scan_batches(es_client, indices, q, source=source, batch_size=batch_size,
+                                                        preserve_order=ranked, max_results=max_results):
+            builder.add([h.get("_source", dict()) for h in hits], ids=[h["_id"] for h in hits])
+            if cold is not None: hot_ids.update(h["_id"] for h in hits)
+        if cold is None or (max_results is not None and builder.n >= max_results): return builder.frame()
+        remaining = None if max_results is None else max_results - builder.n
+        if predicate is not None:
+            add_records([obj for obj in cold.local_index().search(predicate, max_results=None) if obj.id not in hot_ids][:remaining])
+            return builder.frame()
+        for sources in cold.batches():
+            sources = [source for source in sources if source["id"] not in hot_ids][:remaining]
+            builder.add(sources)
+            if remaining is not None:
+                remaining -= len(sources)
+                if remaining == 0: break
+        return builder.frame()
+
+    @staticmethod
+    def geopoint_query_of(swift_cls, field, point):
+        """(lat, lng) of a point of a geo query on field; raises KeyError if field is not a geopoint field"""
+        if SwiftDataInternal.mapping_of(swift_cls).get(field) != "GeoPoint": raise KeyError(f"{swift_cls.__name__}.{field} is not a geopoint field")
+        return geo.parse_point(point)
+
+    @staticmethod
+    def mapping_of(swift_cls):
+        """Returns dict(field=es_field_cls_name) of a SwiftData class; i.e., Keyword, Text, Date, Integer, etc."""
+        if swift_cls not in SwiftDataInternal.mappings:
+            SwiftDataInternal.mappings[swift_cls] = {f.name: SwiftDataInternal.es_field_of(f)[0] for f in dataclasses.fields(swift_cls)}
+        return SwiftDataInternal.mappings[swift_cls]
+
+    @staticmethod
+    def compiled_search_bar(swift_cls, s, local=False):
+        """Returns the SearchBarPlan (or local predicate) of search bar s for swift_cls; cached by class and normalized s,
+        unless s has bounds relative to now (now-1d), which are resolved again each time it is compiled"""
+        s = searchbar.normalize(s)
+        if searchbar.parse(s).is_relative(): return SwiftDataInternal._compiled_search_bar.__wrapped__(swift_cls, s, local)
+        return SwiftDataInternal._compiled_search_bar(swift_cls, s, local)
+
+    @staticmethod
+    def local_predicate_of(swift_cls, q, operation):
+        """Returns the local predicate of q (a search bar string) for es=False, or None if q is None; the local index has
+        no query dsl, so a Q (or dict) raises NotImplementedError naming the operation"""
+        if q is None: return None
+        if not isinstance(q, str):
+            raise NotImplementedError(f"SwiftData {swift_cls.__name__}.{operation} by Q is supported for es=True only; "
+                                      f"es=False (the local index) takes search bar strings, i.e., \"field:value\"")
+        return SwiftDataInternal.compiled_search_bar(swift_cls, q, local=True)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=4096)
+    def _compiled_search_bar(swift_cls, s, local):
+        query, mapping = searchbar.parse(s), SwiftDataInternal.mapping_of(swift_cls)
+        buckets = SwiftDataInternal.buckets_of(swift_cls)
+        if local: return searchbar.compile_to_local(query, mapping, name=swift_cls.__name__, buckets=buckets)
+        return SearchBarPlan.compile(query, mapping=mapping, name=swift_cls.__name__, buckets=buckets)
+
+    @staticmethod
+    def codecs_of(swift_cls):
+        """Returns [(field, decode)] which bring stored or transported values into their object form as .new() does."""
+        # NOTE: decode is None for fields kept as is; field types may define upon_decode as a one step shortcut of
+        # upon_get(upon_set(value)), i.e., to parse a timestamp once instead of parse, format, and parse again.
+        if swift_cls not in SwiftDataInternal.codecs:
+            codecs = []
+            for field in dataclasses.fields(swift_cls):
+                t = field.type
+                if hasattr(t, "upon_decode"): decode = t.upon_decode
+                elif hasattr(t, "upon_set") and hasattr(t, "upon_get"): decode = lambda value, t=t: t.upon_get(t.upon_set(value))
+                elif hasattr(t, "upon_set"): decode = t.upon_set
+                else: decode = None
+                codecs.append((field.name, decode))
+            SwiftDataInternal.codecs[swift_cls] = codecs
+        return SwiftDataInternal.codecs[swift_cls]
+
+    @staticmethod
+    def decode(swift_cls, source, id=None):
+        """Builds the SwiftData object of a stored or transported dict, i.e., a json file or an ES hit _source"""
+        values = dict()
+        for name, decode in SwiftDataInternal.codecs_of(swift_cls):
+            value = source.get(name)
+            values[name] = value if decode is None or value is None else decode(value)
+        if id is not None: values["id"] = id
+        return swift_cls(**values)
+
+    @staticmethod
+    def disk_form_of(swift_obj):
+        """Returns the dict of a SwiftData object as stored on the local filesystem."""
+        as_dict = swift_obj.as_dict()
+        for field in dataclasses.fields(swift_obj.__class__):
+            if hasattr(field.type, "upon_disk_storage") and field.name in as_dict:
+                as_dict[field.name] = field.type.upon_disk_storage(as_dict[field.name])
+        return as_dict
+
+    @staticmethod
+    def decode_hits(swift_cls, hits):
+        return [SwiftDataInternal.decode(swift_cls, h.get("_source", dict()), id=h["_id"]) for h in hits]
+
+    @staticmethod
+    def decode_hits_as_columns(swift_cls, hits):
+        """Decodes hits column by column into dict(field=list of values) without building any SwiftData objects"""
+        sources = [h.get("_source", dict()) for h in hits]
+        columns = dict()
+        for name, decode in SwiftDataInternal.codecs_of(swift_cls):
+            column = [source.get(name) for source in sources]
+            if decode is not None: column = [value if value is None else decode(value) for value in column]
+            columns[name] = column
+        columns["id"] = [h["_id"] for h in hits]
+        return columns
+
+    @staticmethod
+    def encoders_of(swift_cls):
+        """Returns [(field, encode)] of the fields whose ElasticSearch form differs from their object form."""
+        if swift_cls not in SwiftDataInternal.encoders:
+            SwiftDataInternal.encoders[swift_cls] = [(f.name, f.type.upon_index) for f in dataclasses.fields(swift_cls)
+                                                     if hasattr(f.type, "upon_index")]
+        return SwiftDataInternal.encoders[swift_cls]
+
+    @staticmethod
+    def swiftdata_obj_es_init(swift_obj):
+        values = vars(swift_obj) | dict(meta=dict(id=swift_obj.id))
+        for name, encode in SwiftDataInternal.encoders_of(swift_obj.__class__): values[name] = encode(values.get(name))
+        for name, widths in SwiftDataInternal.buckets_of(swift_obj.__class__).items():
+            for width, seconds in widths:
+                keys = timebuckets.bucket_keys(values.get(name), seconds)
+                values[timebuckets.bucket_field(name, width)] = keys if isinstance(values.get(name), (list, tuple)) else (keys or [None])[0]
+        return values
 
     @staticmethod
     def es_obj_swiftdata_init(es_obj):
@@ -1,37 +1,60 @@
+from cloudnode.base.core.elasticsearch import timebuckets
 import datetime
 import dateparser
 import hashlib
+import base64
+import numpy
 import json
 
 
+def parse_datetime(value):
+    """Parses isoformat strings natively (fast) and falls back to dateparser for every other readable format."""
+    try: return datetime.datetime.fromisoformat(value)
+    except ValueError: return dateparser.parse(value)
+
+
 class TIMESTAMP(str):
-    description = "TIMESTAMP is any string parsable or datetime object; e.g., '2/2/20', isoformat string, .now()"
+    description = "TIMESTAMP is any string parsable or datetime object; e.g., '2/2/20', isoformat string, .now(); " \
+                  "buckets=['5m', '1h', '1d'] rewrites window filters into exact matches of hidden bucket fields"
+
+    buckets = ()  # derived fields set the [(width, seconds)] of sd.timestamp(buckets=...), the widest first
 
     @staticmethod
     def upon_disk_storage(value):
-        return value.isoformat()
+        if isinstance(value, (list, tuple)): return [TIMESTAMP.upon_disk_storage(v) for v in value]
+        return None if value is None else value.isoformat()
 
     @staticmethod
     def upon_get(value):
         if value is None: return None
-        dt = dateparser.parse(value)
+        if isinstance(value, (list, tuple)): return [TIMESTAMP.upon_get(v) for v in value]
+        dt = parse_datetime(value)
         return dt
 
     @staticmethod
     def upon_set(value):
         if value is None: return None
+        if isinstance(value, (list, tuple)): return [TIMESTAMP.upon_set(v) for v in value]
         if isinstance(value, datetime.datetime): value = value.isoformat()
-        elif isinstance(value, str): value = dateparser.parse(value).isoformat()
+        elif isinstance(value, str): value = parse_datetime(value).isoformat()
         else: raise ValueError("unrecognized format not datetime or str")
         return value
 
+    @staticmethod
+    def upon_decode(value):
+        """stored or transported value into its object form in one parse; the same as upon_get(upon_set(value))"""
+        if value is None or isinstance(value, datetime.datetime): return value
+        if isinstance(value, (list, tuple)): return [TIMESTAMP.upon_decode(v) for v in value]
+        return parse_datetime(value)
+
 
 class TEXT(str):
-    description = "TEXT can support tokenized searchable language (analyze=true) or exact match i.e., keywords."
+    description = "TEXT can support tokenized searchable language (analyze=true) or exact match i.e., keywords; " \
+                  "suggest=true adds search-as-you-type completions, see SwiftData.suggest"
 
 
 class FLAGS(str):
-    description = "FLAGS a key<str>-value<str> for exact searchable pipeline states"""
+    description = "FLAGS a key<str>-value<str> for exact searchable pipeline states; i.e., search bar flags.scraped:done"
 
     @staticmethod
     def upon_get(s):
@@ -46,62 +69,145 @@ class FLAGS(str):
         else: raise ValueError("unrecognized format not dict or str")
         return value
 
+    @staticmethod
+    def upon_decode(value):
+        if value is None or isinstance(value, dict): return value
+        return FLAGS.upon_get(FLAGS.upon_set(value))
+
 
 class GEOPOINT(str):
-    description = "GEOPOINT is a geospatial lat/lng or lat/lng/z in [lat, long], 'lat,lng' or similar formats."""
+    description = "GEOPOINT is a geospatial lat/lng or lat/lng/z in [lat, long], 'lat,lng' or similar formats; " \
+                  "list=True holds a list of them. See SwiftData.within, in_bbox and geo_grid"""
+
+    @classmethod
+    def upon_index(cls, value):
+        """ElasticSearch reads geo_point arrays as [lng, lat]; the "lat,lng" string form keeps the SwiftData order"""
+        if value is None: return None
+        if cls.is_points(value): return [cls.upon_index(point) for point in value]
+        return ",".join(str(f) for f in (value if isinstance(value, (list, tuple)) else cls.upon_decode(value)))
 
     @staticmethod
     def upon_get(s):
         if s is None: return None
         return json.loads(s)
 
-    @staticmethod
-    def upon_set(value):
+    @classmethod
+    def upon_set(cls, value):
         if value is None: return None
+        if isinstance(value, str) and value.startswith("["): value = json.loads(value)
+        if cls.is_points(value) or isinstance(value, (list, tuple)) and len(value) == 0:
+            return json.dumps([cls.upon_get(cls.upon_set(point)) for point in value])
         if isinstance(value, str): value = value.split(",")  # "60.503,-40.56"
         if len(value) != 2 and len(value) != 3: raise ValueError(f"geopoint must be length 2 or 3 {value}")
         if isinstance(value, (list, tuple)): value = json.dumps([float(s_or_f) for s_or_f in value])
         else: raise ValueError("unrecognized format not list/tuple or comma separated str of floats")
         return value
 
+    @classmethod
+    def upon_decode(cls, value):
+        if value is None: return None
+        if isinstance(value, (list, tuple)) and len(value) in [2, 3] and not cls.is_points(value):
+            return [float(s_or_f) for s_or_f in value]
+        return cls.upon_get(cls.upon_set(value))
+
+    @staticmethod
+    def is_points(value):
+        """True for a list of points (list=True fields) rather than a single point"""
+        return isinstance(value, (list, tuple)) and len(value) != 0 and \
+            (isinstance(value[0], (list, tuple)) or isinstance(value[0], str) and "," in value[0])
+
 
 class VECTOR(str):
-    description = "VECTOR is a vector of floats; e.g., an embedding vector"""
+    description = "VECTOR is a vector of floats; e.g., an embedding vector, held as a numpy array of dtype float32, " \
+                  "float16 or int8 (a unit vector, for cosine similarity) and stored as base64 of its bytes"""
 
-    @staticmethod
-    def upon_get(s):
+    dtype = "float32"  # derived fields set the dtype of sd.vector(n_dims, dtype=...)
+
+    @classmethod
+    def upon_get(cls, s):
         if s is None: return None
-        return json.loads(s)
+        return cls.upon_decode(s)
 
-    @staticmethod
-    def upon_set(value):
+    @classmethod
+    def upon_set(cls, value):
         if value is None: return None
-        if isinstance(value, (list, tuple)): value = json.dumps([float(s_or_f) for s_or_f in value])
-        else: raise ValueError("unrecognized format not list/tuple or comma separated str of floats")
-        return value
+        if isinstance(value, str): return value if not value.startswith("[") else cls.upon_set(json.loads(value))
+        if isinstance(value, (list, tuple, numpy.ndarray)): return base64.b64encode(cls.quantize(value).tobytes()).decode()
+        raise ValueError("unrecognized format not list/tuple/ndarray or base64 str of its bytes")
+
+    @classmethod
+    def upon_decode(cls, value):
+        """base64 (disk), list (ElasticSearch _source) or json (legacy) straight into the numpy array of the field"""
+        if value is None: return None
+        if isinstance(value, str) and value.startswith("["): value = json.loads(value)
+        if isinstance(value, str): array = numpy.frombuffer(base64.b64decode(value), dtype=cls.dtype)
+        elif cls.dtype == "int8" and isinstance(value, (list, tuple)): array = numpy.asarray(value, dtype=numpy.int8)
+        else: array = cls.quantize(value)
+        if cls.dtype != "int8": return array
+        array = array.astype(numpy.float32)
+        norm = numpy.linalg.norm(array)
+        return array / norm if norm != 0 else array
+
+    @classmethod
+    def upon_disk_storage(cls, value): return cls.upon_set(value)
+
+    @classmethod
+    def upon_index(cls, value):
+        """ElasticSearch dense_vector values: floats, or for int8 the quantized integers (its byte element_type)"""
+        # NOTE: floats are written with the digits of their dtype only, i.e., 0.1 rather than 0.10000000149011612
+        if value is None: return None
+        array = cls.quantize(cls.upon_decode(value) if isinstance(value, str) else value)
+        if cls.dtype == "int8": return array.tolist()
+        digits = ".8g" if cls.dtype == "float32" else ".5g"
+        return [float(format(f, digits)) for f in array.tolist()]
+
+    @classmethod
+    def quantize(cls, value):
+        """The array of value in dtype; int8 scales the largest component to 127, keeping the direction (not the length)"""
+        if cls.dtype != "int8": return numpy.asarray(value, dtype=cls.dtype)
+        if isinstance(value, numpy.ndarray) and value.dtype == numpy.int8: return value
+        value = numpy.asarray(value, dtype=numpy.float32)
+        largest = numpy.abs(value).max() if value.size != 0 else 0
+        return numpy.round(value / (largest if largest != 0 else 1) * 127).astype(numpy.int8)
 
 
 class INTEGER(str):
     description = "INTEGER is an integer."""
 
-    @staticmethod
-    def upon_get(s):
-        if s is None: return None
-        return json.loads(s)
+    native = int  # values are held natively on the object, in the local columns and in ElasticSearch
 
-    @staticmethod
-    def upon_set(value):
+    @classmethod
+    def upon_set(cls, value):
         if value is None: return None
-        return json.dumps(value)
+        if isinstance(value, (list, tuple)): return [cls.upon_set(v) for v in value]
+        if isinstance(value, str): value = json.loads(value)  # i.e., "3"; and json strings of previous versions
+        if cls.native is int and isinstance(value, (float, numpy.floating)) and not float(value).is_integer():
+            raise ValueError(f"integer field cannot hold {value}")  # rather than truncate 3.7 to 3
+        return cls.native(value)
+
+    @classmethod
+    def upon_decode(cls, value):
+        return value if value is None or type(value) is cls.native else cls.upon_set(value)
 
 
 class FLOAT(INTEGER):
     description = "FLOAT is an double-precision float."""
 
+    native = float
+
 
 class BOOLEAN(INTEGER):
     description = "BOOLEAN is an True/False states as such."""
 
+    native = bool
+
+    @classmethod
+    def upon_set(cls, value):
+        if value is None: return None
+        if isinstance(value, (list, tuple)): return [cls.upon_set(v) for v in value]
+        if isinstance(value, str): return value.strip().lower() in ["true", "1", "yes"]
+        return bool(value)
+
 
 def derived_field(swift_cls, es_field_cls_name, **parameters):
     md5 = hashlib.md5(json.dumps(parameters).encode()).hexdigest()
@@ -111,25 +217,35 @@ def derived_field(swift_cls, es_field_cls_name, **parameters):
     return derived
 
 
-def GENERIC_STRING(list=False, analyze=False, dont_index=False):
-    if analyze: return derived_field(TEXT, "Text", multi=list, dont_index=dont_index)
-    else: return derived_field(TEXT, "Keyword", multi=list, dont_index=dont_index)
+def GENERIC_STRING(list=False, analyze=False, dont_index=False, suggest=False):
+    if analyze: return derived_field(TEXT, "Text", multi=list, dont_index=dont_index, suggest=suggest)
+    else: return derived_field(TEXT, "Keyword", multi=list, dont_index=dont_index, suggest=suggest)
 
 
-def GENERIC_TIMESTAMP(list=False, dont_index=False):
-    return derived_field(TIMESTAMP, "Date", is_list=list, dont_index=dont_index)
+def GENERIC_TIMESTAMP(list=False, dont_index=False, buckets=None):
+    if not buckets: return derived_field(TIMESTAMP, "Date", is_list=list, dont_index=dont_index)
+    derived = derived_field(TIMESTAMP, "Date", is_list=list, dont_index=dont_index, buckets=[str(b) for b in buckets])
+    derived.buckets = timebuckets.widths_of(buckets)
+    return derived
 
 
 def GENERIC_FLAGS(dont_index=False):
-    return derived_field(FLAGS, "Keyword", dont_index=dont_index)
+    return derived_field(FLAGS, "Flattened", dont_index=dont_index)
 
 
 def GENERIC_GEOPOINT(list=False, dont_index=False):
     return derived_field(GEOPOINT, "GeoPoint", is_list=list, dont_index=dont_index)
 
 
-def GENERIC_VECTOR(n_dims, dont_index=False):
-    return derived_field(VECTOR, "DenseVector", n_dims=n_dims, dont_index=dont_index)
+def GENERIC_VECTOR(n_dims, dont_index=False, dtype="float32"):
+    if dtype not in vector_dtypes: raise ValueError(f"vector dtype must be one of {vector_dtypes}")
+    derived = derived_field(VECTOR, "DenseVector", n_dims=n_dims, dont_index=dont_index, dtype=dtype)
+    derived.dtype = dtype
+    return derived
+
+
+vector_dtypes = ["float32", "float16", "int8"]
+
 
 def GENERIC_INTEGER(list=False, dont_index=False):
     return derived_field(INTEGER, "Integer", is_list=list, dont_index=dont_index)
@@ -0,0 +1,130 @@
+from cloudnode.base.core.lightweight_utilities.profiler_logger import ProfilerLogger
+import dataclasses
+import collections
+import threading
+import datetime
+import random
+import json
+import time
+
+profiler, logger = ProfilerLogger.getLogger(__name__)
+
+# The QueryLog keeps structured records of SwiftData queries which were slow or profiled, per class and index, so that
+# the time of a slow search endpoint can be split into ElasticSearch execution (took_ms), network and transport
+# (network_ms is the round trip minus took_ms), and hit decoding into SwiftData (decode_ms), next to the bytes received.
+#
+# PRODUCTION: every query is timed (two clock reads) but only recorded if slower than slow_ms or if sampled; sampled
+# queries (sample_rate) and profile=True queries request the ElasticSearch profile, which costs ElasticSearch time, and
+# decode under ProfilerLogger. Records are held in bounded deques per (class, index), so memory is bounded. A slow query
+# which was not profiled is re-run with profile in the background at most once every reprofile_every_s per class and
+# index, so that slow queries come with the profile of where their ElasticSearch time went.
+
+
+@dataclasses.dataclass
+class QueryRecord:
+    cls_name: str
+    index: str
+    ts: str
+    slow: bool
+    total_ms: float
+    took_ms: float = None      # ElasticSearch execution, as reported by ElasticSearch
+    network_ms: float = None   # round trip of the search request minus took_ms
+    decode_ms: float = None    # hits into SwiftData objects or columns
+    n_hits: int = None
+    bytes: int = None          # bytes of the response body
+    query: dict = None
+    profile: dict = None       # the ElasticSearch profile output, if profiled
+
+    def as_dict(self): return dataclasses.asdict(self)
+
+
+class QueryLog(object):
+    """Slow and sampled query records per SwiftData class and index; configure() sets threshold and sampling."""
+
+    slow_ms = None             # None disables slow query capture
+    sample_rate = 0.0          # fraction of queries profiled and recorded regardless of their time
+    max_records = 1000         # per (class, index)
+    reprofile_every_s = 10.0
+    records = dict()           # map from (cls_name, index) => deque of QueryRecord
+    reprofiled_s = dict()      # map from (cls_name, index) => time of the last background re-profile
+    lock = threading.Lock()
+
+    @staticmethod
+    def configure(slow_ms=None, sample_rate=0.0, max_records=1000, reprofile_every_s=10.0):
+        QueryLog.slow_ms, QueryLog.sample_rate = slow_ms, sample_rate
+        QueryLog.max_records, QueryLog.reprofile_every_s = max_records, reprofile_every_s
+        return QueryLog
+
+    @staticmethod
+    def is_sampled(): return QueryLog.sample_rate > 0 and random.random() < QueryLog.sample_rate
+
+    @staticmethod
+    def is_slow(total_ms): return QueryLog.slow_ms is not None and total_ms >= QueryLog.slow_ms
+
+    @staticmethod
+    def record(record):
+        key = (record.cls_name, record.index)
+        with QueryLog.lock:
+            if key not in QueryLog.records: QueryLog.records[key] = collections.deque(maxlen=QueryLog.max_records)
+            QueryLog.records[key].append(record)
+        if record.slow:
+            logger.warning(f"SLOW QUERY {record.cls_name} in {record.index}: total={record.total_ms:.1f}ms "
+                           f"took={record.took_ms}ms network={record.network_ms:.1f}ms decode={record.decode_ms:.1f}ms "
+                           f"hits={record.n_hits} bytes={record.bytes}")
+        return record
+
+    @staticmethod
+    def should_reprofile(cls_name, index, now_s):
+        """Rate limits background re-profiling of slow queries per (class, index)."""
+        with QueryLog.lock:
+            if now_s - QueryLog.reprofiled_s.get((cls_name, index), 0.0) < QueryLog.reprofile_every_s: return False
+            QueryLog.reprofiled_s[(cls_name, index)] = now_s
+            return True
+
+    @staticmethod
+    def decode(cls_name, decode, hits, profiled):
+        """Returns (decode(hits), decode_ms); profiled decodes are measured and logged by ProfilerLogger."""
+        if not profiled:
+            s = time.perf_counter()
+            return decode(hits), (time.perf_counter() - s) * 1000
+        with profiler.profile(f"SWIFTDATA_DECODE_{cls_name}") as p:
+            results = decode(hits)
+            p.add(as_rates=dict(hits=len(hits)))
+        return results, p.quants["duration_s"] * 1000
+
+    @staticmethod
+    def reprofile(record, search):
+        """Re-runs a slow query with profile in a background thread, rate limited; search(profile=True) => response."""
+        if not QueryLog.should_reprofile(record.cls_name, record.index, time.time()): return
+        def run():
+            try: profile = search(profile=True).body.get("profile")
+            except Exception as e:
+                logger.warning(f"SLOW QUERY re-profile of {record.cls_name} in {record.index} failed: {e}")
+                return
+            with QueryLog.lock: record.profile = profile
+        threading.Thread(target=run, name=f"reprofile={record.cls_name}", daemon=True).start()
+
+    @staticmethod
+    def query(cls_name=None, index=None, slow_only=False):
+        """Returns records (as dicts, most recent last) of a class and/or index, or of all if None."""
+        with QueryLog.lock:
+            items = [(k, list(v)) for k, v in QueryLog.records.items()]
+        found = []
+        for (k_cls, k_index), records in items:
+            if (cls_name is None or k_cls == cls_name) and (index is None or k_index == index):
+                found.extend(r for r in records if r.slow or not slow_only)
+        return [r.as_dict() for r in sorted(found, key=lambda r: r.ts)]
+
+    @staticmethod
+    def clear():
+        with QueryLog.lock: QueryLog.records, QueryLog.reprofiled_s = dict(), dict()
+
+
+def now_iso(): return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+
+def body_bytes(response):
+    """The size of a response body: from content-length when given, otherwise by serializing the body."""
+    length = response.meta.headers.get("content-length") if response.meta.headers is not None else None
+    if length is not None and str(length).isdigit(): return int(length)
+    return len(json.dumps(response.body, default=str))
@@ -0,0 +1,110 @@
+import collections
+import threading
+import bisect
+import heapq
+import time
+
+# Search-as-you-type: fields declared with sd.string(suggest=True) are completed by prefix from a structure built at write
+# time rather than by a search per keystroke. In ElasticSearch the field carries a completion multi-field (field.suggest,
+# an in-memory FST of the whole values); in the LocalIndex each suggest field keeps Completions, the sorted normalized
+# values with their number of records, so that a prefix is a binary search and the top-k the most frequent values of it.
+#
+# CACHE: keystrokes repeat the same short prefixes across users ("n", "ne", "new"), so SuggestCache keeps the top-k of
+# hot prefixes in a bounded LRU. Local entries are keyed by the generation of the Completions, which every write bumps,
+# so they are never stale; ElasticSearch entries expire after ttl_s, about the refresh interval after which writes become
+# searchable anyway.
+
+
+def normalize(value):
+    """The form in which values are matched by prefix: lowercase with collapsed whitespace."""
+    return " ".join(str(value).lower().split())
+
+
+class Completions(object):
+    """Prefix completions of the values of one field, ranked by the number of records holding them."""
+
+    def __init__(self):
+        self.counts = dict()   # map from normalized value => number of records holding it
+        self.display = dict()  # map from normalized value => the value as last written
+        self.keys = []         # sorted normalized values; rebuilt lazily when values were added or removed
+        self.is_sorted = True
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def add(self, values):
+        with self.lock:
+            for value in values:
+                key = normalize(value)
+                if len(key) == 0: continue
+                if key not in self.counts: self.counts[key], self.is_sorted = 0, False
+                self.counts[key] += 1
+                self.display[key] = value
+            self.generation += 1
+
+    def remove(self, values):
+        with self.lock:
+            for value in values:
+                key = normalize(value)
+                if key not in self.counts: continue
+                self.counts[key] -= 1
+                if self.counts[key] <= 0:
+                    del self.counts[key], self.display[key]
+                    self.is_sorted = False
+            self.generation += 1
+
+    def complete(self, prefix, k=10):
+        """Returns up to k values starting with prefix, the most frequent first (ties alphabetically)."""
+        prefix = normalize(prefix)
+        with self.lock:
+            if not self.is_sorted: self.keys, self.is_sorted = sorted(self.counts), True
+            lo = bisect.bisect_left(self.keys, prefix)
+            hi = bisect.bisect_left(self.keys, prefix + "\uffff", lo=lo)
+            top = heapq.nsmallest(k, self.keys[lo:hi], key=lambda key: (-self.counts[key], key))
+            return [self.display[key] for key in top]
+
+
+class SuggestCache(object):
+    """LRU of the top-k completions of hot prefixes; see configure() for its size and the ttl of ElasticSearch entries."""
+
+    max_entries = 4096
+    ttl_s = 1.0
+    entries = collections.OrderedDict()  # map from key => (expires_s, completions)
+    lock = threading.Lock()
+    hits, misses = 0, 0
+
+    @staticmethod
+    def configure(max_entries=4096, ttl_s=1.0):
+        SuggestCache.max_entries, SuggestCache.ttl_s = max_entries, ttl_s
+        SuggestCache.clear()
+        return SuggestCache
+
+    @staticmethod
+    def get(key):
+        now = time.time()
+        with SuggestCache.lock:
+            entry = SuggestCache.entries.get(key)
+            if entry is None or entry[0] < now:
+                SuggestCache.misses += 1
+                return None
+            SuggestCache.entries.move_to_end(key)
+            SuggestCache.hits += 1
+            return entry[1]
+
+    @staticmethod
+    def put(key, completions, ttl_s=None):
+        expires_s = float("inf") if ttl_s is None else time.time() + ttl_s
+        with SuggestCache.lock:
+            SuggestCache.entries[key] = (expires_s, completions)
+            SuggestCache.entries.move_to_end(key)
+            while len(SuggestCache.entries) > SuggestCache.max_entries: SuggestCache.entries.popitem(last=False)
+        return completions
+
+    @staticmethod
+    def stats():
+        with SuggestCache.lock:
+            return dict(entries=len(SuggestCache.entries), hits=SuggestCache.hits, misses=SuggestCache.misses,
+                        hit_ratio=SuggestCache.hits / max(1, SuggestCache.hits + SuggestCache.misses))
+
+    @staticmethod
+    def clear():
+        with SuggestCache.lock: SuggestCache.entries, SuggestCache.hits, SuggestCache.misses = collections.OrderedDict(), 0, 0
@@ -0,0 +1,226 @@
+from cloudnode.base.core.lightweight_utilities.filesystem import FileSystem
+from cloudnode.base.core.elasticsearch.searchbar import date_math
+from cloudnode.base.core.elasticsearch import timebuckets
+from cloudnode.base.core.swiftdata.local import LocalIndex
+import collections
+import dataclasses
+import threading
+import gzip
+import json
+import time
+import io
+import re
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Tiering keeps the recent records of a SwiftData class in ElasticSearch (the hot tier) and moves the older ones, by a
+# timestamp field, into a compressed store on the local filesystem (the cold tier), i.e., class Reading(SwiftData,
+# tiering=Tiering("ts", older_than="30d")), so that the indices, and the heap and disk they hold, only grow with the
+# recent records. The moves run in the background (see SwiftData.tier and tier_schedule): a batch of records older than
+# the cutoff is written into the cold store first and only then deleted from ElasticSearch, so that a failed move leaves
+# a record in both tiers rather than in neither; reads prefer the hot copy.
+#
+# COLD STORE: one directory per class and index beside the local records (swift.{cls_name}.cold/), of gzip segments of
+# json lines, one segment per moved batch, and a manifest of the ids of each segment; records are found by id through
+# the manifest and read by segment. Deletes (and saves, which make a record hot again) rewrite the segments holding them
+# into new segments before the manifest is replaced, so that a crash never leaves a half-written segment in use.
+# ROUTING: es=True reads of a tiered class (get, exists, list, getAll, count, search_bar, stats, sort_by) read both tiers
+# and merge their results, the hot records first; search bar queries run on the cold tier as local predicates over its
+# LocalIndex, which is built on the first cold query, and skip it when their window on the tier field starts after the
+# cutoff. Queries by Q (expert_query and the geo, hybrid and suggest queries) search the hot tier only.
+
+
+@dataclasses.dataclass(frozen=True)
+class Tiering:
+    """The tiering policy of a SwiftData class, i.e., class Reading(SwiftData, tiering=Tiering("ts", older_than="30d"))."""
+    field: str = "ts"          # the timestamp field by which records are cold
+    older_than: str = "30d"    # records older than this are moved to the cold tier: "12h", "30d"
+    batch_size: int = 1000     # records per move, and per segment of the cold store
+
+    @property
+    def seconds(self): return timebuckets.parse_width(self.older_than)
+
+    def cutoff(self, now=None):
+        """Epoch seconds before which records are cold; now is epoch seconds (the current time if None)."""
+        return (time.time() if now is None else now) - self.seconds
+
+    def cutoff_value(self, now=None):
+        """The cutoff as the isoformat of the field, for range queries."""
+        return timebuckets.iso_of(self.cutoff(now))
+
+    def is_hot_window(self, bounds, now=None):
+        """True if the window bounds (gte, gt, lte, lt; dates or date math) start at or after the cutoff, so that no cold
+        record can match; False if the window is open-ended or unparsable."""
+        lower = bounds.get("gte", bounds.get("gt"))
+        if lower is None: return False
+        try: return date_math(lower).timestamp() >= self.cutoff(now)
+        except (TypeError, ValueError, OverflowError, AttributeError): return False
+
+
+class ColdStore(object):
+    """The cold tier of one SwiftData class in one index: gzip segments of json lines on the local filesystem."""
+
+    known = dict()  # map from directory => ColdStore; one per class and index per process
+    known_lock = threading.Lock()
+
+    def __init__(self, swift_cls, index, directory, encode, decode, index_kwargs):
+        self.swift_cls = swift_cls
+        self.index = index
+        self.directory = directory
+        self.encode = encode              # SwiftData object => dict, as records are stored on disk
+        self.decode = decode              # dict => SwiftData object
+        self.index_kwargs = index_kwargs  # dict(mapping=..., suggest_fields=..., buckets=...) of its LocalIndex
+        self.segments = None              # map from segment name => [ids]; see .load()
+        self.locations = dict()           # map from id => segment name
+        self.cache = collections.OrderedDict()  # map from segment name => dict(id=dict) of the last segments read
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def of(swift_cls, index, directory, encode, decode, index_kwargs):
+        with ColdStore.known_lock:
+            if directory not in ColdStore.known:
+                ColdStore.known[directory] = ColdStore(swift_cls, index, directory, encode, decode, index_kwargs)
+            return ColdStore.known[directory]
+
+    @property
+    def key(self): return f"{self.index}.cold"  # the index name of its LocalIndex
+
+    def load(self):
+        """Reads the manifest; called once, and again whenever another process may have moved records."""
+        with self.lock:
+            stub = self.directory + "manifest.json"
+            self.segments = json.load(FileSystem.easy_download(stub)) if FileSystem.easy_exists(stub) else dict()
+            self.locations = {id: name for name, ids in self.segments.items() for id in ids}
+            self.cache.clear()
+            return self
+
+    def __len__(self):
+        with self.lock:
+            if self.segments is None: self.load()
+            return len(self.locations)
+
+    def __contains__(self, id):
+        with self.lock:
+            if self.segments is None: self.load()
+            return str(id) in self.locations
+
+    def ids(self):
+        with self.lock:
+            if self.segments is None: self.load()
+            return list(self.locations)
+
+    def get(self, ids):
+        """Returns dict(id=SwiftData object) of the ids found in the cold store; one read per segment."""
+        with self.lock:
+            if self.segments is None: self.load()
+            by_segment = collections.defaultdict(list)
+            for id in ids:
+                if str(id) in self.locations: by_segment[self.locations[str(id)]].append(str(id))
+            return {id: self.decode(self.__read(name)[id]) for name, found in by_segment.items() for id in found}
+
+    def records(self):
+        """Returns every cold record, segment by segment."""
+        with self.lock:
+            if self.segments is None: self.load()
+            return [self.decode(source) for name in list(self.segments) for source in self.__read(name, cache=False).values()]
+
+    def batches(self):
+        """Yields the stored dicts of the cold records, one segment at a time."""
+        with self.lock:
+            if self.segments is None: self.load()
+            names = list(self.segments)
+        for name in names:
+            with self.lock:
+                if name not in self.segments: continue  # rewritten since
+                sources = list(self.__read(name, cache=False).values())
+            yield sources
+
+    def append(self, objects):
+        """Writes objects into a new segment; ids already in the cold store are replaced."""
+        objects = list({str(obj.id): obj for obj in objects}.values())
+        if len(objects) == 0: return
+        with self.lock:
+            if self.segments is None: self.load()
+            replaced = [str(obj.id) for obj in objects if str(obj.id) in self.locations]
+            segments, obsolete = self.__without(replaced)
+            name = self.__write([self.encode(obj) for obj in objects])
+            segments[name] = [str(obj.id) for obj in objects]
+            self.__commit(segments, obsolete)
+            local_index = LocalIndex.if_built(self.swift_cls, self.key)
+            if local_index is not None: [local_index.upsert(obj) for obj in objects]
+
+    def remove(self, ids):
+        """Removes ids from the cold store; returns the number removed."""
+        with self.lock:
+            if self.segments is None: self.load()
+            ids = [str(id) for id in ids if str(id) in self.locations]
+            if len(ids) == 0: return 0
+            segments, obsolete = self.__without(ids)
+            self.__commit(segments, obsolete)
+            local_index = LocalIndex.if_built(self.swift_cls, self.key)
+            if local_index is not None: [local_index.remove(id) for id in ids]
+            return len(ids)
+
+    def local_index(self, fresh=False):
+        """The LocalIndex of the cold records, for search bar queries; built on first use and kept current."""
+        return LocalIndex.of(self.swift_cls, self.key, self.index_kwargs["mapping"], self.records, fresh=fresh,
+                             suggest_fields=self.index_kwargs["suggest_fields"], buckets=self.index_kwargs["buckets"])
+
+    def __without(self, ids):
+        """Returns (segments, obsolete segments) after rewriting the segments of ids into new segments without them."""
+        segments, obsolete, ids = dict(self.segments), [], set(ids)
+        for name in {self.locations[id] for id in ids}:
+            kept = {id: source for id, source in self.__read(name, cache=False).items() if id not in ids}
+            segments.pop(name)
+            obsolete.append(name)
+            if len(kept) != 0: segments[self.__write(list(kept.values()))] = list(kept)
+        return segments, obsolete
+
+    def __commit(self, segments, obsolete):
+        """Replaces the manifest, then deletes the obsolete segments."""
+        FileSystem.easy_upload(io.StringIO(json.dumps(segments)), self.directory + "manifest.json")
+        self.segments = segments
+        self.locations = {id: name for name, ids in segments.items() for id in ids}
+        for name in obsolete:
+            self.cache.pop(name, None)
+            FileSystem.easy_delete(self.directory + name)
+
+    def __write(self, sources):
+        numbers = [int(m.group(1)) for m in map(re.compile(r"^segment\.(\d+)\.jsonl\.gz$").match, self.__files()) if m]
+        name = f"segment.{max(numbers, default=0) + 1:06d}.jsonl.gz"
+        lines = "".join(json.dumps(source) + "\n" for source in sources)
+        FileSystem.easy_upload(io.BytesIO(gzip.compress(lines.encode("utf-8"))), self.directory + name)
+        return name
+
+    def __read(self, name, cache=True):
+        """Returns dict(id=dict) of a segment; the last few segments read are cached."""
+        if name in self.cache:
+            self.cache.move_to_end(name)
+            return self.cache[name]
+        lines = gzip.decompress(FileSystem.easy_download(self.directory + name).getvalue()).decode("utf-8").splitlines()
+        sources = {str(source["id"]): source for source in map(json.loads, lines)}
+        if cache:
+            self.cache[name] = sources
+            while len(self.cache) > 4: self.cache.popitem(last=False)
+        return sources
+
+    def __files(self):
+        return FileSystem.easy_listdir(self.directory) if FileSystem.easy_exists(self.directory) else []
+
+
+def merged_stats(hot, cold):
+    """Merges the dict(count, min, max, avg, sum) of the two tiers."""
+    count = hot["count"] + cold["count"]
+    if count == 0: return dict(count=0, min=None, max=None, avg=None, sum=0.0)
+    total = (hot["sum"] or 0.0) + (cold["sum"] or 0.0)
+    extremes = [s for s in [hot, cold] if s["count"] != 0]
+    return dict(count=count, min=min(s["min"] for s in extremes), max=max(s["max"] for s in extremes), avg=total / count, sum=total)
+
+
+def merged_sorted(hot, cold, field, descending=False, max_results=50):
+    """Merges the records of the two tiers, each sorted by field, into up to max_results; records without a value last."""
+    missing = [obj for obj in hot + cold if getattr(obj, field) is None]
+    valued = sorted([obj for obj in hot + cold if getattr(obj, field) is not None], key=lambda obj: getattr(obj, field), reverse=descending)
+    return (valued + missing)[:max_results]
+
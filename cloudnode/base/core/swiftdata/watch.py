@@ -0,0 +1,157 @@
+from cloudnode.base.core.elasticsearch.searchbar import analyze
+import collections
+import threading
+import time
+import uuid
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Watches are saved search bar queries which are matched against records as they are written, i.e., SavedQuery of
+# Movie.watch(index, "genre:horror year:2024", "ae://notify"), instead of an EasyCron which re-runs the query over the
+# whole index every few seconds to find what is new: every SwiftData save (es=True or es=False) and every document
+# indexed by the bulk indexer into a watched index is tested by the compiled local predicate of each query registered on
+# its index (see searchbar.compile_to_local; the text fields of a record are analyzed once for all of its queries), so
+# that the cost is per write and nothing polls. Matching records are posted to the callback endpoint in batches.
+#
+# DISPATCH: each SavedQuery holds its matched records and one daemon thread posts them as dict(watch, cls, index, query,
+# records=[...]) once batch_size have matched or linger_s after the first, so that the writers never wait on the
+# callback. Failed posts are logged and counted and their records are not retried; .close() posts what is pending.
+# SEND: batches are posted by the send of SwiftData.watch, else by the default of Watches.set_sender, which the
+# Infrastructure sets to AetherClient.request (for ae:// endpoints); core modules do not import the iaas client.
+# BULK: documents are matched after ElasticSearch has indexed them (see BulkIndexer watched and on_indexed), by the
+# _index they are added with; add them with the index name of the class (its alias), as SwiftData does.
+# NOTE: queries are matched per record, so that clauses on other records (i.e., counts) cannot be watched; a window
+# relative to now (now-1d) is compiled again for each record tested, as for local queries.
+
+
+class SavedQuery(object):
+    """A search bar query watched on a class in an index; records matching it are posted to endpoint in batches."""
+
+    def __init__(self, swift_cls, index, name, query, predicate, endpoint, encode, decode, send, batch_size=100, linger_s=1.0):
+        self.id = uuid.uuid4().hex
+        self.swift_cls = swift_cls
+        self.index = index
+        self.name = name            # the ElasticSearch index name of the class in index, by which writes are matched
+        self.query = query
+        self.predicate = predicate  # predicate(values, tokens); see searchbar.compile_to_local
+        self.endpoint = endpoint
+        self.encode = encode        # SwiftData object => json dict of the callback
+        self.decode = decode        # ElasticSearch _source, id => SwiftData object
+        self.send = send            # send(endpoint, data, rtype), as AetherClient.request
+        self.batch_size = batch_size
+        self.linger_s = linger_s
+        self.pending = []           # records matched and not yet posted
+        self.first_pending_s = None
+        self.counters = dict(tested=0, matched=0, posted=0, batches=0, failures=0)
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self.__run, name=f"watch={swift_cls.__name__}.{index}", daemon=True)
+        self.thread.start()
+
+    def offer(self, obj, tokens):
+        """Tests one written record; queues it for the callback if it matches."""
+        matched = self.predicate(vars(obj), tokens)
+        with self.condition:
+            self.counters["tested"] += 1
+            if not matched: return False
+            self.counters["matched"] += 1
+            self.pending.append(self.encode(obj))
+            if self.first_pending_s is None: self.first_pending_s = time.time()
+            if len(self.pending) >= self.batch_size: self.condition.notify_all()
+        return True
+
+    def close(self):
+        """Unregisters the query and posts its pending records; returns its stats."""
+        Watches.unregister(self)
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+        return self.stats()
+
+    def stats(self):
+        """Returns dict(id, query, endpoint, tested, matched, posted, batches, failures, pending)."""
+        with self.condition:
+            return dict(id=self.id, query=self.query, endpoint=self.endpoint, pending=len(self.pending), **self.counters)
+
+    def __run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed or self.__is_due(), timeout=self.linger_s)
+                if len(self.pending) == 0:
+                    if self.closed: return
+                    continue
+                if not (self.closed or self.__is_due()): continue
+                batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+                self.first_pending_s = time.time() if len(self.pending) != 0 else None
+            self.__post(batch)
+
+    def __is_due(self):
+        if len(self.pending) >= self.batch_size: return True
+        return self.first_pending_s is not None and time.time() >= self.first_pending_s + self.linger_s
+
+    def __post(self, batch):
+        data = dict(watch=self.id, cls=self.swift_cls.__name__, index=self.index, query=self.query, records=batch)
+        try:
+            r = self.send(self.endpoint, data, None)  # as EasyCron: the response is not marshalled
+            failed = r is None or not getattr(r, "success", True)
+        except Exception as e:
+            logger.warning(f"WATCH {self.swift_cls.__name__}.{self.index} post to {self.endpoint} failed: {e}")
+            failed = True
+        with self.condition:
+            self.counters["batches"] += 1
+            self.counters["failures" if failed else "posted"] += len(batch)
+
+
+class Watches(object):
+    """The registry of the saved queries of this process, by the ElasticSearch index name of their class and index."""
+
+    registered = collections.defaultdict(list)  # map from index name => [SavedQuery]
+    lock = threading.Lock()
+    send = None                                 # the default send of saved queries; see set_sender
+
+    @staticmethod
+    def set_sender(send):
+        """Sets the default send(endpoint, data, rtype) of saved queries, i.e., AetherClient.request by Infrastructure"""
+        Watches.send = send
+
+    @staticmethod
+    def register(saved):
+        with Watches.lock: Watches.registered[saved.name] = Watches.registered[saved.name] + [saved]
+        return saved
+
+    @staticmethod
+    def unregister(saved):
+        with Watches.lock:
+            Watches.registered[saved.name] = [s for s in Watches.registered[saved.name] if s is not saved]
+            if len(Watches.registered[saved.name]) == 0: del Watches.registered[saved.name]
+
+    @staticmethod
+    def of(name):
+        """The saved queries on index name; an empty list (and no lock) when nothing is watched."""
+        return Watches.registered.get(name, []) if len(Watches.registered) != 0 else []
+
+    @staticmethod
+    def is_watched(name): return len(Watches.of(name)) != 0
+
+    @staticmethod
+    def match(name, objects, text_fields):
+        """Tests written records against the saved queries on index name; returns the number of matches."""
+        watching, n = Watches.of(name), 0
+        if len(watching) == 0: return n
+        for obj in objects:
+            tokens = {field: analyze(getattr(obj, field, None)) for field in text_fields}
+            n += sum(1 for saved in watching if saved.offer(obj, tokens))
+        return n
+
+    @staticmethod
+    def match_indexed(documents, text_fields_of):
+        """Tests documents indexed in bulk, as [(index name, id, _source)]; text_fields_of(swift_cls) lists its Text fields."""
+        by_name = collections.defaultdict(list)
+        for name, id, source in documents: by_name[name].append((id, source))
+        for name, docs in by_name.items():
+            watching = Watches.of(name)
+            if len(watching) == 0: continue
+            saved = watching[0]  # every saved query on name is of the same class
+            Watches.match(name, [saved.decode(source, id) for id, source in docs], text_fields_of(saved.swift_cls))
@@ -57,17 +57,16 @@ class DockerClient(object):
         if not isinstance(ports, dict): ports = {ports: ports for port in ports}
         if environment is None: environment = dict()
         if mounts is None: mounts = []
+        if censor is None: censor = []
         as_mounts = [docker.types.Mount(**mount) for mount in mounts]
 
         # to help users unsure what is happening in the background
         s_env_log = " ".join([f"-e {k}={'<hidden>' if k in censor else v}" for k,v in environment.items()])
-        s_env = " ".join([f"-e {k}={v}" for k,v in environment.items()])
         s_mount = " ".join([f"--mount type={m['type']},source={m['source']},target={m['target']}" for m in mounts])
         s_ports = " ".join(f"-p {_from}:{_to}" for _from, _to in ports.items())
         s_detact = " -d" if detach else ""
         s_name = f" --name {name}" if name is not None else ""
         as_cmd_log = f"docker run {s_ports}{s_detact}{s_name} {s_mount} {s_env_log} {image}"
-        as_cmd = f"docker run {s_ports}{s_detact}{s_name} {s_mount} {s_env} {image}"
         logger.info(f"running docker equivalent to: {as_cmd_log}")
 
         # try using the docker python sdk then the command line as fallback
@@ -75,12 +74,17 @@ class DockerClient(object):
             logger.info("trying docker python sdk")
             self.client.containers.run(image=image, ports=ports, name=name, mounts=as_mounts,
                                        # volumes={directory: {"bind": directory, "mode": "rw"}},
-                                       environment=[environment], detach=detach)
+                                       environment=environment, detach=detach)
 
         except docker.errors.APIError as e:
             logger.warning("docker python sdk client build error")
             logger.info("trying docker command subprocess")
-            subprocess.run([p.strip() for p in as_cmd.split() if len(p.strip()) != 0])
+            # NOTE: arguments are built as a list (not split from as_cmd) as environment values may contain spaces
+            cmd = ["docker", "run"] + [p for _from, _to in ports.items() for p in ["-p", f"{_from}:{_to}"]]
+            cmd += (["-d"] if detach else []) + (["--name", name] if name is not None else [])
+            cmd += [p for m in mounts for p in ["--mount", f"type={m['type']},source={m['source']},target={m['target']}"]]
+            cmd += [p for k, v in environment.items() for p in ["-e", f"{k}={v}"]]
+            subprocess.run(cmd + [image])
 
     @staticmethod
     def copy_from_container(name, source, target):
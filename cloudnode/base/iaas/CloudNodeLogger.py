@@ -1,5 +1,6 @@
-from cloudnode import SwiftData, sd
+from cloudnode import SwiftData, Rollover, sd
 import dataclasses
+import threading
 import time
 
 import logging
@@ -11,8 +12,14 @@ logger = logging.getLogger(__name__)
 # their functions with standard logging capabilities, and the IAAS framework elevates these to cloud stage logging here.
 # The CloudNodeLogger may accept an optional runtime state upon creation to describe the context of the CloudFunction,
 # i.e., defining a process id, or any other information which may be useful for tracing Functions across one another.
+# ROLLOVER: LogLine rolls over by opt-in, i.e., LogLine.rollover_policy = log_rollover before its first use, so that its
+# records roll over into one index (and local directory) per day of their timestamp with 30 days retained; see LogLine
+# .rollover(index), and LogLine.rollover_schedule(index) for the Infrastructure cron loop. It is not the default since
+# existing deployments hold a concrete LogLine index under the name of the alias of a rolled LogLine, which RolledIndex
+# refuses to adopt: opt in for new deployments, or once the records of the concrete index are deleted or reindexed.
 
 index = "cloudnode.cloudnodelogger"  # FIXME: This should be system defined.
+log_rollover = Rollover("timestamp", period="1d", keep=30)  # opt-in, see ROLLOVER
 
 
 @dataclasses.dataclass
@@ -63,23 +70,35 @@ class CloudNodeLoggerHandler(logging.StreamHandler):
 
 class CloudNodeLogger(logging.RootLogger):
 
+    # NOTE: requests of a servlet run concurrently (threads, or coroutines of an ASGI servlet) and each enters its own
+    # CloudNodeLogger, so that the root handlers are swapped by the first to enter and restored by the last to exit;
+    # the handler of the first serves the others meanwhile, rather than each restoring the handlers of another.
+    entered = 0
+    original_handlers = []
+    lock = threading.Lock()
+
     def __init__(self, pid=None):
         super(CloudNodeLogger, self).__init__(logging.getLogger().level)
-        self.original_handlers = []
         self.pid = pid
         self.cloud_handler = CloudNodeLoggerHandler(pid=pid)
 
     def __enter__(self):  # get the handlers attached to the original root logger; reattach after .exit()
         _logger = logging.getLogger()
-        for h in _logger.handlers: self.original_handlers.append(h)
-        _logger.handlers.clear()
-        _logger.addHandler(self.cloud_handler)  # remove all handlers, and add only the new cloud_logger
+        with CloudNodeLogger.lock:
+            CloudNodeLogger.entered += 1
+            if CloudNodeLogger.entered != 1: return self
+            CloudNodeLogger.original_handlers = list(_logger.handlers)
+            _logger.handlers.clear()
+            _logger.addHandler(self.cloud_handler)  # remove all handlers, and add only the new cloud_logger
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         _logger = logging.getLogger()
-        _logger.handlers.clear()
-        for h in self.original_handlers: _logger.addHandler(h)  # remove all once again, and add back original handlers
+        with CloudNodeLogger.lock:
+            CloudNodeLogger.entered -= 1
+            if CloudNodeLogger.entered != 0: return
+            _logger.handlers.clear()
+            for h in CloudNodeLogger.original_handlers: _logger.addHandler(h)  # remove all once again, and add back original handlers
 
 
 
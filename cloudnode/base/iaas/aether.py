@@ -1,6 +1,8 @@
-from cloudnode.base.iaas.client import ReturnType, GenericCloudClient
+from cloudnode.base.iaas.client import ReturnType, GenericCloudClient, GenericResponse
 from cloudnode.base.iaas.nodes.BuildServletConfig import BuildServletConfig
 from flask import Response
+import concurrent.futures
+import collections
 import json
 import uuid
 
@@ -50,16 +52,74 @@ class AetherClient(object):
         else: return GenericCloudClient.request(endpoint, d=d, rtype=rtype, method=method)
 
     @staticmethod
-    def wrap_to_cloudnode_request(endpoint, data):
+    def request_batch(calls, rtype=ReturnType.JSON, max_servlets=8):
+        """Requests many node functions in one request per servlet: calls are dict(name=ae://function (or ae://function:
+        servlet_name, or an http:// endpoint), kwargs=dict()); returns a GenericResponse per call, in the order of calls"""
+        # NOTE: each name is resolved once, so that all of its calls go to the same servlet, and the calls of each servlet
+        # are posted together to its /functions/_batch endpoint (see BatchCloudFunction), up to max_servlets at a time.
+        resolved, batches = dict(), collections.defaultdict(list)  # map from batch endpoint => [(i, dict(name, kwargs))]
+        for i, call in enumerate(calls):
+            if call["name"] not in resolved: resolved[call["name"]] = AetherClient.endpoint_of(call["name"])
+            function_name, endpoint = resolved[call["name"]]
+            batches[endpoint.rsplit("/", 1)[0] + "/_batch"].append((i, dict(name=function_name, kwargs=call.get("kwargs", dict()))))
+
+        def request_one_batch(endpoint, items):
+            wrapped = AetherClient.__packaged([call for _, call in items])
+            logger.info(f"cloudnode aether batch={endpoint} tid={wrapped['__ae']['tid']} calls={len(items)}")
+            r = GenericCloudClient.request(endpoint, d=wrapped, rtype=ReturnType.JSON)
+            if not r.success: return [(i, GenericResponse(code=r.code, error=f"AetherClient batch failed: error={r.error}")) for i, _ in items]
+            results = AetherClient.__results_of(r.data, len(items))
+            if isinstance(results, str):  # NOTE: a bad gateway for each of its calls, rather than raising in the pool
+                logger.error(f"cloudnode aether batch={endpoint} failed: {results}")
+                return [(i, GenericResponse(code=502, error=f"AetherClient batch failed: error={results}")) for i, _ in items]
+            return [(i, AetherClient.__response_of(result, rtype)) for (i, _), result in zip(items, results)]
+
+        responses = [None] * len(calls)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(max_servlets, len(batches)))) as pool:
+            for batch in pool.map(lambda item: request_one_batch(*item), batches.items()):
+                for i, response in batch: responses[i] = response
+        return responses
+
+    @staticmethod
+    def __results_of(data, n):
+        """The n results of the response of a batch endpoint, each dict(name, status, data); else the error message"""
+        if not isinstance(data, dict) or not AetherClient.is_ae_data(data): return "response is not wrapped by aether"
+        try: results = json.loads(data["d"])
+        except (TypeError, ValueError) as e: return f"response is not json: {e}"
+        if not isinstance(results, list) or len(results) != n: return f"response is not a list of {n} results"
+        if not all(isinstance(r, dict) and isinstance(r.get("status"), int) and "data" in r for r in results):
+            return "response is not a list of dict(name, status, data)"
+        return results
+
+    @staticmethod
+    def __response_of(result, rtype):
+        """The GenericResponse of one dict(name, status, data) result of a batch, marshalled as AetherClient.request"""
+        if result["status"] != 200: return GenericResponse(code=result["status"], error=result["data"])
+        try: return GenericResponse(code=200, data=GenericCloudClient._marshal_response_text_into_object(result["data"], rtype))
+        except Exception as e: return GenericResponse(code=500, error=f"AetherClient batch response of {result.get('name')} not {rtype}: {e}")
+
+    @staticmethod
+    def endpoint_of(endpoint):
+        """Resolves ae://function (or ae://function:servlet_name) into (function name, the http endpoint of one of its
+        servlets); an http:// endpoint is its own"""
+        if not AetherClient.is_ae_endpoint(endpoint): return endpoint.rsplit("/", 1)[-1], endpoint
         ae_name = endpoint[len(AetherClient.aether_protocol):]
-        function_name, server_name = ae_name.split(":") if ":" in ae_name else (ae_name, None)
-        endpoint = BuildServletConfig.get_endpoint(function_name, servlet_name=server_name)
+        function_name, server_name = ae_name.split(":", 1) if ":" in ae_name else (ae_name, None)
+        return function_name, BuildServletConfig.get_endpoint(function_name, servlet_name=server_name)
+
+    @staticmethod
+    def wrap_to_cloudnode_request(endpoint, data):
+        _, endpoint = AetherClient.endpoint_of(endpoint)
+        packaged = AetherClient.__packaged(data)
+        logger.info(f"cloudnode aether={endpoint} tid={packaged['__ae']['tid']} mapped to {endpoint}")
+        return endpoint, packaged, "POST"  # FIX ME, I want this and ReturnType from methods
+
+    @staticmethod
+    def __packaged(data):
         tid = uuid.uuid4().hex.lower()[:6]
         pid = "__PID_"  # FIXME
         uid = "__UID_"  # FIXME
-        packaged = {"__ae": dict(uid=uid, pid=pid, tid=tid), "d": data}
-        logger.info(f"cloudnode aether={endpoint} tid={tid} mapped to {endpoint}")
-        return endpoint, packaged, "POST"  # FIX ME, I want this and ReturnType from methods
+        return {"__ae": dict(uid=uid, pid=pid, tid=tid), "d": data}
 
     @staticmethod
     def is_ae_data(kwargs):
@@ -75,8 +135,12 @@ class AetherClient(object):
 
     @staticmethod
     def wrap_to_cloudnode_response(uid, pid, tid, response):
-        packaged = {"__ae": dict(uid=uid, pid=pid, tid=tid), "d": response.get_data(as_text=True)}
-        return Response(response=json.dumps(packaged), status=response.status)
+        return Response(response=AetherClient.wrap_to_cloudnode_text(uid, pid, tid, response.get_data(as_text=True)), status=response.status)
+
+    @staticmethod
+    def wrap_to_cloudnode_text(uid, pid, tid, text):
+        """The json body of a wrapped response, for servlets which are not Flask (i.e., ASGI servlets)"""
+        return json.dumps({"__ae": dict(uid=uid, pid=pid, tid=tid), "d": text})
 
     @staticmethod
     def unwrap_from_cloudnode_response(response):
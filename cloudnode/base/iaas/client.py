@@ -66,7 +66,7 @@ class GenericCloudClient(object):
             msg = f"GenericCloudClient request failed:\n {e}"
             if hasattr(e, "response") and hasattr(e.response, "text"): msg += f" ==> {e.response.text}"
             logger.exception(msg)
-        return GenericResponse(code=r.status_code, error=msg)
+        return GenericResponse(code=None if r is None else r.status_code, error=msg)  # None if no response, i.e., refused
 
     @staticmethod
     def _marshal_response_text_into_object(rtext, rtype):
@@ -0,0 +1,111 @@
+from cloudnode.base.iaas.nodes.TraditionalCloudFunction import TraditionalCloudFunction
+from cloudnode.base.iaas.CloudNodeLogger import CloudNodeLogger
+from cloudnode.base.iaas.aether import AetherClient
+from http import HTTPStatus
+import concurrent.futures
+import asyncio
+import json
+
+from cloudnode.base.core.lightweight_utilities.profiler_logger import ProfilerLogger
+profiler, logger = ProfilerLogger.getLogger(__name__)
+
+# BatchCloudFunction is the /functions/_batch endpoint of every servlet, which runs many calls of its node functions in
+# one request, i.e., POST [dict(name="Items.get", kwargs=dict(id=1)), dict(name="Items.get", kwargs=dict(id=2)), ...],
+# so that a client which needs N small calls pays one round trip per servlet rather than N (see AetherClient
+# .request_batch, which groups calls by the servlet of their function). Calls run with at most parallel at a time (the
+# threads of the servlet) and each is handled as its own request would be, meta requests (__ping) included; the response
+# is a list of dict(name, status, data) in the order of the calls, where data is the body its own request would return
+# (i.e., the json of the results) or its error message, so that one failed call does not fail the others.
+
+
+class BatchCloudFunction:
+
+    name = "_batch"
+    methods = ["POST"]
+
+    def __init__(self, node_builders, parallel=8):
+        self.functions = {b.name: b for b in node_builders}  # the TraditionalCloudFunctions of the servlet, by name
+        self.parallel = parallel
+        self.route = TraditionalCloudFunction.route_format.format(name=self.name)
+
+    def flask_route(self, app):
+        """Creates the Flask ingress of the batch endpoint; its calls run on a pool of threads per request"""
+        from flask import request, Response
+        logger.info(f"add BatchCloudFunction to Flask parallel={self.parallel} route={self.route}")
+        def flask_batch_ingress():
+            with CloudNodeLogger():
+                with profiler.profile(f"NODE_{self.name.upper()}") as p:
+                    calls, ae = self.__unwrapped(request.get_json(silent=True))
+                    if isinstance(calls, str): return Response(response=calls, status=HTTPStatus.BAD_REQUEST)
+                    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(self.parallel, len(calls)))) as pool:
+                        results = list(pool.map(self.__call, calls))
+                    body = self.__wrapped(results, ae)
+                    p.add(dict(calls=len(calls), bytes=len(body)))
+                    return Response(response=body)
+        flask_batch_ingress.__name__ = self.name
+        app.add_url_rule(self.route, view_func=flask_batch_ingress, methods=self.methods)
+
+    def starlette_route(self):
+        """Creates the Starlette route of the batch endpoint of an ASGI servlet; its calls run as coroutines"""
+        from starlette.responses import Response
+        from starlette.routing import Route
+        logger.info(f"add BatchCloudFunction to Starlette parallel={self.parallel} route={self.route}")
+        async def starlette_batch_ingress(request):
+            with CloudNodeLogger():
+                with profiler.profile(f"NODE_{self.name.upper()}") as p:
+                    try: data = await request.json()
+                    except ValueError: data = None
+                    calls, ae = self.__unwrapped(data)
+                    if isinstance(calls, str): return Response(content=calls, status_code=HTTPStatus.BAD_REQUEST)
+                    semaphore = asyncio.Semaphore(self.parallel)
+                    async def bounded(call):
+                        async with semaphore: return await self.__call_async(call, request.app.state.limiter)
+                    results = await asyncio.gather(*[bounded(call) for call in calls])
+                    body = self.__wrapped(results, ae)
+                    p.add(dict(calls=len(calls), bytes=len(body)))
+                    return Response(content=body)
+        return Route(self.route, endpoint=starlette_batch_ingress, methods=self.methods, name=self.name)
+
+    @staticmethod
+    def __unwrapped(data):
+        """Returns (calls, ae) of a request body, where ae is (uid, pid, tid) of an AetherClient request or None; calls is
+        the error message if the body is not a list of calls"""
+        ae = None
+        if isinstance(data, dict) and AetherClient.is_ae_data(data):
+            uid, pid, tid, data = AetherClient.unwrap_from_cloudnode_kwargs(data)
+            ae = (uid, pid, tid)
+        if not isinstance(data, list): return f"{BatchCloudFunction.name} expects a list of dict(name, kwargs)", ae
+        return data, ae
+
+    @staticmethod
+    def __wrapped(results, ae):
+        body = json.dumps(results)
+        return body if ae is None else AetherClient.wrap_to_cloudnode_text(*ae, body)
+
+    def __function_of(self, call):
+        """Returns (TraditionalCloudFunction, kwargs) of a call, or (None, result) if the call is malformed, unknown or
+        of a function which does not accept POST"""
+        if not isinstance(call, dict) or not isinstance(call.get("name"), str) or not isinstance(call.get("kwargs", dict()), dict):
+            return None, dict(name=None, status=HTTPStatus.BAD_REQUEST, data="a call must be dict(name=str, kwargs=dict)")
+        if call["name"] not in self.functions:
+            return None, dict(name=call["name"], status=HTTPStatus.NOT_FOUND, data=f"function={call['name']} not on this servlet")
+        # NOTE: the batch is a POST, so it only runs functions whose own route accepts POST (not the GET of HTTP types)
+        if "POST" not in [m.upper() for m in self.functions[call["name"]].methods]:
+            return None, dict(name=call["name"], status=HTTPStatus.METHOD_NOT_ALLOWED, data=f"function={call['name']} does not accept POST")
+        return self.functions[call["name"]], call.get("kwargs", dict())
+
+    def __call(self, call):
+        function, kwargs = self.__function_of(call)
+        if function is None: return kwargs
+        return self.__result(function.name, *function.call(kwargs))
+
+    async def __call_async(self, call, limiter):
+        function, kwargs = self.__function_of(call)
+        if function is None: return kwargs
+        return self.__result(function.name, *(await function.call_async(kwargs, limiter)))
+
+    @staticmethod
+    def __result(name, body, status):
+        if isinstance(body, bytes): body = body.decode("utf-8")
+        elif not isinstance(body, str): body = str(body)
+        return dict(name=name, status=int(status), data=body)
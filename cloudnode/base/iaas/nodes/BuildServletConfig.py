@@ -37,8 +37,8 @@ class BuildServletConfig(object):
 
     @staticmethod
     def empty_disk():
-        if os.path.exists(nf_filename_configs): FileSystem.easy_delete(nf_filename_configs)
-        if os.path.exists(nf_filename_endpoints): FileSystem.easy_delete(nf_filename_endpoints)
+        if FileSystem.easy_exists(nf_filename_configs): FileSystem.easy_delete(nf_filename_configs)
+        if FileSystem.easy_exists(nf_filename_endpoints): FileSystem.easy_delete(nf_filename_endpoints)
 
     def to_disk_configs_by_servlet(self):
         # NOTE: see note in endpoints_to_disk to understand the format of cf_configurations_filename
@@ -58,7 +58,7 @@ class BuildServletConfig(object):
 
     @staticmethod
     def from_disk_configs_by_servlet(servlet_name):  # FIXME: note; everything necessary to rebuild a servlet from scratch
-        if os.path.exists(nf_filename_configs):
+        if FileSystem.easy_exists(nf_filename_configs):
             configs_by_servlet = json.load(FileSystem.easy_download(nf_filename_configs))
         else: raise RuntimeError(f"configs_by_servlet file does not exist stub={nf_filename_configs}")
         if servlet_name not in configs_by_servlet:
@@ -66,7 +66,7 @@ class BuildServletConfig(object):
         try: metadata, function_configs = configs_by_servlet[servlet_name]["metadata"], configs_by_servlet[servlet_name]["functions"]
         except: raise ValueError(f"servlet={servlet_name} configs_by_servlet not properly formed data={configs_by_servlet[servlet_name]}")
         return BuildServletConfig(servlet_name=servlet_name, **metadata, no_base_sysops=True)\
-            .add_functions(function_configs.values()).integrity_confirmed()
+            .add_functions(list(function_configs.values())).integrity_confirmed(unpacked=True)
 
     @staticmethod
     def endpoints_by_function_to_disk(endpoints_by_function_name, servlet_name):
@@ -3,9 +3,15 @@ from cloudnode.base.core.lightweight_utilities.misc_logging import LogEveryS
 from cloudnode.base.iaas.for_functions import parse_function_config_into_source
 from cloudnode.base.iaas.nodes.BuildServletConfig import BuildServletConfig
 from cloudnode.base.iaas.nodes.TraditionalCloudFunction import TraditionalCloudFunction
+from cloudnode.base.iaas.nodes.BatchCloudFunction import BatchCloudFunction
+from cloudnode.base.iaas.nodes.prefork import PreforkServer, serve_asgi
 from cloudnode.base.iaas.cron import EasyCron
+from cloudnode.base.iaas.aether import AetherClient
+from cloudnode.base.core.swiftdata.watch import Watches
 from flask_cors import CORS
+import contextlib
 import threading
+import signal
 import flask
 import inspect
 import datetime
@@ -25,6 +31,8 @@ profiler, logger = ProfilerLogger.getLogger(__name__)
 # Infrastructure is a server built on Flask which performs a blocking start after converting known lists of functions
 # into servlets of easyapi endpoints; for convenience, system-level tools such as cron scheduling is also available.
 
+Watches.set_sender(AetherClient.request)  # saved queries post to ae:// endpoints as node functions do; see SwiftData.watch
+
 daemon_functions = [
     dict(source="cloudnode.base.iaas.nodes.Infrastructure:Infrastructure.end", as_type="HTTP")
 ]
@@ -37,6 +45,12 @@ class BuildServlet:
         self.config = None
         self.node_builders = []  # NodeBuilders construct APIs (Flask endpoints) from their Python equivalents
         self.thread = None       # The thread that manages the actual background process its Flask functions runs on
+        self.workers = None      # The worker processes of its routes (prefork), or None to run flask on self.thread
+        self.threads = 8         # The threads per worker process (prefork), or for the functions which are not async (asgi),
+                                 # and the calls run at a time by its /functions/_batch endpoint (see BatchCloudFunction)
+        self.prefork = None      # The PreforkServer of its worker processes, once started
+        self.worker_init = None  # The "module:function" every worker process calls before it builds its app (prefork)
+        self.asgi = False        # True if any of its functions is an async def: served by uvicorn on an event loop
 
         self.flask_app = flask.Flask(__name__)  # The named Flask app to launch the .run() for this servlet. Running one
         CORS(self.flask_app)                    # Flask app for each servlet is not the intended use of Flask so beware.
@@ -76,19 +90,54 @@ class BuildServlet:
             builder.config = unpacked
             for item in unpacked.function_configs:
                 builder.node_builders.append(TraditionalCloudFunction(unpacked.servlet_name, item))
+            builder.asgi = any(b.is_async for b in builder.node_builders)
         return builder
 
+    @staticmethod
+    def rebuilt(servlet_name, threads=8):
+        """Returns the app of a built servlet from its config on disk, without writing it; i.e., in a prefork worker"""
+        builder = BuildServlet()
+        builder.config = BuildServletConfig.from_disk_configs_by_servlet(servlet_name)
+        for item in builder.config.function_configs:
+            builder.node_builders.append(TraditionalCloudFunction(servlet_name, item))
+        if any(b.is_async for b in builder.node_builders): return BuildServlet.asgi_app(builder.node_builders, threads)
+        for b in builder.node_builders + [BatchCloudFunction(builder.node_builders, threads)]: b.flask_route(builder.flask_app)
+        return builder.flask_app
+
+    @staticmethod
+    def asgi_app(node_builders, threads=8):
+        """Returns the Starlette app of an ASGI servlet; functions which are not async def run on its threads"""
+        from starlette.middleware.cors import CORSMiddleware  # NOTE: only servlets of async def functions need starlette
+        import starlette.applications
+        import anyio
+        @contextlib.asynccontextmanager
+        async def lifespan(app):
+            app.state.limiter = anyio.CapacityLimiter(threads)  # NOTE: created on the event loop which serves the app
+            yield
+        routes = [b.starlette_route() for b in node_builders + [BatchCloudFunction(node_builders, threads)]]
+        app = starlette.applications.Starlette(routes=routes, lifespan=lifespan)
+        app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])  # as CORS()
+        return app
+
     def start(self):
         """starts a background thread containing the flask.run() for its hostport; i.e., starts to run this servlet"""
         # NOTE: daemon=True ensures that all servlets are automatically ended when the main program Infrastructure ends
         if self.config is None: raise RuntimeError("BuildServlet.build() must be run before BuildServlet.start()")
         protocol, hostport, servlet_name = self.config.protocol, self.config.hostport, self.config.servlet_name
-        logger.info(f"Starting servlet={servlet_name} protocol={protocol} hostpost={hostport}")
-        for b in self.node_builders: b.flask_route(self.flask_app)
+        logger.info(f"Starting servlet={servlet_name} protocol={protocol} hostpost={hostport} workers={self.workers}")
         (host, port), uid = hostport.split(":"),  f"{protocol}{hostport}"
         if uid in Infrastructure.servlets: raise RuntimeError(f"servlet {uid} already running: {Infrastructure.servlets.keys()}")
-        self.thread = threading.Thread(target=self.flask_app.run, args=(host, int(port)), name=f"servlet={uid}", daemon=True)
-        self.thread.start()
+        if self.workers is None and self.asgi:
+            app = BuildServlet.asgi_app(self.node_builders, self.threads)
+            self.thread = threading.Thread(target=serve_asgi, args=(app, host, int(port)), name=f"servlet={uid}", daemon=True)
+            self.thread.start()
+        elif self.workers is None:
+            for b in self.node_builders + [BatchCloudFunction(self.node_builders, self.threads)]: b.flask_route(self.flask_app)
+            self.thread = threading.Thread(target=self.flask_app.run, args=(host, int(port)), name=f"servlet={uid}", daemon=True)
+            self.thread.start()
+        else:  # NOTE: workers are processes, stopped at the exit of the main program Infrastructure as the threads end
+            self.prefork = PreforkServer(f"{__name__}:BuildServlet.rebuilt", servlet_name, host, int(port), workers=self.workers,
+                                         threads=self.threads, init=self.worker_init).start()
 
         endpoints = {b.name: f"{protocol}{hostport}{b.route}" for b in self.node_builders}
         BuildServletConfig.endpoints_by_function_to_disk(endpoints, self.config.servlet_name)
@@ -97,6 +146,12 @@ class BuildServlet:
         if self.config is None: raise RuntimeError("BuildServlet.start() must be run before BuildServlet.end()")
         protocol, hostport, servlet_name = self.config.protocol, self.config.hostport, self.config.servlet_name
         logger.info(f"Ending servlet={servlet_name} protocol={protocol} hostport={hostport}")
+        if self.prefork is not None: self.prefork.stop()
+
+    def reload(self):
+        """Replaces the worker processes of a prefork servlet gracefully, i.e., after deploying new code; else a no-op"""
+        if self.prefork is not None: self.prefork.reload()
+        return self
 
 
 class Infrastructure(object):
@@ -122,11 +177,16 @@ class Infrastructure(object):
         return Infrastructure
 
     @staticmethod
-    def servlet(hostport, functions, servlet_name=None, no_base_sysops=False):
-        logger.info(f"Infrastructure BuildServlet hostport={hostport} functions={functions}")
+    def servlet(hostport, functions, servlet_name=None, no_base_sysops=False, workers=None, threads=8, worker_init=None):
+        """Builds a servlet; workers=n serves it from n prefork worker processes of threads each, which each call
+        worker_init="module:function" first, as they do not run the main program (see prefork.py). A servlet with async
+        def functions is served by uvicorn on an event loop, where threads run its other functions"""
+        if worker_init is not None and workers is None: raise ValueError("worker_init requires workers (a prefork servlet)")
+        logger.info(f"Infrastructure BuildServlet hostport={hostport} functions={functions} workers={workers}")
         config = BuildServletConfig(hostport=hostport, servlet_name=servlet_name, no_base_sysops=no_base_sysops)\
             .add_functions(functions).integrity_confirmed()
         servlet = BuildServlet.build(config)  # servlet has an updated config
+        servlet.workers, servlet.threads, servlet.worker_init = workers, threads, worker_init
         Infrastructure.servlets[config.servlet_name] = servlet
         return servlet
 
@@ -140,11 +200,20 @@ class Infrastructure(object):
     @staticmethod
     def add_crons(to_add): [Infrastructure.crons.append(EasyCron(**cron)) for cron in to_add]
 
+    @staticmethod
+    def add_cron(cron):
+        """Runs any object of the EasyCron protocol (.do_if_time_has_lapsed()) from the cron loop, i.e., a ScheduledRun
+        such as SwiftDataBackend().snapshots(applet), LogLine.rollover_schedule(index) or Reading.tier_schedule(index)"""
+        Infrastructure.crons.append(cron)
+        return cron
+
     @staticmethod
     def blocking_start():
         logger.info(f"Adding daemon servlet functions on hostport={daemon_hostport}")
         Infrastructure.servlet(daemon_hostport, daemon_functions)
         for servlet in Infrastructure.servlets.values(): servlet.start()
+        try: signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=Infrastructure.reload, daemon=True).start())
+        except (AttributeError, ValueError): logger.info("Infrastructure SIGHUP reload unavailable (platform or not main thread)")
 
         _every = LogEveryS(logger, n_sec=60, and_first=True)
         while True:
@@ -155,6 +224,13 @@ class Infrastructure(object):
                 exit()  # this is a correct solution when all servers are daemons (c.f. their thread config)
             for cron in Infrastructure.crons: cron.do_if_time_has_lapsed()
 
+    @staticmethod
+    def reload():
+        """Reloads the worker processes of every prefork servlet gracefully; also on SIGHUP after blocking_start"""
+        for servlet in list(Infrastructure.servlets.values()):
+            if isinstance(servlet, BuildServlet): servlet.reload()
+        return f"RELOADED at={datetime.datetime.now().isoformat()}"
+
     @staticmethod
     def end():
         Infrastructure.abort_now = True
@@ -5,6 +5,7 @@ from cloudnode.base.core.lightweight_utilities.dicts import dictionary_parser
 from cloudnode.base.core.lightweight_utilities.sysops import dynamic_variable_loader
 from http import HTTPStatus
 import datetime
+import inspect
 import json
 
 
@@ -71,6 +72,17 @@ class TraditionalCloudFunction:
         flask_accepts_no_arguments_wrapper.__name__ = self.name
         app.add_url_rule(self.route, view_func=flask_accepts_no_arguments_wrapper, methods=self.methods)
 
+    def starlette_route(self):
+        """Creates the Starlette route of an ASGI servlet to access the Python function, async def or not"""
+        from starlette.routing import Route
+        logger.info(f"add TraditionalCloudFunction to Starlette name={self.name} methods={self.methods} route={self.route}")
+        return Route(self.route, endpoint=self.__python_function_as_starlette_ingress(), methods=self.methods, name=self.name)
+
+    @property
+    def is_async(self):
+        """True if the Python function is an async def, which is served by an ASGI servlet (see BuildServlet.build)"""
+        return inspect.iscoroutinefunction(self.__resolve_function())
+
 
     ###################################################################################################################
     # NOTE: Code below this line is for wrapping of Python functions to create IaaS endpoints and their profiling.
@@ -87,44 +99,12 @@ class TraditionalCloudFunction:
         # function to a server inbound execution api. This function also looks into the request for one of a few simple
         # meta requests asking to  report on any number of characteristics of any cloud function (ping, metadata, etc).
         from flask import Response
-        if self.function is None:
-            class_name, function_name = self.name.split(".") if "." in self.name else (None, self.name)
-            if class_name is None:
-                self.function = dynamic_variable_loader(self.module, function_name)
-            else: self.function = getattr(dynamic_variable_loader(self.module, class_name), function_name)
-        if self.function is None:
-            raise RuntimeError(f"Configuration error: {self.name} is unable to resolve function.")
+        self.__resolve_function()
 
-        # NOTE: This block of code handles special flags (e.g. __ping) for the Python function.
+        # NOTE: This block of code handles special flags (e.g. __ping) for the Python function; see .call()
         def available_meta_operations_and_python_function(kwargs):
-            try:
-                # expectation: kwargs=dict(__is_awake=<any_value>)
-                # __is_awake is to ensure functions do not shut down, with minimum egress cost.
-                # __ping returns local time to measure round trip latency.
-                # __metadata is currently only name to solve a problem of identifying functions-frameworks urls,
-                # Remember that egress cost is expensive on most commercial cloud provider systems.
-                if len(kwargs) == 1 and "__is_awake" in kwargs.keys():
-                    logger.info("Received IS_AWAKE request: returning confirmation with True response.")
-                    return Response(response=json.dumps(True))
-                if len(kwargs) == 1 and "__ping" in kwargs.keys():
-                    utc_now = datetime.datetime.now().astimezone(datetime.timezone.utc).replace(tzinfo=None).isoformat()
-                    logger.info(f"Received PING request: returning current system utc_now={utc_now}.")
-                    return Response(response=json.dumps(dict(utc_now=utc_now)))
-                if len(kwargs) == 1 and "__metadata" in kwargs.keys():
-                    metadata = dict(name=self.name)
-                    logger.info(f"Received METADATA request: returning {metadata}.")
-                    return Response(response=json.dumps(metadata))
-                # Continue onward into the normal operating Cloud Function calls.
-                args_s = {k: f"{str(v)[:5000]}" for k, v in kwargs.items()}
-                logger.info(f"entering Function {self.name}: {args_s}")
-                results = self.function(**kwargs)
-                if self.do_json: results = json.dumps(results)
-                return Response(response=results)
-            except Exception as e:
-                msg = f"{type(e)}: {e}"
-                status = e.args[1] if len(e.args) > 1 else HTTPStatus.INTERNAL_SERVER_ERROR
-                logger.error(f"{status}: {msg}")
-                return Response(response=msg, status=status)
+            body, status = self.call(kwargs)
+            return Response(response=body, status=status)
 
         def server_entrypoint_suitable_for_profiling_and_logging(request):
             with CloudNodeLogger() as logger:  # switch to CloudNodeLogger from base local logger
@@ -143,5 +123,101 @@ class TraditionalCloudFunction:
                     return r
         return server_entrypoint_suitable_for_profiling_and_logging
 
+    def __python_function_as_starlette_ingress(self):
+        """As __python_function_as_flask_ingress, for an ASGI servlet: async def functions are awaited on its event loop,
+        and other functions run on its threads (request.app.state.limiter), so that they never block the event loop"""
+        from starlette.responses import Response
+        self.__resolve_function()
+
+        async def available_meta_operations_and_python_function(kwargs, limiter):
+            body, status = await self.call_async(kwargs, limiter)
+            return Response(content=body, status_code=status)
+
+        async def server_entrypoint_suitable_for_profiling_and_logging(request):
+            with CloudNodeLogger() as logger:  # switch to CloudNodeLogger from base local logger
+                with profiler.profile(f"NODE_{self.name.upper()}") as p:
+                    if request.method == "GET": kwargs = dict(request.query_params)
+                    elif request.method == "POST":
+                        try: kwargs = await request.json()
+                        except ValueError:  # as BatchCloudFunction, and as flask request.get_json() does
+                            return Response(content=f"{self.name} expects a json body", status_code=HTTPStatus.BAD_REQUEST)
+                    else: raise NotImplemented(f"Request method {request.method} unknown, must be GET or POST.")
+                    is_ae = AetherClient.is_ae_data(kwargs)
+                    if is_ae: uid, pid, tid, kwargs = AetherClient.unwrap_from_cloudnode_kwargs(kwargs)
+                    r = await available_meta_operations_and_python_function(kwargs, request.app.state.limiter)
+                    if is_ae: r = Response(content=AetherClient.wrap_to_cloudnode_text(uid, pid, tid, r.body.decode("utf-8")),
+                                           status_code=r.status_code)
+                    p.add(dict(bytes=len(r.body)))
+                    return r
+        return server_entrypoint_suitable_for_profiling_and_logging
+
+    def call(self, kwargs):
+        """Runs a meta request or the Python function on kwargs, as its endpoint does; returns (response body, status)"""
+        self.__resolve_function()
+        try:
+            meta = self.__meta_operation(kwargs)
+            if meta is not None: return meta, HTTPStatus.OK
+            # Continue onward into the normal operating Cloud Function calls.
+            self.__log_entering(kwargs)
+            results = self.function(**kwargs)
+            return (json.dumps(results) if self.do_json else results), HTTPStatus.OK
+        except Exception as e: return self.__error_of(e)
+
+    async def call_async(self, kwargs, limiter=None):
+        """As .call() on an event loop: an async def function is awaited, and another runs on a thread of limiter"""
+        import anyio.to_thread
+        self.__resolve_function()
+        try:
+            meta = self.__meta_operation(kwargs)
+            if meta is not None: return meta, HTTPStatus.OK
+            self.__log_entering(kwargs)
+            if self.is_async: results = await self.function(**kwargs)
+            else: results = await anyio.to_thread.run_sync(lambda: self.function(**kwargs), limiter=limiter)
+            return (json.dumps(results) if self.do_json else results), HTTPStatus.OK
+        except Exception as e: return self.__error_of(e)
+
+    def __resolve_function(self):
+        """Loads self.function from its module on first use"""
+        if self.function is None:
+            class_name, function_name = self.name.split(".") if "." in self.name else (None, self.name)
+            if class_name is None:
+                self.function = dynamic_variable_loader(self.module, function_name)
+            else: self.function = getattr(dynamic_variable_loader(self.module, class_name), function_name)
+        if self.function is None:
+            raise RuntimeError(f"Configuration error: {self.name} is unable to resolve function.")
+        return self.function
+
+    def __meta_operation(self, kwargs):
+        """Returns the json response of a meta request (__is_awake, __ping, __metadata), or None for a function call"""
+        # expectation: kwargs=dict(__is_awake=<any_value>)
+        # __is_awake is to ensure functions do not shut down, with minimum egress cost.
+        # __ping returns local time to measure round trip latency.
+        # __metadata is currently only name to solve a problem of identifying functions-frameworks urls,
+        # Remember that egress cost is expensive on most commercial cloud provider systems.
+        if len(kwargs) == 1 and "__is_awake" in kwargs.keys():
+            logger.info("Received IS_AWAKE request: returning confirmation with True response.")
+            return json.dumps(True)
+        if len(kwargs) == 1 and "__ping" in kwargs.keys():
+            utc_now = datetime.datetime.now().astimezone(datetime.timezone.utc).replace(tzinfo=None).isoformat()
+            logger.info(f"Received PING request: returning current system utc_now={utc_now}.")
+            return json.dumps(dict(utc_now=utc_now))
+        if len(kwargs) == 1 and "__metadata" in kwargs.keys():
+            metadata = dict(name=self.name)
+            logger.info(f"Received METADATA request: returning {metadata}.")
+            return json.dumps(metadata)
+        return None
+
+    def __log_entering(self, kwargs):
+        args_s = {k: f"{str(v)[:5000]}" for k, v in kwargs.items()}
+        logger.info(f"entering Function {self.name}: {args_s}")
+
+    @staticmethod
+    def __error_of(e):
+        """Returns the (message, status) of the response of a failed function; raise Exception(msg, status) to set it"""
+        msg = f"{type(e)}: {e}"
+        status = e.args[1] if len(e.args) > 1 else HTTPStatus.INTERNAL_SERVER_ERROR
+        logger.error(f"{status}: {msg}")
+        return msg, status
+
 # FIXME: profiler.swift().add(bytes=sd.integer()).as_rates() <== add name automatically;
 # FIXME: do the change to upload the logs and return with the errors stub.
\ No newline at end of file
@@ -0,0 +1,228 @@
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+from cloudnode.base.core.lightweight_utilities.sysops import dynamic_variable_loader
+import concurrent.futures
+import inspect
+import subprocess
+import threading
+import select
+import signal
+import socket
+import atexit
+import time
+import sys
+import os
+
+from cloudnode.base.core.lightweight_utilities.profiler_logger import ProfilerLogger
+profiler, logger = ProfilerLogger.getLogger(__name__)
+
+# Prefork serves the routes of one servlet from a pool of worker processes rather than the development server on a
+# thread of the Infrastructure process, so that its requests are not serialized by one GIL: i.e., Infrastructure.servlet
+# (hostport, functions, workers=4, threads=8). Every worker binds the hostport itself with SO_REUSEPORT, so that the
+# kernel balances the connections across the workers without a proxy, and serves them from a bounded pool of threads.
+#
+# WORKERS: workers are new python processes (not forks) which rebuild the flask app of the servlet from its config on
+# disk (see BuildServlet.rebuilt), so that they do not inherit the threads, locks and connections of the Infrastructure
+# process; node functions must therefore be importable by their module, as for any worker server. Workers which die are
+# restarted by the monitor thread of the PreforkServer, and all are stopped (drained) when the Infrastructure exits.
+# INIT: workers do not run the main program of the Infrastructure, so that what it starts before .blocking_start() (i.e.,
+# SwiftDataBackend().start()) is not started in them: a servlet's worker_init="module:function", i.e., Infrastructure
+# .servlet(hostport, functions, workers=4, worker_init="myapp:connect"), is called by every worker before it builds its
+# app. Crons (see Infrastructure.add_cron) run in the Infrastructure process only, once rather than once per worker.
+# RESTARTS: the monitor restarts dead workers outside of the lock, so that .status() and .reload() do not wait on a slow
+# start; a restart which fails is retried with exponential backoff (check_s doubled per failure, up to max_backoff_s).
+# ASGI: workers of a servlet of async def functions serve its Starlette app with uvicorn instead, on a socket bound with
+# SO_REUSEPORT in the same way; uvicorn drains its requests on SIGTERM.
+# RELOAD: .reload() (or SIGHUP to the Infrastructure process) starts a new generation of workers beside the current one
+# and, once every new worker is bound, stops the old ones gracefully: they stop accepting and finish their requests in
+# flight before they exit, so that no connection is refused during the reload, i.e., after deploying new code.
+
+
+class PooledRequestHandler(WSGIRequestHandler):
+    """One request per connection, so that idle keep-alive connections do not hold the threads of the pool."""
+    protocol_version = "HTTP/1.0"
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """The WSGI server of a worker: binds with SO_REUSEPORT and handles each connection on a pool of threads."""
+
+    multithread = True
+
+    def __init__(self, host, port, app, threads=8):
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix=f"worker={os.getpid()}")
+        super().__init__(host, port, app, handler=PooledRequestHandler)
+
+    def server_bind(self):
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        super().server_bind()
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self.__handle, request, client_address)
+
+    def __handle(self, request, client_address):
+        try: self.finish_request(request, client_address)
+        except Exception: self.handle_error(request, client_address)
+        finally: self.shutdown_request(request)
+
+    def drain(self):
+        """Stops accepting, then waits for the requests in flight; called on SIGTERM."""
+        self.shutdown()
+        self.pool.shutdown(wait=True)
+
+
+def serve_asgi(app, host, port, sock=None):
+    """Serves an ASGI app (see BuildServlet.asgi_app) with uvicorn until it exits; on sock if given, i.e., in a worker"""
+    import uvicorn  # NOTE: only servlets of async def functions need uvicorn
+    server = uvicorn.Server(uvicorn.Config(app, host=host, port=port, log_config=None, timeout_graceful_shutdown=30))
+    server.run(sockets=None if sock is None else [sock])
+
+
+# python -c worker_program app_factory servlet_name host port threads ready_fd init; see PreforkServer
+worker_program = "import sys; from cloudnode.base.iaas.nodes.prefork import serve_worker; serve_worker(*sys.argv[1:])"
+
+
+def loaded(source):
+    """Returns the function of source "module:function" or "module:Cls.method"."""
+    module, path = source.split(":")
+    function = dynamic_variable_loader(module, path.split(".")[0])
+    for name in path.split(".")[1:]: function = getattr(function, name)
+    return function
+
+
+def serve_worker(app_factory, servlet_name, host, port, threads, ready_fd, init=""):
+    """The main of a worker process: runs init, builds the app (WSGI or ASGI), binds, signals ready, serves until SIGTERM."""
+    port, threads, ready_fd = int(port), int(threads), int(ready_fd)
+    if init != "": loaded(init)()
+    app = loaded(app_factory)(servlet_name, threads)
+    if inspect.iscoroutinefunction(type(app).__call__):  # an ASGI app; uvicorn drains on SIGTERM itself
+        sock = socket.socket(socket.AF_INET6 if ":" in host else socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind((host, port))
+        sock.listen(2048)
+        logger.info(f"PREFORK worker pid={os.getpid()} serving asgi servlet={servlet_name} on {host}:{port}")
+        os.write(ready_fd, b"1")
+        os.close(ready_fd)
+        return serve_asgi(app, host, port, sock=sock)
+    server = PooledWSGIServer(host, port, app, threads=threads)
+    signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.drain, daemon=True).start())
+    logger.info(f"PREFORK worker pid={os.getpid()} serving servlet={servlet_name} on {host}:{port} threads={threads}")
+    os.write(ready_fd, b"1")
+    os.close(ready_fd)
+    server.serve_forever()
+    server.pool.shutdown(wait=True)
+    server.server_close()
+
+
+class PreforkServer(object):
+    """Runs the worker processes of one servlet on its hostport: starts, restarts, reloads and stops them."""
+
+    def __init__(self, app_factory, servlet_name, host, port, workers=2, threads=8, init=None, check_s=1.0,
+                 max_backoff_s=60.0, ready_timeout_s=60.0):
+        if not hasattr(socket, "SO_REUSEPORT"): raise NotImplementedError("prefork servlets require SO_REUSEPORT (linux, bsd, macos)")
+        if workers < 1 or threads < 1: raise ValueError(f"workers and threads must be at least 1: workers={workers} threads={threads}")
+        self.app_factory = app_factory  # "module:Cls.method" of app_factory(servlet_name, threads) => WSGI or ASGI app
+        self.servlet_name = servlet_name
+        self.host, self.port = host, port
+        self.n_workers = workers
+        self.threads = threads
+        self.init = init                # "module:function" called by every worker before it builds the app, or None
+        self.check_s = check_s
+        self.max_backoff_s = max_backoff_s
+        self.ready_timeout_s = ready_timeout_s
+        self.workers = []      # the processes of the current generation
+        self.generation = 0
+        self.restarts = 0
+        self.lock = threading.RLock()
+        self.stopping = threading.Event()
+        self.monitor = None
+
+    def start(self):
+        with self.lock:
+            self.workers = self.__spawn(self.n_workers)
+        self.monitor = threading.Thread(target=self.__monitor, name=f"prefork={self.servlet_name}", daemon=True)
+        self.monitor.start()
+        atexit.register(self.stop)  # as daemon threads, workers end with the main program Infrastructure
+        return self
+
+    def reload(self):
+        """Starts a new generation of workers and, once they are bound, stops the previous one gracefully."""
+        with self.lock:
+            previous = self.workers
+            self.generation += 1
+            self.workers = self.__spawn(self.n_workers)
+        self.__stop(previous)
+        logger.info(f"PREFORK servlet={self.servlet_name} reloaded generation={self.generation} pids={self.pids()}")
+        return self
+
+    def stop(self, timeout_s=30.0):
+        self.stopping.set()
+        with self.lock: workers, self.workers = self.workers, []
+        self.__stop(workers, timeout_s=timeout_s)
+
+    def pids(self):
+        with self.lock: return [worker.pid for worker in self.workers]
+
+    def status(self):
+        """Returns dict(servlet, generation, workers, threads, pids, alive, restarts)."""
+        with self.lock:
+            return dict(servlet=self.servlet_name, generation=self.generation, workers=self.n_workers, threads=self.threads,
+                        pids=[w.pid for w in self.workers], alive=sum(1 for w in self.workers if w.poll() is None), restarts=self.restarts)
+
+    def __spawn(self, n):
+        """Starts n workers and waits until each has bound the port."""
+        # NOTE: workers run worker_program rather than a multiprocessing.Process, which would import the __main__ of the
+        # Infrastructure process into each worker and run its Infrastructure.servlet(...) again
+        env = os.environ | dict(PYTHONPATH=os.pathsep.join(p for p in sys.path if p))
+        started = []
+        for _ in range(n):
+            read_fd, write_fd = os.pipe()
+            args = [sys.executable, "-c", worker_program, self.app_factory, self.servlet_name, self.host, str(self.port),
+                    str(self.threads), str(write_fd), self.init or ""]
+            worker = subprocess.Popen(args, env=env, pass_fds=(write_fd,))
+            os.close(write_fd)
+            started.append((worker, read_fd))
+        try:
+            deadline = time.time() + self.ready_timeout_s
+            for worker, read_fd in started:
+                readable, _, _ = select.select([read_fd], [], [], max(0.0, deadline - time.time()))
+                if len(readable) == 0 or os.read(read_fd, 1) != b"1":
+                    self.__stop([w for w, _ in started], timeout_s=1.0)
+                    raise RuntimeError(f"PREFORK worker pid={worker.pid} of servlet={self.servlet_name} failed to start "
+                                       f"within {self.ready_timeout_s}s (exit code={worker.poll()})")
+        finally:
+            for _, read_fd in started: os.close(read_fd)
+        return [worker for worker, _ in started]
+
+    def __stop(self, workers, timeout_s=30.0):
+        for worker in workers:
+            if worker.poll() is None: worker.terminate()  # SIGTERM: the worker drains its requests in flight
+        deadline = time.time() + timeout_s
+        for worker in workers:
+            try: worker.wait(max(0.0, deadline - time.time()))
+            except subprocess.TimeoutExpired:
+                logger.warning(f"PREFORK worker pid={worker.pid} of servlet={self.servlet_name} did not drain in {timeout_s}s")
+                worker.kill()
+                worker.wait()
+
+    def __monitor(self):
+        failures, retry_s = 0, 0.0  # consecutive failed restarts, and when to retry after the last of them
+        while not self.stopping.wait(self.check_s):
+            with self.lock: dead = [(i, w) for i, w in enumerate(self.workers) if w.poll() is not None]
+            for i, worker in dead:
+                if self.stopping.is_set() or time.time() < retry_s: break
+                logger.warning(f"PREFORK worker pid={worker.pid} of servlet={self.servlet_name} exited {worker.returncode}; restarting")
+                try: restarted = self.__spawn(1)[0]
+                except Exception as e:
+                    failures += 1
+                    backoff_s = min(self.max_backoff_s, self.check_s * 2 ** failures)
+                    retry_s = time.time() + backoff_s
+                    logger.error(f"PREFORK restart of servlet={self.servlet_name} failed {failures} time(s); retry in {backoff_s:.1f}s: {e}")
+                    break
+                failures = 0
+                with self.lock:  # NOTE: if a reload or stop replaced the workers meanwhile, the restarted one is not theirs
+                    replaced = self.stopping.is_set() or i >= len(self.workers) or self.workers[i] is not worker
+                    if not replaced:
+                        self.workers[i] = restarted
+                        self.restarts += 1
+                if replaced: self.__stop([restarted], timeout_s=1.0)
+
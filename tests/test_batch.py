@@ -0,0 +1,87 @@
+from cloudnode.base.iaas.nodes.BatchCloudFunction import BatchCloudFunction
+from cloudnode.base.iaas.client import GenericCloudClient, GenericResponse, ReturnType
+from cloudnode.base.iaas.aether import AetherClient
+from http import HTTPStatus
+from unittest import mock
+import unittest
+import logging
+import flask
+import json
+import time
+
+logging.disable(logging.INFO)
+
+
+class Function:
+    """A node function of a servlet, as BatchCloudFunction calls it: .call(kwargs) => (body, status)."""
+
+    def __init__(self, name, status=HTTPStatus.OK, methods=("POST",)):
+        self.name = name
+        self.status = status
+        self.methods = list(methods)
+
+    def call(self, kwargs):
+        time.sleep(kwargs.get("sleep_s", 0.0))
+        return json.dumps(kwargs.get("x")), self.status
+
+
+class TestBatch(unittest.TestCase):
+    """The /functions/_batch endpoint of a servlet, and AetherClient.request_batch across servlets."""
+
+    def setUp(self):
+        self.servlets = dict()  # map from host => the flask test client of its servlet
+        for host in ["a", "b"]:
+            app = flask.Flask(host)
+            BatchCloudFunction([Function(f"{host}.echo"), Function(f"{host}.fails", HTTPStatus.INTERNAL_SERVER_ERROR),
+                                Function(f"{host}.page", methods=["GET"])], parallel=4).flask_route(app)
+            self.servlets[host] = app.test_client()
+
+    def post(self, endpoint, d=None, rtype=None, method="POST"):
+        """GenericCloudClient.request onto the test clients of the servlets, i.e., http://a/functions/_batch"""
+        host, path = endpoint[len("http://"):].split("/", 1)
+        r = self.servlets[host].post(f"/{path}", json=d)
+        if r.status_code != 200: return GenericResponse(code=r.status_code, error=r.get_data(as_text=True))
+        return GenericResponse(code=200, data=GenericCloudClient._marshal_response_text_into_object(r.get_data(as_text=True), rtype))
+
+    def test_results_are_in_the_order_of_the_calls(self):
+        calls = [dict(name="a.echo", kwargs=dict(x=i, sleep_s=0.01 * (5 - i))) for i in range(5)]  # the last finish first
+        calls += [dict(name="a.nope"), dict(kwargs=dict()), dict(name="a.fails", kwargs=dict(x=5)), dict(name="a.page")]
+        r = self.servlets["a"].post("/functions/_batch", json=calls)
+        self.assertEqual(200, r.status_code)
+        results = json.loads(r.get_data(as_text=True))
+        self.assertEqual([json.dumps(i) for i in range(5)], [result["data"] for result in results[:5]])
+        self.assertEqual([200] * 5 + [404, 400, 500, 405], [result["status"] for result in results])
+        for body in [dict(name="a.echo"), "not json"]:
+            with self.subTest(body=body):
+                self.assertEqual(400, self.servlets["a"].post("/functions/_batch", json=body).status_code)
+
+    @staticmethod
+    def endpoint_of(name):
+        """ae://a.echo => (a.echo, http://a/functions/a.echo), as the servlet of a host serves its functions"""
+        function_name = name[len("ae://"):]
+        return function_name, f"http://{function_name.split('.')[0]}/functions/{function_name}"
+
+    def test_request_batch_across_servlets(self):
+        calls = [dict(name=f"ae://{'ab'[i % 2]}.echo", kwargs=dict(x=i)) for i in range(6)] + [dict(name="ae://b.fails")]
+        with mock.patch.object(AetherClient, "endpoint_of", self.endpoint_of), mock.patch.object(GenericCloudClient, "request", self.post):
+            responses = AetherClient.request_batch(calls, rtype=ReturnType.JSON)
+        self.assertEqual(list(range(6)), [r.data for r in responses[:6]])
+        self.assertEqual([200] * 6 + [500], [r.code for r in responses])
+
+    def test_request_batch_of_malformed_responses(self):
+        calls = [dict(name="ae://a.echo", kwargs=dict(x=1)), dict(name="ae://b.echo", kwargs=dict(x=2))]
+        malformed = [["a"], dict(d="[]"), dict(__ae=dict(), d="[]"), dict(__ae=dict(), d="{}"), dict(__ae=dict(), d="not json"),
+                     dict(__ae=dict(), d=json.dumps([dict(name="a.echo")]))]
+        for data in malformed:
+            with self.subTest(data=data):
+                def post(endpoint, d=None, rtype=None, method="POST"):  # servlet a answers malformed, and b as it should
+                    if endpoint.startswith("http://a/"): return GenericResponse(code=200, data=data)
+                    return self.post(endpoint, d=d, rtype=rtype, method=method)
+                with mock.patch.object(AetherClient, "endpoint_of", self.endpoint_of), mock.patch.object(GenericCloudClient, "request", post):
+                    a, b = AetherClient.request_batch(calls, rtype=ReturnType.JSON)
+                self.assertEqual((502, False), (a.code, a.success))
+                self.assertEqual((200, 2), (b.code, b.data))
+
+
+if __name__ == '__main__':
+    unittest.main()
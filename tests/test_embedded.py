@@ -0,0 +1,44 @@
+from cloudnode.base.core.elasticsearch.embedded import EmbeddedElasticsearch, EmbeddedElasticSearchClient
+import elasticsearch
+import unittest
+import types
+import time
+
+
+class TestEmbeddedElasticsearch(unittest.TestCase):
+    """The embedded engine raises as the Elasticsearch client does."""
+
+    def setUp(self):
+        self.es = EmbeddedElasticsearch()
+        self.es.indices.create("docs")
+        for i in range(5): self.es.index("docs", id=str(i), document=dict(n=i), refresh=True)
+
+    def test_malformed_requests_raise_bad_request(self):
+        for query in [dict(percolate=dict()), dict(range=dict(n=dict(gte="not a number"))), dict(match_all=dict(), term=dict())]:
+            with self.subTest(query=query):
+                with self.assertRaises(elasticsearch.BadRequestError) as raised: self.es.search(index="docs", query=query)
+                self.assertEqual(400, raised.exception.meta.status)
+        r = self.es.msearch(searches=[dict(index="docs"), dict(query=dict(percolate=dict())), dict(index="docs"), dict()])
+        self.assertEqual([400, 200], [response["status"] for response in r.body["responses"]])
+
+    def test_scroll_contexts_expire_after_their_keep_alive(self):
+        r = self.es.search(index="docs", size=2, scroll="200ms")
+        r = self.es.scroll(scroll_id=r.body["_scroll_id"], scroll="200ms")
+        self.assertEqual(2, len(r.body["hits"]["hits"]))
+        time.sleep(0.3)
+        with self.assertRaises(elasticsearch.NotFoundError): self.es.scroll(scroll_id=r.body["_scroll_id"], scroll="200ms")
+        with self.assertRaises(elasticsearch.BadRequestError): self.es.search(index="docs", scroll="soon")
+
+    def test_close_requires_index_names(self):
+        self.es.indices.create("logs-1", aliases=dict(logs=dict()))
+        for path in ["/*/_close", "/docs,log*/_close", "/_all/_close"]:
+            with self.subTest(path=path):
+                with self.assertRaises(elasticsearch.BadRequestError): self.es.perform_request("POST", path)
+        client = EmbeddedElasticSearchClient(types.SimpleNamespace(engine=self.es))
+        self.assertEqual(["docs", "logs-1"], sorted(client.indices_close(["*"])))
+        self.assertEqual(["logs-1"], client.indices_close(["logs", "missing"]))
+        self.assertEqual([], client.indices_close(["nothing*"]))
+
+
+if __name__ == '__main__':
+    unittest.main()
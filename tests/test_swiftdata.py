@@ -0,0 +1,193 @@
+from cloudnode import SwiftData, Tiering, sd
+from cloudnode.base.core.swiftdata.modeling import SwiftDataBackend, SwiftDataInternal
+from unittest import mock
+import elasticsearch.helpers
+import dataclasses
+import datetime
+import inspect
+import numpy
+import unittest
+import logging
+import time
+import uuid
+import os
+
+logging.disable(logging.INFO)
+
+
+def utc_now(**delta): return datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(**delta)
+
+
+@dataclasses.dataclass
+class Event(SwiftData):
+    at: sd.timestamp()
+    hourly: sd.timestamp(buckets=["1h", "1d"])
+
+
+@dataclasses.dataclass
+class Place(SwiftData):
+    name: sd.string(analyze=True)
+    state: sd.flags()
+    at: sd.geopoint()
+
+
+@dataclasses.dataclass
+class Passage(SwiftData):
+    text: sd.string(analyze=True)
+    embedding: sd.vector(3, dtype="int8")
+
+
+@dataclasses.dataclass
+class Count(SwiftData):
+    n: sd.integer()
+    x: sd.float()
+
+
+@dataclasses.dataclass
+class Reading(SwiftData, tiering=Tiering("ts", older_than="1d", batch_size=2)):
+    ts: sd.timestamp()
+    value: sd.float()
+
+
+class TestSwiftData(unittest.TestCase):
+    """SwiftData on the embedded engine; each test uses its own index so that local records of other runs are unseen."""
+
+    @classmethod
+    def setUpClass(cls):
+        SwiftDataBackend().start(engine="embedded", rebuild=True)
+
+    @classmethod
+    def tearDownClass(cls):
+        SwiftDataBackend().stop()
+
+    def setUp(self):
+        self.index = f"test{uuid.uuid4().hex[:8]}"
+        self.saved = []
+
+    def tearDown(self):
+        for cls, id in self.saved: cls.delete(self.index, id)
+
+    def save(self, obj, es):
+        obj.save(self.index, es=es)
+        if es: type(obj).refresh_index(self.index, es=True)
+        else: self.saved.append((type(obj), obj.id))
+        return obj
+
+    def test_search_bar_now_is_resolved_each_time(self):
+        Event.create_index(self.index, exist_ok=True)
+        for es in [False, True]:
+            with self.subTest(es=es):
+                self.save(Event.new(id="1", at=utc_now(hours=-1), hourly=utc_now(hours=-1)), es)
+                self.assertEqual(1, len(Event.search_bar(self.index, "at:now-1d..now", es=es)))
+                self.assertEqual(1, len(Event.search_bar(self.index, "hourly:now-1d..now", es=es)))
+                self.save(Event.new(id="2", at=utc_now(), hourly=utc_now()), es)  # after now was first resolved
+                self.assertEqual(2, len(Event.search_bar(self.index, "at:now-1d..now", es=es)))
+                self.assertEqual(2, len(Event.search_bar(self.index, "hourly:now-1d..now", es=es)))
+
+    def test_search_bar_date_only_upper_bound_is_its_whole_day(self):
+        Event.create_index(self.index, exist_ok=True)
+        for es in [False, True]:
+            with self.subTest(es=es):
+                noon = datetime.datetime(2024, 1, 3, 12, tzinfo=datetime.timezone.utc)
+                self.save(Event.new(id="1", at=noon, hourly=noon), es)
+                self.assertEqual(1, len(Event.search_bar(self.index, "at:2024-01-01..2024-01-03", es=es)))
+                self.assertEqual(1, len(Event.search_bar(self.index, "hourly:2024-01-01..2024-01-03", es=es)))
+                self.assertEqual(0, len(Event.search_bar(self.index, "hourly:2024-01-01..2024-01-02", es=es)))
+
+    def test_search_bar_now_is_utc_on_any_host(self):
+        Event.create_index(self.index, exist_ok=True)
+        tz = os.environ.get("TZ")
+        os.environ["TZ"] = "America/New_York"
+        time.tzset()
+        try:
+            self.save(Event.new(id="1", at=utc_now(minutes=-30), hourly=utc_now(minutes=-30)), es=False)
+            self.save(Event.new(id="2", at=utc_now(hours=-3), hourly=utc_now(hours=-3)), es=False)
+            for q, expected in [("at:now-1h..now", ["1"]), ("at:*..now-2h", ["2"]), ("at:now-1d/d..now", ["1", "2"]),
+                                ("at:yesterday..now", ["1", "2"]), ("hourly:now-1h..now", ["1"])]:
+                with self.subTest(q=q):
+                    self.assertEqual(expected, sorted(e.id for e in Event.search_bar(self.index, q, es=False)))
+        finally:
+            if tz is None: del os.environ["TZ"]
+            else: os.environ["TZ"] = tz
+            time.tzset()
+
+    def test_search_bar_absolute_plans_are_cached(self):
+        s = "at:2024-01-01..2024-01-31"
+        self.assertIs(SwiftDataInternal.compiled_search_bar(Event, s), SwiftDataInternal.compiled_search_bar(Event, s))
+        s = "at:now-1d..now"
+        self.assertIsNot(SwiftDataInternal.compiled_search_bar(Event, s), SwiftDataInternal.compiled_search_bar(Event, s))
+
+    def test_mapping_is_explicit(self):
+        Place.create_index(self.index, exist_ok=True)
+        es_client, es_cls, es_index = SwiftDataBackend.operation_context(self.index, Place, with_index=True)
+        mapping = list(es_client.indices.get_mapping(index=es_index._name).body.values())[0]["mappings"]["properties"]
+        self.assertEqual(dict(name="text", state="flattened", at="geo_point"), {k: mapping[k]["type"] for k in ["name", "state", "at"]})
+        self.save(Place.new(id="1", name="museum", state=dict(open="yes"), at=[40.78, -73.96]), es=True)
+        source = es_client.get(index=es_index._name, id="1").body["_source"]
+        self.assertEqual("40.78,-73.96", source["at"])  # lat,lng; an array would be read as [lng, lat]
+        place = Place.search_bar(self.index, "name:museum", es=True)[0]
+        self.assertEqual(([40.78, -73.96], "yes"), (list(place.at), place.state["open"]))
+
+    def test_hybrid_search_of_int8_vectors(self):
+        Passage.create_index(self.index, exist_ok=True)
+        for es in [False, True]:
+            with self.subTest(es=es):
+                self.save(Passage.new(id="x", text="red apple", embedding=[1.0, 0.0, 0.0]), es)
+                self.save(Passage.new(id="y", text="green pear", embedding=[0.0, 1.0, 0.1]), es)
+                found = Passage.hybrid_search(self.index, "", "embedding", [0.1, 0.9, 0.05], k=2, es=es)  # floats, not bytes
+                self.assertEqual(["y", "x"], [p.id for p in found])
+                found = Passage.hybrid_search(self.index, "apple", "embedding", [0.9, 0.1, 0.0], k=1, es=es)
+                self.assertEqual(["x"], [p.id for p in found])
+
+    def test_count_takes_es_positionally(self):
+        Count.create_index(self.index, exist_ok=True)
+        self.save(Count.new(id="1", n=1), True)
+        self.save(Count.new(id="2", n=2), True)
+        self.save(Count.new(id="3", n=3), False)
+        self.assertEqual((2, 1), (Count.count(self.index, True), Count.count(self.index, False)))
+        self.assertEqual(1, Count.count(self.index, True, q="n:2"))
+
+    def test_integer_coercion(self):
+        self.assertEqual((3, 3, 3, [1, 2]), tuple(Count.new(n=n).n for n in [3, 3.0, "3", [1, 2.0]]))
+        for n in [3.7, "3.7", numpy.float32(0.5), [1, 2.5]]:
+            with self.subTest(n=n):
+                with self.assertRaises(ValueError): Count.new(n=n)
+        self.assertEqual(3.7, Count.new(x=3.7).x)
+
+    def test_tier_stops_when_deletes_fail(self):
+        Reading.create_index(self.index, exist_ok=True)
+        for i in range(3): self.save(Reading.new(id=str(i), ts=utc_now(days=-2), value=i), es=True)
+        es_client, es_cls, es_index = SwiftDataBackend.operation_context(self.index, Reading, with_index=True)
+        bulk = es_client.bulk
+        def failing_bulk(operations, **kwargs):  # the first delete succeeds, the others fail
+            response = bulk(operations=operations[:1], **kwargs)
+            error = dict(status=503, error=dict(type="unavailable_shards_exception"))
+            failed = [dict(delete=op["delete"] | error) for op in operations[1:]]
+            return es_client.response(dict(response.body, errors=True, items=response.body["items"] + failed))
+        with mock.patch.object(es_client, "bulk", failing_bulk):
+            with self.assertRaises(elasticsearch.helpers.BulkIndexError) as raised: Reading.tier(self.index)
+        self.assertEqual(1, len(raised.exception.errors))
+        self.assertEqual(2, es_client.count(index=es_index._name).body["count"])  # the failed one is still hot
+        self.assertEqual(dict(moved=2, cold=3), Reading.tier(self.index))
+        self.assertEqual(0, es_client.count(index=es_index._name).body["count"])
+        self.assertEqual(["0", "1", "2"], sorted(Reading.list(self.index, es=True)))
+
+    def test_watch_posts_by_its_send(self):
+        posted = []
+        send = lambda endpoint, data, rtype: posted.append((endpoint, [r["id"] for r in data["records"]])) or True
+        saved = Event.watch(self.index, "at:now-1d..now", "ae://on_event", linger_s=0.05, send=send)
+        self.save(Event.new(id="1", at=utc_now(), hourly=utc_now()), es=False)
+        self.save(Event.new(id="2", at=utc_now(days=-2), hourly=utc_now()), es=False)
+        self.assertEqual(1, saved.close()["posted"])
+        self.assertEqual([("ae://on_event", ["1"])], posted)
+
+    def test_queries_default_to_elasticsearch(self):
+        for name in ["search_bar", "flagged", "stats", "sort_by", "within", "in_bbox", "geo_grid", "hybrid_search",
+                     "suggest", "query_frame", "scan_frame"]:
+            self.assertIs(True, inspect.signature(getattr(SwiftData, name)).parameters["es"].default, name)
+        for name in ["get", "exists", "list", "delete", "count", "save"]:
+            self.assertIs(False, inspect.signature(getattr(SwiftData, name)).parameters["es"].default, name)
+
+
+if __name__ == '__main__':
+    unittest.main()
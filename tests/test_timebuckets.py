@@ -0,0 +1,56 @@
+from cloudnode.base.core.elasticsearch import timebuckets
+import unittest
+
+
+def key(iso): return str(int(timebuckets.epoch_of(iso)))
+
+
+def at(iso): return timebuckets.iso_of(timebuckets.epoch_of(iso))
+
+
+class TestCover(unittest.TestCase):
+    """timebuckets.cover: whole buckets within the window, and ranges within its partial edge buckets only."""
+
+    widths = timebuckets.widths_of(["1h", "1d"])
+
+    def test_aligned_window_is_whole_buckets(self):
+        terms, edges = timebuckets.cover(dict(gte="2024-01-01T00:00:00", lt="2024-01-03T02:00:00"), self.widths)
+        self.assertEqual([key("2024-01-01"), key("2024-01-02")], terms["1d"])
+        self.assertEqual([key("2024-01-03T00:00:00"), key("2024-01-03T01:00:00")], terms["1h"])
+        self.assertEqual([], edges)
+
+    def test_unaligned_bounds_keep_ranges_in_their_edge_buckets(self):
+        terms, edges = timebuckets.cover(dict(gte="2024-01-01T00:30:00", lte="2024-01-01T05:15:00"), self.widths)
+        self.assertEqual([key(f"2024-01-01T0{h}:00:00") for h in range(1, 5)], terms["1h"])
+        self.assertEqual([("1h", key("2024-01-01T00:00:00"), dict(gte="2024-01-01T00:30:00", lt=at("2024-01-01T01:00:00"))),
+                          ("1h", key("2024-01-01T05:00:00"), dict(gte=at("2024-01-01T05:00:00"), lte="2024-01-01T05:15:00"))], edges)
+
+    def test_gt_an_aligned_bound_excludes_its_bucket(self):
+        terms, edges = timebuckets.cover(dict(gt="2024-01-01T00:00:00", lt="2024-01-01T03:00:00"), self.widths)
+        self.assertEqual([key("2024-01-01T01:00:00"), key("2024-01-01T02:00:00")], terms["1h"])
+        self.assertEqual([("1h", key("2024-01-01T00:00:00"), dict(gt="2024-01-01T00:00:00", lt=at("2024-01-01T01:00:00")))], edges)
+
+    def test_date_only_bounds_round_as_elasticsearch(self):
+        terms, edges = timebuckets.cover(dict(gte="2024-01-01", lte="2024-01-03"), self.widths)  # lte: all of the 3rd
+        self.assertEqual([key("2024-01-01"), key("2024-01-02")], terms["1d"])
+        self.assertEqual([key(f"2024-01-03T{h:02d}:00:00") for h in range(23)], terms["1h"])
+        self.assertEqual([("1h", key("2024-01-03T23:00:00"), dict(gte=at("2024-01-03T23:00:00"), lte="2024-01-03"))], edges)
+        terms, edges = timebuckets.cover(dict(gte="2024-01-01", lt="2024-01-03"), self.widths)  # lt: before the 3rd
+        self.assertEqual(([key("2024-01-01"), key("2024-01-02")], []), (terms["1d"], edges))
+        terms, edges = timebuckets.cover(dict(gt="2024-01-01", lt="2024-01-03"), self.widths)  # gt: after the 1st
+        self.assertEqual([key("2024-01-02")], terms["1d"])
+
+    def test_outer_cover_is_a_superset_without_edges(self):
+        terms, edges = timebuckets.cover(dict(gte="2024-01-01T00:30:00", lte="2024-01-01T01:15:00"), self.widths, outer=True)
+        self.assertEqual(([key("2024-01-01T00:00:00"), key("2024-01-01T01:00:00")], []), (terms["1h"], edges))
+
+    def test_windows_which_are_not_rewritten(self):
+        for bounds in [dict(gte="2024-01-01"),                                   # open-ended
+                       dict(gte="now-1d", lte="now"),                            # relative
+                       dict(gte="2024-01-01T00:10:00", lte="2024-01-01T00:50:00"),  # within one bucket
+                       dict(gte="2000-01-01", lte="2024-01-01")]:                # more than max_terms keys
+            with self.subTest(bounds=bounds): self.assertIsNone(timebuckets.cover(bounds, self.widths))
+
+
+if __name__ == '__main__':
+    unittest.main()